@@ -0,0 +1,704 @@
+import os
+import time
+from argparse import ArgumentParser
+
+import h5py
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from data_source import BlockShuffleBatchSampler, DuetDynamicBatchTrainset, DuetDynamicTrainset, \
+    DuetHdf5BatchTestset, DuetHdf5BatchTrainset, DuetHdf5Testset, DuetHdf5Trainset, LengthBucketBatchSampler, \
+    build_interaction_matrix, build_interaction_matrices, collate_trimmed, idfs_to_array, \
+    collate_sparse, interaction_matrix_from_matches, load_idfs, sparse_interaction_matrices
+from duetv2_model import DuetV2, DuetV2Local, model_from_train_args
+from qa_utils.evaluation import read_args
+from train import SplitOptimizer, build_optimizer
+
+
+def _reference_interaction_matrix(q_ids, doc_ids, idfs, max_query_len, max_doc_len):
+    """The original pure python interaction matrix builder, kept as a baseline."""
+    m = np.zeros(shape=(max_doc_len, max_query_len), dtype=np.float32)
+    for j in range(len(doc_ids)):
+        for i in range(len(q_ids)):
+            cur_qid = q_ids[i]
+            if cur_qid == doc_ids[j]:
+                m[j, i] = idfs[cur_qid]
+    return m
+
+
+def _synthetic_pairs(n, vocab_size, max_query_len, max_doc_len, seed=0):
+    """Sample n random query-document pairs with zipf distributed token ids, so that matches are realistic."""
+    rng = np.random.default_rng(seed)
+    idfs = dict(enumerate(rng.uniform(0, 10, size=vocab_size).tolist()))
+
+    def sample(max_len):
+        ids = np.minimum(rng.zipf(1.3, size=rng.integers(1, max_len + 1)), vocab_size - 1)
+        return ids.astype(np.int64)
+
+    pairs = [(sample(max_query_len), sample(max_doc_len)) for _ in range(n)]
+    return pairs, idfs
+
+
+def _pad_to(x, n):
+    return np.pad(x, (0, n - len(x)), constant_values=0)
+
+
+def _samples_per_sec(fn, n):
+    start = time.perf_counter()
+    fn()
+    return n / (time.perf_counter() - start)
+
+
+def bench_imat(args):
+    pairs, idfs = _synthetic_pairs(args.num_samples, args.vocab_size, args.max_q_len, args.max_d_len)
+    idf_array = idfs_to_array(idfs)
+    queries = np.stack([_pad_to(q, args.max_q_len) for q, _ in pairs])
+    docs = np.stack([_pad_to(d, args.max_d_len) for _, d in pairs])
+
+    reference = np.stack([_reference_interaction_matrix(q, d, idfs, args.max_q_len, args.max_d_len)
+                          for q, d in pairs])
+    vectorized = np.stack([build_interaction_matrix(q, d, idfs, args.max_q_len, args.max_d_len) for q, d in pairs])
+    batched = np.concatenate([build_interaction_matrices(queries[i:i + args.batch_size],
+                                                         docs[i:i + args.batch_size], idfs)
+                              for i in range(0, len(pairs), args.batch_size)])
+    assert np.array_equal(reference, vectorized), 'vectorized builder differs from the reference'
+    assert np.array_equal(reference, batched), 'batched builder differs from the reference'
+    assert np.array_equal(reference, build_interaction_matrices(queries, docs, idf_array)), \
+        'idf array lookup differs from the reference'
+
+    results = {
+        'python loop': _samples_per_sec(
+            lambda: [_reference_interaction_matrix(q, d, idfs, args.max_q_len, args.max_d_len) for q, d in pairs],
+            len(pairs)),
+        'np.equal.outer': _samples_per_sec(
+            lambda: [build_interaction_matrix(q, d, idfs, args.max_q_len, args.max_d_len) for q, d in pairs],
+            len(pairs)),
+        'batched (bs={})'.format(args.batch_size): _samples_per_sec(
+            lambda: [build_interaction_matrices(queries[i:i + args.batch_size], docs[i:i + args.batch_size], idfs)
+                     for i in range(0, len(pairs), args.batch_size)],
+            len(pairs)),
+        'batched, idf array': _samples_per_sec(
+            lambda: [build_interaction_matrices(queries[i:i + args.batch_size], docs[i:i + args.batch_size],
+                                                idf_array)
+                     for i in range(0, len(pairs), args.batch_size)],
+            len(pairs))
+    }
+    for name, sps in results.items():
+        print('{:<24} {:>12.0f} samples/sec'.format(name, sps))
+
+
+def _vlen_bytes(dataset, rows):
+    """Estimate the bytes a variable length dataset occupies on disk (heap data plus a 16 byte reference per row) from
+    a sample of rows."""
+    sample_bytes = sum(row.nbytes for row in rows)
+    return len(dataset) * (16 + sample_bytes / len(rows))
+
+
+def bench_matches(args):
+    idfs = load_idfs(args.IDF_FILE)
+    with h5py.File(args.HDF5_FILE, 'r') as fp:
+        if 'pos_matches' in fp:
+            fields = [('pos_docs', 'pos_matches'), ('neg_docs', 'neg_matches')]
+        elif 'matches' in fp:
+            fields = [('docs', 'matches')]
+        else:
+            raise ValueError('{} does not contain match coordinates, see --save_matches.'.format(args.HDF5_FILE))
+
+        n = min(args.num_samples, len(fp['queries']))
+        queries = list(fp['queries'][:n])
+        extra_bytes, build_time, scatter_time = 0, 0, 0
+        for doc_field, match_field in fields:
+            docs = list(fp[doc_field][:n])
+            matches = list(fp[match_field][:n])
+            extra_bytes += _vlen_bytes(fp[match_field], matches)
+
+            start = time.perf_counter()
+            built = [build_interaction_matrix(q, d, idfs, args.max_q_len, args.max_d_len)
+                     for q, d in zip(queries, docs)]
+            build_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            scattered = [interaction_matrix_from_matches(q, m, idfs, args.max_q_len, args.max_d_len)
+                         for q, m in zip(queries, matches)]
+            scatter_time += time.perf_counter() - start
+            assert all(np.array_equal(a, b) for a, b in zip(built, scattered)), 'matches give a different matrix'
+
+        epoch_scale = len(fp['queries']) / n
+    file_size = os.path.getsize(args.HDF5_FILE)
+    print('file size:                {:>12.2f} MB'.format(file_size / 2 ** 20))
+    print('match coordinates (est.): {:>12.2f} MB ({:.1%})'.format(extra_bytes / 2 ** 20, extra_bytes / file_size))
+    print('CPU per epoch, build:     {:>12.3f} s'.format(build_time * epoch_scale))
+    print('CPU per epoch, scatter:   {:>12.3f} s'.format(scatter_time * epoch_scale))
+
+
+def _open_dataset(file_path, args, batched=False, **kwargs):
+    """Open a train or candidate set file with the matching dataset class, without building interaction matrices."""
+    with h5py.File(file_path, 'r') as fp:
+        is_trainset = 'pos_docs' in fp or 'pos_doc_refs' in fp
+        is_dynamic = is_trainset and 'neg_docs' not in fp and 'neg_doc_refs' not in fp
+    if is_dynamic:
+        dataset_cls = DuetDynamicBatchTrainset if batched else DuetDynamicTrainset
+    elif is_trainset:
+        dataset_cls = DuetHdf5BatchTrainset if batched else DuetHdf5Trainset
+    else:
+        dataset_cls = DuetHdf5BatchTestset if batched else DuetHdf5Testset
+    return dataset_cls(file_path, args.max_q_len, args.max_d_len, None, build_imat=False, **kwargs)
+
+
+def bench_layout(args):
+    rng = np.random.default_rng(0)
+    print('{:<40} {:>10} {:>10} {:>16} {:>18} {:>18} {:>12}'.format('file', 'rows', 'size (MB)', 'random rows/s',
+                                                                   'sequential rows/s', 'batched rows/s',
+                                                                   'epoch (s)'))
+    for file_path in args.HDF5_FILES:
+        dataset = _open_dataset(file_path, args)
+        n = min(args.num_samples, len(dataset))
+        random_rows = _samples_per_sec(lambda: [dataset[i] for i in rng.integers(0, len(dataset), size=n)], n)
+        sequential_rows = _samples_per_sec(lambda: [dataset[i] for i in range(n)], n)
+
+        batch_dataset = _open_dataset(file_path, args, batched=True)
+        batches = list(BlockShuffleBatchSampler(len(batch_dataset), args.batch_size))
+        n_batched = sum(len(b) for b in batches)
+        # the batches cover the whole file, so this is the read time of an epoch
+        start = time.perf_counter()
+        for batch in batches:
+            batch_dataset.__getitems__(batch)
+        epoch_time = time.perf_counter() - start
+        print('{:<40} {:>10} {:>10.2f} {:>16.0f} {:>18.0f} {:>18.0f} {:>12.2f}'.format(
+            file_path, n_batched, os.path.getsize(file_path) / 2 ** 20, random_rows, sequential_rows,
+            n_batched / epoch_time, epoch_time))
+
+
+def _synthetic_batches(args, rng):
+    """Sample padded train batches (query, doc) with log-normally distributed document lengths."""
+    n = args.num_batches * args.batch_size
+    doc_lens = np.clip(rng.lognormal(np.log(args.median_d_len), 0.5, size=n), 1, args.max_d_len).astype(np.int64)
+    query_lens = rng.integers(1, args.max_q_len + 1, size=n)
+    queries = rng.integers(1, args.vocab_size, size=(n, args.max_q_len))
+    queries *= np.arange(args.max_q_len) < query_lens[:, None]
+    docs = rng.integers(1, args.vocab_size, size=(n, args.max_d_len))
+    docs *= np.arange(args.max_d_len) < doc_lens[:, None]
+    return torch.from_numpy(queries), torch.from_numpy(docs), doc_lens
+
+
+def _train_throughput(model, batches, device):
+    """Samples per second of forward and backward passes over the batches."""
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+    n = 0
+    start = time.perf_counter()
+    for query, doc in batches:
+        optimizer.zero_grad()
+        model(query.to(device), doc.to(device)).sum().backward()
+        optimizer.step()
+        n += len(query)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return n / (time.perf_counter() - start)
+
+
+def bench_model(args):
+    rng = np.random.default_rng(0)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    queries, docs, doc_lens = _synthetic_batches(args, rng)
+    id_to_word = {i: str(i) for i in range(args.vocab_size)}
+    idfs = rng.uniform(0, 10, size=args.vocab_size).astype(np.float32)
+
+    def model(length_adaptive):
+        # random embeddings, the throughput doesn't depend on GloVe
+        return DuetV2(id_to_word, None, None, args.glove_dim, args.h_dim, args.max_q_len, args.max_d_len, 0.5,
+                      idfs=idfs, length_adaptive=length_adaptive).to(device)
+
+    padded = [(queries[i:i + args.batch_size], docs[i:i + args.batch_size])
+              for i in range(0, len(queries), args.batch_size)]
+    bucketed = []
+    for batch in LengthBucketBatchSampler(doc_lens, args.batch_size):
+        q_ids = torch.zeros(len(batch))
+        _, (query, doc), _ = collate_trimmed((q_ids, [queries[batch], docs[batch]], q_ids))
+        bucketed.append((query, doc))
+
+    padded_tokens = sum(doc.numel() for _, doc in padded)
+    bucketed_tokens = sum(doc.numel() for _, doc in bucketed)
+    print('device: {}, mean document length: {:.1f}, padded document tokens: {:.1%} (bucketed)'.format(
+        device, doc_lens.mean(), bucketed_tokens / padded_tokens))
+
+    results = {}
+    for name, length_adaptive, batches in [('fixed shape', False, padded), ('length adaptive', True, bucketed)]:
+        m = model(length_adaptive)
+        # warm up, e.g. for cudnn autotuning
+        _train_throughput(m, batches[:2], device)
+        results[name] = _train_throughput(m, batches, device)
+    for name, sps in results.items():
+        print('{:<24} {:>12.0f} samples/sec'.format(name, sps))
+
+
+def bench_embedding_dim(args):
+    rng = np.random.default_rng(0)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    queries, docs, _ = _synthetic_batches(args, rng)
+    id_to_word = {i: str(i) for i in range(args.vocab_size)}
+    idfs = rng.uniform(0, 10, size=args.vocab_size).astype(np.float32)
+    batches = [(queries[i:i + args.batch_size], docs[i:i + args.batch_size])
+               for i in range(0, len(queries), args.batch_size)]
+
+    def score(model):
+        model.eval()
+        with torch.no_grad():
+            for query, doc in batches:
+                model(query.to(device), doc.to(device))
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    print('device: {}, synthetic batches'.format(device))
+    print('{:>8} {:>18} {:>22} {:>22}'.format('dim', 'embedding params', 'train samples/sec', 'score samples/sec'))
+    for dim in args.dims:
+        # random embeddings of the reduced dimension, the throughput doesn't depend on GloVe
+        model = DuetV2(id_to_word, None, None, args.glove_dim, args.h_dim, args.max_q_len, args.max_d_len, 0.5,
+                       idfs=idfs, pca_dim=dim).to(device)
+        _train_throughput(model, batches[:2], device)
+        train_sps = _train_throughput(model, batches, device)
+        score_sps = _samples_per_sec(lambda: score(model), len(queries))
+        print('{:>8} {:>18} {:>22.0f} {:>22.0f}'.format(
+            dim, model.distributed_model.glove.embedding.weight.numel(), train_sps, score_sps))
+
+    if args.dev_data is not None:
+        # one training run per dimension (train.py --pca_dim), scored with its last checkpoint
+        print('dev set {}'.format(args.dev_data))
+        print('{:>8} {:>10}  {}'.format('dim', 'MRR@{}'.format(args.mrr_k), 'checkpoint'))
+        for working_dir in args.working_dirs:
+            train_args = read_args(working_dir)
+            dev_dl, idfs = _dev_loader(args.dev_data, train_args, args.batch_size)
+            ckpt = os.path.join(working_dir, 'ckpt', sorted(os.listdir(os.path.join(working_dir, 'ckpt')))[-1])
+            model = model_from_train_args(train_args, idfs, freeze_embeddings=True)
+            model.load_state_dict(torch.load(ckpt, map_location='cpu')['state_dict'])
+            q_ids, scores, labels = _score_dev_set(model, dev_dl, device)
+            dim = train_args.get('pca_dim') or train_args['glove_dim']
+            print('{:>8} {:>10.4f}  {}'.format(dim, _mrr(q_ids, scores, labels, args.mrr_k), ckpt))
+
+
+def _tensor_bytes(t):
+    if t.is_sparse:
+        return _tensor_bytes(t._indices()) + _tensor_bytes(t._values())
+    return t.numel() * t.element_size()
+
+
+def _optimizer_bytes(optimizer):
+    """The size of the optimizer state and the gradients of its parameters."""
+    optimizers = optimizer.optimizers if isinstance(optimizer, SplitOptimizer) else [optimizer]
+    state_bytes, grad_bytes = 0, 0
+    for o in optimizers:
+        for p, state in o.state.items():
+            state_bytes += sum(_tensor_bytes(v) for v in state.values() if torch.is_tensor(v))
+        for group in o.param_groups:
+            grad_bytes += sum(_tensor_bytes(p.grad) for p in group['params'] if p.grad is not None)
+    return state_bytes, grad_bytes
+
+
+def bench_embedding_optimizer(args):
+    rng = np.random.default_rng(0)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    queries, docs, _ = _synthetic_batches(args, rng)
+    id_to_word = {i: str(i) for i in range(args.vocab_size)}
+    idfs = rng.uniform(0, 10, size=args.vocab_size).astype(np.float32)
+    batches = [(queries[i:i + args.batch_size].to(device), docs[i:i + args.batch_size].to(device))
+               for i in range(0, len(queries), args.batch_size)]
+    print('device: {}, vocabulary: {}, distinct tokens per batch: {:.0f}'.format(
+        device, args.vocab_size, np.mean([len(torch.unique(torch.cat([q.flatten(), d.flatten()])))
+                                          for q, d in batches])))
+
+    print('{:<24} {:>16} {:>22} {:>18}'.format('embeddings', 'step time (ms)', 'optimizer state (MB)',
+                                               'gradients (MB)'))
+    for name, sparse, freeze in [('dense', False, False), ('sparse', True, False), ('frozen', False, True)]:
+        # random embeddings, the step time doesn't depend on GloVe
+        model = DuetV2(id_to_word, None, None, args.glove_dim, args.h_dim, args.max_q_len, args.max_d_len, 0.5,
+                       idfs=idfs, sparse_embeddings=sparse, freeze_embeddings=freeze).to(device).train()
+        optimizer = build_optimizer(model, 1e-3)
+
+        def step(query, doc):
+            optimizer.zero_grad()
+            model(query, doc).sum().backward()
+            optimizer.step()
+
+        # the first step allocates the optimizer state
+        step(*batches[0])
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for query, doc in batches:
+            step(query, doc)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        step_time = (time.perf_counter() - start) / len(batches)
+        state_bytes, grad_bytes = _optimizer_bytes(optimizer)
+        print('{:<24} {:>16.1f} {:>22.1f} {:>18.1f}'.format(name, step_time * 1000, state_bytes / 2 ** 20,
+                                                            grad_bytes / 2 ** 20))
+
+
+def _order_agreement(a, b, rng, num_pairs=100000):
+    """The share of random pairs of samples that two sets of scores put in the same order."""
+    i, j = rng.integers(len(a), size=(2, num_pairs))
+    differ = a[i] != a[j]
+    return float(np.mean(np.sign(a[i] - a[j])[differ] == np.sign(b[i] - b[j])[differ]))
+
+
+def _mrr(q_ids, scores, labels, k):
+    """MRR@k of candidates grouped by query id."""
+    reciprocal_ranks = []
+    for q_id in np.unique(q_ids):
+        group = q_ids == q_id
+        ranked = labels[group][np.argsort(-scores[group], kind='stable')][:k]
+        hits = np.flatnonzero(ranked > 0)
+        reciprocal_ranks.append(1 / (hits[0] + 1) if len(hits) > 0 else 0)
+    return float(np.mean(reciprocal_ranks))
+
+
+def _dev_loader(dev_data, train_args, batch_size):
+    """A dataloader of a dev set in the input format of a trained model, see evaluate.py."""
+    imat_in_model = train_args.get('imat_in_model') == 'True'
+    sparse_imat = train_args.get('sparse_imat') == 'True'
+    idfs = load_idfs(train_args['IDF_FILE'])
+    dev_set = DuetHdf5Testset(dev_data, int(train_args['max_q_len']), int(train_args['max_d_len']), idfs,
+                              build_imat=not imat_in_model, sparse_imat=sparse_imat)
+    return DataLoader(dev_set, batch_size=batch_size, collate_fn=collate_sparse if sparse_imat else None), idfs
+
+
+def _score_dev_set(model, dev_dl, device):
+    """The query ids, scores and labels of all candidates of a dev set."""
+    model.to(device).eval()
+    q_ids, scores, labels = [], [], []
+    with torch.no_grad():
+        for b_q_ids, inputs, b_labels in dev_dl:
+            scores.append(model(*[x.to(device) for x in inputs]).cpu().numpy()[:, 0])
+            q_ids.append(b_q_ids.numpy())
+            labels.append(b_labels.numpy())
+    return np.concatenate(q_ids), np.concatenate(scores), np.concatenate(labels)
+
+
+def _dev_set_scores(args, device):
+    """Score a dev set with a trained model in both precisions."""
+    train_args = read_args(args.working_dir)
+    dev_dl, idfs = _dev_loader(args.dev_data, train_args, args.batch_size)
+    state_dict = torch.load(args.ckpt, map_location='cpu')['state_dict']
+
+    results = {}
+    for precision in ('fp32', 'bf16'):
+        model = model_from_train_args(train_args, idfs, freeze_embeddings=True, precision=precision)
+        model.load_state_dict(state_dict)
+        start = time.perf_counter()
+        q_ids, scores, labels = _score_dev_set(model, dev_dl, device)
+        results[precision] = (scores, len(q_ids) / (time.perf_counter() - start))
+    return q_ids, labels, results
+
+
+def bench_precision(args):
+    rng = np.random.default_rng(0)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    queries, docs, _ = _synthetic_batches(args, rng)
+    id_to_word = {i: str(i) for i in range(args.vocab_size)}
+    idfs = rng.uniform(0, 10, size=args.vocab_size).astype(np.float32)
+    idf_array = idfs_to_array(dict(enumerate(idfs)))
+    batches = []
+    for i in range(0, len(queries), args.batch_size):
+        query, doc = queries[i:i + args.batch_size], docs[i:i + args.batch_size]
+        imat = torch.from_numpy(build_interaction_matrices(query.numpy(), doc.numpy(), idf_array))
+        batches.append((query.to(device), doc.to(device), imat.to(device)))
+
+    torch.manual_seed(int(rng.integers(2 ** 31)))
+    state_dict = None
+    scores = {}
+    print('device: {}, synthetic batches'.format(device))
+    print('{:<28} {:>22} {:>22}'.format('mode', 'train samples/sec', 'score samples/sec'))
+    for name, precision, bf16_imat, bf16_embeddings in [('fp32', 'fp32', False, False), ('bf16', 'bf16', False, False),
+                                                        ('bf16 + bf16 storage', 'bf16', True, True)]:
+        # random embeddings, frozen so that they can be stored in bf16 in the last mode
+        model = DuetV2(id_to_word, None, None, args.glove_dim, args.h_dim, args.max_q_len, args.max_d_len, 0.5,
+                       freeze_embeddings=True, precision=precision, bf16_embeddings=bf16_embeddings).to(device)
+        if state_dict is None:
+            # copied, training changes the weights in place
+            state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+            # most scores of random weights are cut off by the last relu
+            state_dict['linear_out.bias'] += 1
+        model.load_state_dict(state_dict)
+        inputs = [(q, d, m.to(torch.bfloat16) if bf16_imat else m) for q, d, m in batches]
+
+        # the loss and the optimizer run in fp32 on the fp32 scores
+        optimizer = build_optimizer(model, 1e-3)
+
+        def train(batches):
+            model.train()
+            for q, d, m in batches:
+                optimizer.zero_grad()
+                model(q, d, m).sum().backward()
+                optimizer.step()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+
+        def score():
+            model.eval()
+            with torch.no_grad():
+                out = torch.cat([model(q, d, m) for q, d, m in inputs])
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            return out
+
+        # score before training changes the weights, this also warms up the scoring
+        scores[name] = score().cpu().numpy()[:, 0]
+        score_sps = _samples_per_sec(score, len(queries))
+        # warm up, e.g. the allocation of the optimizer state and the autograd kernels of each precision
+        train(inputs[:2])
+        train_sps = _samples_per_sec(lambda: train(inputs), len(queries))
+        print('{:<28} {:>22.0f} {:>22.0f}'.format(name, train_sps, score_sps))
+    for name in ('bf16', 'bf16 + bf16 storage'):
+        print('{}: max score difference to fp32: {:.2e}, pairs in the same order: {:.2%}'.format(
+            name, np.abs(scores[name] - scores['fp32']).max(), _order_agreement(scores['fp32'], scores[name], rng)))
+
+    if args.dev_data is not None:
+        q_ids, labels, results = _dev_set_scores(args, device)
+        print('dev set {} ({} candidates)'.format(args.dev_data, len(q_ids)))
+        for precision, (dev_scores, sps) in results.items():
+            print('{:<8} MRR@{}: {:.4f}, {:.0f} samples/sec'.format(precision, args.mrr_k,
+                                                                    _mrr(q_ids, dev_scores, labels, args.mrr_k), sps))
+        print('pairs in the same order: {:.2%}'.format(
+            _order_agreement(results['fp32'][0], results['bf16'][0], rng)))
+
+
+def bench_doc_features(args):
+    rng = np.random.default_rng(0)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    queries, docs, _ = _synthetic_batches(args, rng)
+    id_to_word = {i: str(i) for i in range(args.vocab_size)}
+    idfs = rng.uniform(0, 10, size=args.vocab_size).astype(np.float32)
+    model = DuetV2(id_to_word, None, None, args.glove_dim, args.h_dim, args.max_q_len, args.max_d_len, 0.5,
+                   idfs=idfs).to(device).eval()
+    batches = [(queries[i:i + args.batch_size].to(device), docs[i:i + args.batch_size].to(device))
+               for i in range(0, len(queries), args.batch_size)]
+
+    with torch.no_grad():
+        features = [model.encode_docs(doc) for _, doc in batches]
+        for (query, doc), doc_features in zip(batches, features):
+            assert torch.allclose(model(query, doc), model(query, doc, doc_features=doc_features), atol=1e-6), \
+                'cached document features give different scores'
+
+        def score(cached):
+            for (query, doc), doc_features in zip(batches, features):
+                model(query, doc, doc_features=doc_features if cached else None)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+
+        n = len(queries)
+        results = {'full model': _samples_per_sec(lambda: score(False), n),
+                   'cached doc features': _samples_per_sec(lambda: score(True), n)}
+    print('device: {}, document features: {:.1f} KB per document (float32)'.format(
+        device, features[0][0].numel() * 4 / 2 ** 10))
+    for name, sps in results.items():
+        print('{:<24} {:>12.0f} samples/sec'.format(name, sps))
+
+
+def bench_local(args):
+    rng = np.random.default_rng(0)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    pairs, idfs = _synthetic_pairs(args.num_samples, args.vocab_size, args.max_q_len, args.max_d_len)
+    idf_array = idfs_to_array(idfs)
+    queries = np.stack([_pad_to(q, args.max_q_len) for q, _ in pairs])
+    docs = np.stack([_pad_to(d, args.max_d_len) for _, d in pairs])
+    dense = [torch.from_numpy(build_interaction_matrices(queries[i:i + args.batch_size], docs[i:i + args.batch_size],
+                                                         idf_array)).to(device)
+             for i in range(0, len(pairs), args.batch_size)]
+    sparse = [torch.from_numpy(sparse_interaction_matrices(queries[i:i + args.batch_size],
+                                                           docs[i:i + args.batch_size], idf_array)).to(device)
+              for i in range(0, len(pairs), args.batch_size)]
+    dense_bytes = sum(m.numel() * m.element_size() for m in dense)
+    sparse_bytes = sum(m.numel() * m.element_size() for m in sparse)
+    print('device: {}, nonzeros: {:.2%}, sparse / dense size: {:.2%}'.format(
+        device, sum(int((m != 0).sum()) for m in dense) / sum(m.numel() for m in dense), sparse_bytes / dense_bytes))
+
+    torch.manual_seed(int(rng.integers(2 ** 31)))
+    model = DuetV2Local(args.h_dim, args.max_q_len, args.max_d_len, 0.5).to(device).eval()
+    sparse_model = DuetV2Local(args.h_dim, args.max_q_len, args.max_d_len, 0.5, sparse_imat=True).to(device).eval()
+    sparse_model.load_state_dict(model.state_dict())
+
+    with torch.no_grad():
+        for d, s in zip(dense, sparse):
+            assert torch.allclose(model(d), sparse_model(s), atol=1e-5), 'sparse local model differs from the dense one'
+
+        def run(m, batches):
+            for batch in batches:
+                m(batch)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+
+        results = {'dense conv1d': _samples_per_sec(lambda: run(model, dense), len(pairs)),
+                   'sparse matmul': _samples_per_sec(lambda: run(sparse_model, sparse), len(pairs))}
+    for name, sps in results.items():
+        print('{:<24} {:>12.0f} samples/sec'.format(name, sps))
+
+
+def bench_zero_overlap(args):
+    rng = np.random.default_rng(0)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    pairs, idfs = _synthetic_pairs(args.num_samples, args.vocab_size, args.max_q_len, args.max_d_len)
+    # shift the tokens of a share of the documents out of the query vocabulary
+    idf_array = np.tile(idfs_to_array(idfs), 2)
+    no_overlap = rng.random(len(pairs)) < args.zero_overlap
+    queries = np.stack([_pad_to(q, args.max_q_len) for q, _ in pairs])
+    docs = np.stack([_pad_to(d + args.vocab_size * shift, args.max_d_len) for (_, d), shift in zip(pairs, no_overlap)])
+
+    torch.manual_seed(int(rng.integers(2 ** 31)))
+    for sparse_imat, build in ((False, build_interaction_matrices), (True, sparse_interaction_matrices)):
+        batches = [torch.from_numpy(build(queries[i:i + args.batch_size], docs[i:i + args.batch_size],
+                                          idf_array)).to(device)
+                   for i in range(0, len(pairs), args.batch_size)]
+        model = DuetV2Local(args.h_dim, args.max_q_len, args.max_d_len, 0.5, sparse_imat=sparse_imat).to(device).eval()
+
+        def run(shortcut):
+            model.zero_overlap_shortcut = shortcut
+            out = [model(batch) for batch in batches]
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            return out
+
+        with torch.no_grad():
+            max_diff = 0.0
+            for step in range(2):
+                for a, b in zip(run(False), run(True)):
+                    # the matmuls may round differently for the smaller batch of rows with matches
+                    assert torch.allclose(a, b, atol=1e-6), 'the zero overlap shortcut changes the output'
+                    max_diff = max(max_diff, float((a - b).abs().max()))
+                # the cached output has to follow parameter updates
+                model.linear_1.bias.add_(0.1)
+            model.shortcut_rows = 0
+            results = {'full': _samples_per_sec(lambda: run(False), len(pairs)),
+                       'zero overlap shortcut': _samples_per_sec(lambda: run(True), len(pairs))}
+        print('device: {}, {} interaction matrices, shortcut rows: {} / {}, max difference: {:.2e}'.format(
+            device, 'sparse' if sparse_imat else 'dense', model.shortcut_rows, len(pairs), max_diff))
+        for name, sps in results.items():
+            print('{:<24} {:>12.0f} samples/sec'.format(name, sps))
+
+
+def main():
+    ap = ArgumentParser(description='Microbenchmarks for the DUET input pipeline and model.')
+    subparsers = ap.add_subparsers(dest='benchmark', required=True)
+
+    imat_ap = subparsers.add_parser('imat', help='Interaction matrix builders (python loop vs. numpy).')
+    imat_ap.add_argument('--num_samples', type=int, default=2000, help='Number of query-document pairs.')
+    imat_ap.add_argument('--vocab_size', type=int, default=80000, help='Vocabulary size.')
+    imat_ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
+    imat_ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document length.')
+    imat_ap.add_argument('--batch_size', type=int, default=1024, help='Batch size of the batched builder.')
+    imat_ap.set_defaults(func=bench_imat)
+
+    matches_ap = subparsers.add_parser('matches', help='Disk cost vs. CPU saved by precomputed match coordinates.')
+    matches_ap.add_argument('HDF5_FILE', help='A file generated with --save_matches.')
+    matches_ap.add_argument('IDF_FILE', help='File containing the idfs, either idfs.npy or the pickled idfs.pkl.')
+    matches_ap.add_argument('--num_samples', type=int, default=10000, help='Number of rows to time.')
+    matches_ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
+    matches_ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document length.')
+    matches_ap.set_defaults(func=bench_matches)
+
+    layout_ap = subparsers.add_parser('layout', help='File size, read throughput and epoch read time of hdf5 files.')
+    layout_ap.add_argument('HDF5_FILES', nargs='+', help='The files to compare, e.g. in layout versions 1 and 2.')
+    layout_ap.add_argument('--num_samples', type=int, default=10000, help='Number of rows to read.')
+    layout_ap.add_argument('--batch_size', type=int, default=1024, help='Batch size of the batched reads.')
+    layout_ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
+    layout_ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document length.')
+    layout_ap.set_defaults(func=bench_layout)
+
+    model_ap = subparsers.add_parser('model', help='Train step throughput of the fixed shape and the length adaptive '
+                                                   'model on synthetic batches.')
+    model_ap.add_argument('--num_batches', type=int, default=20, help='Number of batches.')
+    model_ap.add_argument('--batch_size', type=int, default=256, help='Batch size.')
+    model_ap.add_argument('--vocab_size', type=int, default=10000, help='Vocabulary size.')
+    model_ap.add_argument('--median_d_len', type=float, default=60, help='Median document length.')
+    model_ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
+    model_ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document length.')
+    model_ap.add_argument('--glove_dim', type=int, default=300, help='Embedding dimension.')
+    model_ap.add_argument('--h_dim', type=int, default=300, help='Hidden dimension.')
+    model_ap.set_defaults(func=bench_model)
+
+    local_ap = subparsers.add_parser('local', help='Dense vs. sparse local model on synthetic interaction matrices.')
+    local_ap.add_argument('--num_samples', type=int, default=8192, help='Number of query-document pairs.')
+    local_ap.add_argument('--vocab_size', type=int, default=80000, help='Vocabulary size.')
+    local_ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
+    local_ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document length.')
+    local_ap.add_argument('--batch_size', type=int, default=1024, help='Batch size.')
+    local_ap.add_argument('--h_dim', type=int, default=300, help='Hidden dimension.')
+    local_ap.set_defaults(func=bench_local)
+
+    features_ap = subparsers.add_parser('doc_features', help='Scoring throughput with and without precomputed document '
+                                                             'features on synthetic batches.')
+    features_ap.add_argument('--num_batches', type=int, default=20, help='Number of batches.')
+    features_ap.add_argument('--batch_size', type=int, default=256, help='Batch size.')
+    features_ap.add_argument('--vocab_size', type=int, default=10000, help='Vocabulary size.')
+    features_ap.add_argument('--median_d_len', type=float, default=60, help='Median document length.')
+    features_ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
+    features_ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document length.')
+    features_ap.add_argument('--glove_dim', type=int, default=300, help='Embedding dimension.')
+    features_ap.add_argument('--h_dim', type=int, default=300, help='Hidden dimension.')
+    features_ap.set_defaults(func=bench_doc_features)
+
+    dim_ap = subparsers.add_parser('embedding_dim', help='Throughput of the model for reduced embedding dimensions '
+                                                         '(see --pca_dim) on synthetic batches and optionally the MRR '
+                                                         'of trained models on a dev set.')
+    dim_ap.add_argument('--dims', type=int, nargs='+', default=[300, 128, 64], help='Embedding dimensions.')
+    dim_ap.add_argument('--num_batches', type=int, default=20, help='Number of batches.')
+    dim_ap.add_argument('--batch_size', type=int, default=256, help='Batch size.')
+    dim_ap.add_argument('--vocab_size', type=int, default=10000, help='Vocabulary size.')
+    dim_ap.add_argument('--median_d_len', type=float, default=60, help='Median document length.')
+    dim_ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
+    dim_ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document length.')
+    dim_ap.add_argument('--glove_dim', type=int, default=300, help='Dimension of the GloVe vectors.')
+    dim_ap.add_argument('--h_dim', type=int, default=300, help='Hidden dimension.')
+    dim_ap.add_argument('--dev_data', help='A dev set hdf5 file to compute the MRR on, requires --working_dirs.')
+    dim_ap.add_argument('--working_dirs', nargs='+', default=[],
+                        help='Working directories of models trained with different --pca_dim, the last checkpoint of '
+                             'each is scored.')
+    dim_ap.add_argument('--mrr_k', type=int, default=10, help='Compute MRR@k on the dev set.')
+    dim_ap.set_defaults(func=bench_embedding_dim)
+
+    optimizer_ap = subparsers.add_parser('embedding_optimizer', help='Step time and optimizer memory with dense, '
+                                                                     'sparse and frozen embeddings.')
+    optimizer_ap.add_argument('--num_batches', type=int, default=10, help='Number of batches.')
+    optimizer_ap.add_argument('--batch_size', type=int, default=256, help='Batch size.')
+    optimizer_ap.add_argument('--vocab_size', type=int, default=80000, help='Vocabulary size.')
+    optimizer_ap.add_argument('--median_d_len', type=float, default=60, help='Median document length.')
+    optimizer_ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
+    optimizer_ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document length.')
+    optimizer_ap.add_argument('--glove_dim', type=int, default=300, help='Embedding dimension.')
+    optimizer_ap.add_argument('--h_dim', type=int, default=300, help='Hidden dimension.')
+    optimizer_ap.set_defaults(func=bench_embedding_optimizer)
+
+    precision_ap = subparsers.add_parser('precision', help='Throughput and score differences of fp32 and bf16 on '
+                                                           'synthetic batches and optionally a dev set.')
+    precision_ap.add_argument('--num_batches', type=int, default=10, help='Number of synthetic batches.')
+    precision_ap.add_argument('--batch_size', type=int, default=256, help='Batch size.')
+    precision_ap.add_argument('--vocab_size', type=int, default=10000, help='Vocabulary size.')
+    precision_ap.add_argument('--median_d_len', type=float, default=60, help='Median document length.')
+    precision_ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
+    precision_ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document length.')
+    precision_ap.add_argument('--glove_dim', type=int, default=300, help='Embedding dimension.')
+    precision_ap.add_argument('--h_dim', type=int, default=300, help='Hidden dimension.')
+    precision_ap.add_argument('--dev_data', help='A dev set hdf5 file to compare the MRR on, requires --working_dir '
+                                                 'and --ckpt.')
+    precision_ap.add_argument('--working_dir', help='Working directory of the trained model containing args.csv.')
+    precision_ap.add_argument('--ckpt', help='The checkpoint of the trained model.')
+    precision_ap.add_argument('--mrr_k', type=int, default=10, help='Compute MRR@k on the dev set.')
+    precision_ap.set_defaults(func=bench_precision)
+
+    zero_ap = subparsers.add_parser('zero_overlap', help='Local model with and without the shortcut for documents '
+                                                         'that share no token with the query.')
+    zero_ap.add_argument('--num_samples', type=int, default=8192, help='Number of query-document pairs.')
+    zero_ap.add_argument('--zero_overlap', type=float, default=0.5, help='Share of documents without overlap.')
+    zero_ap.add_argument('--vocab_size', type=int, default=80000, help='Vocabulary size.')
+    zero_ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
+    zero_ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document length.')
+    zero_ap.add_argument('--batch_size', type=int, default=1024, help='Batch size.')
+    zero_ap.add_argument('--h_dim', type=int, default=300, help='Hidden dimension.')
+    zero_ap.set_defaults(func=bench_zero_overlap)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
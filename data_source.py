@@ -1,51 +1,970 @@
+import os
+import queue
+import threading
+import time
+
 import h5pickle as h5py
 import numpy as np
+import torch
 from torch.utils import data
 
+from qa_utils.io import load_pkl_file
+
+
+def idfs_to_array(idfs):
+    """Convert a mapping from integer ids to idfs into a dense float32 array indexed by id. Ids without an idf get 0.
+    """
+    idf_array = np.zeros(max(idfs) + 1, dtype=np.float32)
+    idf_array[list(idfs.keys())] = list(idfs.values())
+    return idf_array
+
+
+def load_idfs(file_path):
+    """Load the idfs written by DuetHhdf5Saver as a dense float32 array indexed by token id.
+
+    Args:
+        file_path: either a .npy file, which is memory-mapped so that all dataloader workers share the same pages, or
+        a pickled id to idf dictionary (older artifacts).
+
+    Returns:
+        np.ndarray: the idfs.
+    """
+    if file_path.endswith('.npy'):
+        return np.load(file_path, mmap_mode='r')
+    return idfs_to_array(load_pkl_file(file_path))
+
+
+def _lookup_idfs(idfs, ids):
+    """Look up the idf of every id in an integer array, ids without an idf get 0."""
+    ids = np.asarray(ids)
+    if isinstance(idfs, np.ndarray):
+        return idfs[ids]
+    values = np.fromiter((idfs.get(i, 0.0) for i in ids.ravel().tolist()), dtype=np.float64, count=ids.size)
+    return values.reshape(ids.shape)
+
+
+def build_interaction_matrix(query, doc, idfs, max_query_len, max_doc_len):
+    """Build the idf weighted exact match interaction matrix of a single query-document pair.
+
+    Args:
+        query: the (unpadded) integer ids of the query.
+        doc: the (unpadded) integer ids of the document.
+        idfs: an array of idfs indexed by integer id, or a mapping from integer ids to idfs.
+        max_query_len: number of columns of the matrix.
+        max_doc_len: number of rows of the matrix.
+
+    Returns:
+        np.ndarray: a (max_doc_len x max_query_len) float32 matrix where m[j, i] = idf(query[i]) if
+        query[i] == doc[j] and 0 otherwise.
+    """
+    query = np.asarray(query)[:max_query_len]
+    doc = np.asarray(doc)[:max_doc_len]
+    m = np.zeros(shape=(max_doc_len, max_query_len), dtype=np.float32)
+    matches = np.equal.outer(doc, query)
+    m[:len(doc), :len(query)] = np.where(matches, _lookup_idfs(idfs, query), 0)
+    return m
+
+
+def build_interaction_matrices(queries, docs, idfs):
+    """Build the interaction matrices of a whole batch of padded query-document pairs at once. Padding (id 0) never
+    matches.
+
+    Args:
+        queries: a (batch_size x max_query_len) array of zero padded query ids.
+        docs: a (batch_size x max_doc_len) array of zero padded document ids.
+        idfs: an array of idfs indexed by integer id, or a mapping from integer ids to idfs.
+
+    Returns:
+        np.ndarray: a (batch_size x max_doc_len x max_query_len) float32 array.
+    """
+    queries = np.asarray(queries)
+    docs = np.asarray(docs)
+    matches = (docs[:, :, np.newaxis] == queries[:, np.newaxis, :]) & (queries[:, np.newaxis, :] != 0)
+    query_idfs = _lookup_idfs(idfs, queries).astype(np.float32)
+    return np.where(matches, query_idfs[:, np.newaxis, :], np.float32(0))
+
+
+def interaction_matrix_from_matches(query, matches, idfs, max_query_len, max_doc_len):
+    """Build the interaction matrix of a single query-document pair from precomputed match coordinates (see
+    DuetHhdf5Saver). Gives the same matrix as build_interaction_matrix.
+
+    Args:
+        query: the (unpadded) integer ids of the query.
+        matches: the flattened (doc_pos, query_pos) pairs of all exact matches.
+        idfs: an array of idfs indexed by integer id, or a mapping from integer ids to idfs.
+        max_query_len: number of columns of the matrix.
+        max_doc_len: number of rows of the matrix.
+
+    Returns:
+        np.ndarray: a (max_doc_len x max_query_len) float32 matrix.
+    """
+    coords = np.asarray(matches, dtype=np.int64).reshape(-1, 2)
+    coords = coords[(coords[:, 0] < max_doc_len) & (coords[:, 1] < max_query_len)]
+    m = np.zeros(shape=(max_doc_len, max_query_len), dtype=np.float32)
+    m[coords[:, 0], coords[:, 1]] = _lookup_idfs(idfs, np.asarray(query)[coords[:, 1]])
+    return m
+
+
+def interaction_matrices_from_matches(queries, matches, idfs, max_doc_len):
+    """Build the interaction matrices of a whole batch from precomputed match coordinates with a single scatter.
+
+    Args:
+        queries: a (batch_size x max_query_len) array of zero padded query ids.
+        matches: for each row, the flattened (doc_pos, query_pos) pairs of all exact matches.
+        idfs: an array of idfs indexed by integer id, or a mapping from integer ids to idfs.
+        max_doc_len: number of rows of the matrices.
+
+    Returns:
+        np.ndarray: a (batch_size x max_doc_len x max_query_len) float32 array.
+    """
+    queries = np.asarray(queries)
+    coords = [np.asarray(m, dtype=np.int64).reshape(-1, 2) for m in matches]
+    rows = np.repeat(np.arange(len(coords)), [len(c) for c in coords])
+    coords = np.concatenate(coords + [np.zeros((0, 2), dtype=np.int64)])
+    keep = (coords[:, 0] < max_doc_len) & (coords[:, 1] < queries.shape[1])
+    rows, coords = rows[keep], coords[keep]
+    m = np.zeros(shape=(len(queries), max_doc_len, queries.shape[1]), dtype=np.float32)
+    m[rows, coords[:, 0], coords[:, 1]] = _lookup_idfs(idfs, queries[rows, coords[:, 1]])
+    return m
+
+
+def _pad_match_lists(rows, coords, values, batch_size):
+    # coords and values are sorted by row, each row gets as many entries as the row with the most matches
+    counts = np.bincount(rows, minlength=batch_size)
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    m = np.zeros(shape=(batch_size, max(1, counts.max(initial=0)), 3), dtype=np.float32)
+    positions = np.arange(len(rows)) - offsets[rows]
+    m[rows, positions, :2] = coords
+    m[rows, positions, 2] = values
+    return m
+
+
+def sparse_interaction_matrices(queries, docs, idfs):
+    """Build the interaction matrices of a batch of padded query-document pairs in sparse form: for each pair, the
+    (doc_pos, query_pos, idf) of every exact match. Padding (id 0) never matches.
+
+    Args:
+        queries: a (batch_size x max_query_len) array of zero padded query ids.
+        docs: a (batch_size x max_doc_len) array of zero padded document ids.
+        idfs: an array of idfs indexed by integer id, or a mapping from integer ids to idfs.
+
+    Returns:
+        np.ndarray: a (batch_size x max_matches x 3) float32 array, rows of pairs with fewer matches are padded with
+        zeros (which the model ignores, see duetv2_model.DuetV2Local).
+    """
+    queries = np.asarray(queries)
+    docs = np.asarray(docs)
+    matches = (docs[:, :, np.newaxis] == queries[:, np.newaxis, :]) & (queries[:, np.newaxis, :] != 0)
+    rows, doc_pos, query_pos = np.nonzero(matches)
+    values = _lookup_idfs(idfs, queries[rows, query_pos])
+    return _pad_match_lists(rows, np.stack([doc_pos, query_pos], axis=1), values, len(queries))
+
+
+def sparse_interaction_matrices_from_matches(queries, matches, idfs, max_doc_len):
+    """Build the interaction matrices of a batch in sparse form (see sparse_interaction_matrices) from precomputed
+    match coordinates.
+
+    Args:
+        queries: a (batch_size x max_query_len) array of zero padded query ids.
+        matches: for each row, the flattened (doc_pos, query_pos) pairs of all exact matches.
+        idfs: an array of idfs indexed by integer id, or a mapping from integer ids to idfs.
+        max_doc_len: ignore matches beyond this document position.
+
+    Returns:
+        np.ndarray: a (batch_size x max_matches x 3) float32 array.
+    """
+    queries = np.asarray(queries)
+    coords = [np.asarray(m, dtype=np.int64).reshape(-1, 2) for m in matches]
+    rows = np.repeat(np.arange(len(coords)), [len(c) for c in coords])
+    coords = np.concatenate(coords + [np.zeros((0, 2), dtype=np.int64)])
+    keep = (coords[:, 0] < max_doc_len) & (coords[:, 1] < queries.shape[1])
+    rows, coords = rows[keep], coords[keep]
+    values = _lookup_idfs(idfs, queries[rows, coords[:, 1]])
+    return _pad_match_lists(rows, coords, values, len(queries))
+
+
+def collate_batch(batch):
+    """Collate function for datasets that return whole batches from __getitems__, e.g. DuetHdf5BatchTrainset."""
+    return batch
+
+
+def _collate_sparse_inputs(inputs):
+    queries = torch.from_numpy(np.stack([np.asarray(x[0]) for x in inputs]))
+    docs = torch.from_numpy(np.stack([np.asarray(x[1]) for x in inputs]))
+    mats = [np.asarray(x[2]) for x in inputs]
+    padded = np.zeros((len(mats), max(len(m) for m in mats), 3), dtype=np.float32)
+    for i, m in enumerate(mats):
+        padded[i, :len(m)] = m
+    return [queries, docs, torch.from_numpy(padded)]
+
+
+def collate_sparse(batch):
+    """Collate function for samples with sparse interaction matrices (see sparse_interaction_matrices), which differ
+    in their number of matches. Batches with dense interaction matrices are collated as by the default collate
+    function.
+    """
+    if isinstance(batch[0][0], (tuple, list)):
+        # train samples of positive and negative inputs
+        pos_inputs, neg_inputs, labels = zip(*batch)
+        return _collate_sparse_inputs(pos_inputs), _collate_sparse_inputs(neg_inputs), torch.tensor(labels)
+    q_ids, inputs, labels = zip(*batch)
+    return torch.tensor(np.asarray(q_ids)), _collate_sparse_inputs(inputs), torch.tensor(np.asarray(labels))
+
+
+class BlockShuffleBatchSampler(data.Sampler):
+    """Yields batches of indices that are shuffled while keeping hdf5 reads mostly contiguous. The indices are split
+    into blocks of consecutive indices, the order of the blocks is shuffled and then the indices within each block.
+    """
+
+    def __init__(self, n, batch_size, block_size=None, shuffle=True, drop_last=False):
+        """Constructs the sampler.
+
+        Args:
+            n: the number of samples in the dataset.
+            batch_size: the number of indices per batch.
+            block_size: the number of consecutive indices per block. Defaults to 4 * batch_size.
+            shuffle: shuffle blocks and indices within blocks. If False, batches are consecutive.
+            drop_last: drop the last batch if it is smaller than batch_size.
+        """
+        super().__init__()
+        self.n = n
+        self.batch_size = batch_size
+        self.block_size = block_size or 4 * batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        indices = np.arange(self.n)
+        if self.shuffle:
+            # seeded from torch so that torch.manual_seed makes the order reproducible
+            rng = np.random.default_rng(int(torch.empty((), dtype=torch.int64).random_().item()))
+            blocks = [indices[i:i + self.block_size] for i in range(0, self.n, self.block_size)]
+            indices = np.concatenate([rng.permutation(blocks[i]) for i in rng.permutation(len(blocks))])
+        for i in range(len(self)):
+            yield indices[i * self.batch_size:(i + 1) * self.batch_size].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n // self.batch_size
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+
+def _used_length(tokens):
+    # rows are padded at the end and id 0 is only used for padding
+    used = torch.nonzero(tokens.any(0))
+    return int(used[-1]) + 1 if len(used) > 0 else 1
+
+
+def _trim_inputs(inputs):
+    query, doc = inputs[:2]
+    query_len, doc_len = _used_length(query), _used_length(doc)
+    trimmed = [query[:, :query_len].contiguous(), doc[:, :doc_len].contiguous()]
+    if len(inputs) > 2:
+        trimmed.append(inputs[2][:, :doc_len, :query_len].contiguous())
+    return trimmed
+
+
+def collate_trimmed(batch):
+    """Collate function like collate_batch which also removes the padding that is not needed for the longest query and
+    document of the batch (dynamic padding). Only for models that accept any input length (see DuetV2,
+    length_adaptive).
+    """
+    if isinstance(batch[0], list):
+        # train batch of positive and negative inputs
+        return _trim_inputs(batch[0]), _trim_inputs(batch[1]), batch[2]
+    q_ids, inputs, labels = batch
+    return q_ids, _trim_inputs(inputs), labels
+
+
+class LengthBucketBatchSampler(data.Sampler):
+    """Yields batches of indices of samples with similar lengths, so that little padding is needed (see
+    collate_trimmed). The indices are shuffled and split into buckets, each bucket is sorted by length and split into
+    batches and the order of the batches is shuffled.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=None, shuffle=True, drop_last=False):
+        """Constructs the sampler.
+
+        Args:
+            lengths: the length of each sample, e.g. from sample_lengths() of the dataset.
+            batch_size: the number of indices per batch.
+            bucket_size: the number of samples that are sorted together. Defaults to 100 * batch_size.
+            shuffle: shuffle the samples and the batches. If False, the samples are sorted by length.
+            drop_last: drop the last batch of each bucket if it is smaller than batch_size.
+        """
+        super().__init__()
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size or 100 * batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        n = len(self.lengths)
+        if self.shuffle:
+            # seeded from torch so that torch.manual_seed makes the order reproducible
+            rng = np.random.default_rng(int(torch.empty((), dtype=torch.int64).random_().item()))
+            indices = rng.permutation(n)
+        else:
+            indices, rng = np.arange(n), None
+        batches = []
+        for i in range(0, n, self.bucket_size):
+            bucket = indices[i:i + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[j:j + self.batch_size] for j in range(0, len(bucket), self.batch_size)
+                           if not self.drop_last or j + self.batch_size <= len(bucket))
+        if rng is not None:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        n = len(self.lengths)
+        if not self.drop_last:
+            return sum((min(self.bucket_size, n - i) + self.batch_size - 1) // self.batch_size
+                       for i in range(0, n, self.bucket_size))
+        return sum(min(self.bucket_size, n - i) // self.batch_size for i in range(0, n, self.bucket_size))
+
+
+class BatchPrefetcher(object):
+    """Wraps a dataloader and prepares the next batches in a background thread: tensors are moved to the device,
+    made contiguous and floating point tensors are cast to dtype. The time the consumer spent waiting for batches in
+    the last iteration is stored in wait_time. Other attributes (e.g. dataset) are those of the dataloader.
+    """
+
+    def __init__(self, dataloader, device, num_batches=2, dtype=None, fields=None):
+        """Constructs the prefetcher.
+
+        Args:
+            dataloader: the dataloader to wrap.
+            device: the device to move the tensors to.
+            num_batches: the number of batches to keep ready.
+            dtype: cast floating point tensors to this type. Keep their type if None.
+            fields: the indices of the elements of a batch that are moved and cast, e.g. [1] for the inputs of
+            (q_ids, inputs, labels) batches. The other elements are passed on as they are. All elements if None.
+        """
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.num_batches = num_batches
+        self.dtype = dtype
+        self.fields = fields
+        self.wait_time = 0
+
+    def __getattr__(self, name):
+        return getattr(self.dataloader, name)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _convert(self, batch):
+        if isinstance(batch, torch.Tensor):
+            if self.dtype is not None and batch.is_floating_point():
+                batch = batch.to(self.device, self.dtype, non_blocking=True)
+            else:
+                batch = batch.to(self.device, non_blocking=True)
+            return batch.contiguous()
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self._convert(x) for x in batch)
+        return batch
+
+    def _convert_fields(self, batch):
+        if self.fields is None:
+            return self._convert(batch)
+        return type(batch)(self._convert(x) if i in self.fields else x for i, x in enumerate(batch))
 
-class DuetHdf5Dataset(data.Dataset):
-    def __init__(self, file_path, max_query_len, max_doc_len, idfs):
-        self.fp = h5py.File(file_path, 'r')
+    def _record_stream(self, batch, stream):
+        # the tensors were allocated on the copy stream, without this the caching allocator may reuse their memory for
+        # the copy stream as soon as they are freed, while kernels of the consuming stream still read them
+        if isinstance(batch, torch.Tensor):
+            if batch.is_cuda:
+                batch.record_stream(stream)
+        elif isinstance(batch, (list, tuple)):
+            for x in batch:
+                self._record_stream(x, stream)
+
+    def _produce(self, batches, stop):
+        # copies run on a separate stream and are finished before a batch is handed over
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for batch in self.dataloader:
+                if stream is None:
+                    batch = self._convert_fields(batch)
+                else:
+                    with torch.cuda.stream(stream):
+                        batch = self._convert_fields(batch)
+                    stream.synchronize()
+                while not stop.is_set():
+                    try:
+                        batches.put((batch, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            batches.put((None, e))
+            return
+        batches.put((None, None))
+
+    def __iter__(self):
+        self.wait_time = 0
+        batches = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                batch, error = batches.get()
+                self.wait_time += time.perf_counter() - start
+                if error is not None:
+                    raise error
+                if batch is None:
+                    return
+                if self.device.type == 'cuda':
+                    self._record_stream(batch, torch.cuda.current_stream(self.device))
+                yield batch
+        finally:
+            # the consumer may stop early, the thread must not block on the full queue forever
+            stop.set()
+
+
+class SharedBatchPool(object):
+    """A pool of preallocated batches in shared memory. Dataloader workers write their batches into a free slot and
+    only send the slot index to the trainer (see SharedBatchDataset), which reads the batch in place and releases the
+    slot when it's done with it (see SharedBatchLoader).
+
+    Workers wait for a free slot, so there need to be more slots than batches in flight, i.e. at least
+    num_workers * prefetch_factor + num_held + 1.
+    """
+
+    def __init__(self, example_batch, num_slots):
+        """Constructs the pool.
+
+        Args:
+            example_batch: a full batch as returned by __getitems__ of the dataset, nested lists of tensors. It
+                determines the shapes and types of the slots.
+            num_slots: the number of batches in the pool.
+        """
+        self.num_slots = num_slots
+        self.slots = self._allocate(example_batch, num_slots)
+        self.busy = torch.zeros(num_slots, dtype=torch.bool).share_memory_()
+        self.lock = torch.multiprocessing.Lock()
+
+    @classmethod
+    def _allocate(cls, batch, num_slots):
+        if isinstance(batch, torch.Tensor):
+            return torch.zeros((num_slots,) + batch.shape, dtype=batch.dtype).share_memory_()
+        return type(batch)(cls._allocate(x, num_slots) for x in batch)
+
+    @classmethod
+    def _copy(cls, slots, batch, slot):
+        if isinstance(batch, torch.Tensor):
+            slots[slot, :len(batch)].copy_(batch)
+            return len(batch)
+        return [cls._copy(x, y, slot) for x, y in zip(slots, batch)][0]
+
+    @classmethod
+    def _view(cls, slots, slot, n):
+        if isinstance(slots, torch.Tensor):
+            return slots[slot, :n]
+        return type(slots)(cls._view(x, slot, n) for x in slots)
+
+    def _acquire(self):
+        while True:
+            with self.lock:
+                free = torch.nonzero(~self.busy)
+                if len(free) > 0:
+                    slot = int(free[0])
+                    self.busy[slot] = True
+                    return slot
+            time.sleep(0.001)
+
+    def write(self, batch):
+        """Copy a batch into a free slot, waiting for one if necessary.
+
+        Args:
+            batch: the batch, nested lists of tensors like the example batch.
+
+        Returns:
+            tuple: the slot and the number of rows in the batch.
+        """
+        slot = self._acquire()
+        return slot, self._copy(self.slots, batch, slot)
+
+    def view(self, slot, n):
+        """Return the batch in a slot. The tensors are views, they are only valid until the slot is released."""
+        return self._view(self.slots, slot, n)
+
+    def release(self, slot):
+        with self.lock:
+            self.busy[slot] = False
+
+    def reset(self):
+        """Release all slots. Only call this when no worker is writing."""
+        with self.lock:
+            self.busy.fill_(False)
+
+
+class SharedBatchDataset(data.Dataset):
+    """Wraps a dataset with __getitems__ (e.g. DuetHdf5BatchTrainset) so that batches are written into a
+    SharedBatchPool and only slot indices are passed to the trainer. Other attributes are those of the dataset.
+    """
+
+    def __init__(self, dataset, pool):
+        self.dataset = dataset
+        self.pool = pool
+
+    def __getattr__(self, name):
+        # unpickling looks up attributes before dataset is set
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitems__(self, indices):
+        return self.pool.write(self.dataset.__getitems__(indices))
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class SharedBatchLoader(object):
+    """Wraps a dataloader of a SharedBatchDataset and yields the batches from the pool. A batch stays valid until
+    num_held newer batches have been yielded. Other attributes (e.g. dataset) are those of the dataloader.
+    """
+
+    def __init__(self, dataloader, pool, num_held=1):
+        """Constructs the loader.
+
+        Args:
+            dataloader: the dataloader, it must use collate_batch.
+            pool: the SharedBatchPool the dataset writes to.
+            num_held: the number of batches the consumer uses at the same time, e.g. more if it prefetches.
+        """
+        self.dataloader = dataloader
+        self.pool = pool
+        self.num_held = num_held
+
+    def __getattr__(self, name):
+        return getattr(self.dataloader, name)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        # slots of batches that were still in flight when a previous iteration stopped early are lost otherwise
+        self.pool.reset()
+        held = []
+        for slot, n in self.dataloader:
+            if len(held) == self.num_held:
+                self.pool.release(held.pop(0))
+            held.append(slot)
+            yield self.pool.view(slot, n)
+        for slot in held:
+            self.pool.release(slot)
+
+
+class QueryGroupBatchSampler(data.Sampler):
+    """Yields batches of consecutive indices that contain whole query groups of a candidate set (consecutive rows with
+    the same query id), as many as fit into batch_size. Groups larger than batch_size are split.
+    """
+
+    def __init__(self, q_ids, batch_size):
+        """Constructs the sampler.
+
+        Args:
+            q_ids: the query id of each row.
+            batch_size: the maximum number of indices per batch.
+        """
+        super().__init__()
+        q_ids = np.asarray(q_ids)
+        starts = np.concatenate([[0], np.flatnonzero(q_ids[1:] != q_ids[:-1]) + 1])
+        ends = np.append(starts[1:], len(q_ids))
+
+        self.batches = []
+        batch_start = batch_end = 0
+        for start, end in zip(starts, ends):
+            if end - batch_start > batch_size and batch_end > batch_start:
+                self.batches.append((batch_start, batch_end))
+                batch_start = start
+            # split groups that don't fit into a batch on their own
+            while end - batch_start > batch_size:
+                self.batches.append((batch_start, batch_start + batch_size))
+                batch_start += batch_size
+            batch_end = end
+        if batch_end > batch_start:
+            self.batches.append((batch_start, batch_end))
+
+    def __iter__(self):
+        for start, end in self.batches:
+            yield list(range(start, end))
+
+    def __len__(self):
+        return len(self.batches)
+
+
+# fields of normalized files (see DuetHhdf5Saver) and the table and references they are stored in
+NORMALIZED_FIELDS = {'queries': ('query_table', 'query_refs'),
+                     'docs': ('doc_table', 'doc_refs'),
+                     'pos_docs': ('doc_table', 'pos_doc_refs'),
+                     'neg_docs': ('doc_table', 'neg_doc_refs')}
+
+
+class FlatRows(object):
+    """Variable length rows stored as one flat array plus row offsets. Unlike an object array, this doesn't create a
+    python object per row, whose reference counts would make forked workers copy the pages on write.
+    """
+
+    def __init__(self, rows, dtype):
+        """Constructs the flat rows.
+
+        Args:
+            rows: a sequence of 1d arrays.
+            dtype: the dtype of the values.
+        """
+        self.offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(row) for row in rows], out=self.offsets[1:])
+        self.values = np.zeros(self.offsets[-1], dtype=dtype)
+        for i, row in enumerate(rows):
+            self.values[self.offsets[i]:self.offsets[i + 1]] = row
+
+    @property
+    def ndim(self):
+        return 1
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.values.nbytes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.values[self.offsets[index]:self.offsets[index + 1]]
+        # slices and index arrays give an object array of views, like h5py does for variable length datasets
+        indices = np.arange(len(self))[index]
+        rows = np.empty(len(indices), dtype=object)
+        for i, j in enumerate(indices):
+            rows[i] = self[j]
+        return rows
+
+
+class ReferencedRows(object):
+    """The token id rows of a normalized file (see DuetHhdf5Saver), i.e. rows of a table of unique rows selected by an
+    array of references. Supports the same reads as the dataset it replaces.
+    """
+
+    def __init__(self, table, refs):
+        """Constructs the referenced rows.
+
+        Args:
+            table: the hdf5 dataset (or array) of unique token id rows.
+            refs: the hdf5 dataset (or array) of references into the table.
+        """
+        self.table = table
+        self.refs = refs
+
+    # read the covering slice of the table instead of a point selection if it is at most this many times larger
+    max_read_span = 4
+
+    @property
+    def ndim(self):
+        return self.table.ndim
+
+    @property
+    def dtype(self):
+        return self.table.dtype
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            return self.table[(int(self.refs[index[0]]),) + index[1:]]
+        if isinstance(index, (int, np.integer)):
+            return self.table[int(self.refs[index])]
+        # hdf5 point selections need sorted, unique indices
+        unique, inverse = np.unique(self.refs[index], return_inverse=True)
+        if len(unique) == 0:
+            return self.table[0:0]
+        start, stop = unique[0], unique[-1] + 1
+        if stop - start <= self.max_read_span * len(unique):
+            return self.table[start:stop][unique - start][inverse]
+        return self.table[unique][inverse]
+
+
+class DuetDataset(data.Dataset):
+    def __init__(self, max_query_len, max_doc_len, idfs, build_imat=True, sparse_imat=False):
+        """Base class of the DUET datasets, independent of the storage format.
+
+        Args:
+            max_query_len: pad queries to this length.
+            max_doc_len: pad documents to this length.
+            idfs: an array of idfs indexed by integer id (see load_idfs). A mapping from integer ids to idfs is
+            converted into one.
+            build_imat: whether samples contain the interaction matrix. Set to False if the model computes it (see
+            duetv2_model.InteractionMatrix), samples are then (query, doc) only.
+            sparse_imat: build the interaction matrices in sparse form (see sparse_interaction_matrices). Samples
+            differ in their number of matches, so they need to be collated with collate_sparse.
+        """
         self.max_query_len = max_query_len
         self.max_doc_len = max_doc_len
-        self.idfs = idfs
+        self.idfs = idfs_to_array(idfs) if isinstance(idfs, dict) else idfs
+        self.build_imat = build_imat
+        self.sparse_imat = sparse_imat
 
     @staticmethod
     def _pad_to(x, n):
         return np.pad(x, (0, n - len(x)), constant_values=0)
 
-    def _build_interaction_matrix(self, q_ids, doc_ids):
-        m = np.zeros(shape=(self.max_doc_len, self.max_query_len), dtype=np.float32)
-        for j in range(len(doc_ids)):
-            for i in range(len(q_ids)):
+    def _build_interaction_matrix(self, query, doc):
+        return self._build_interaction_matrices(query[np.newaxis], doc[np.newaxis])[0]
+
+    def _interaction_matrix_from_matches(self, query, matches):
+        if self.sparse_imat:
+            return self._interaction_matrices_from_matches(query[np.newaxis], [matches])[0]
+        return interaction_matrix_from_matches(query, matches, self.idfs, self.max_query_len, self.max_doc_len)
+
+    def _build_interaction_matrices(self, queries, docs):
+        if self.sparse_imat:
+            return sparse_interaction_matrices(queries, docs, self.idfs)
+        return build_interaction_matrices(queries, docs, self.idfs)
+
+    def _interaction_matrices_from_matches(self, queries, matches):
+        if self.sparse_imat:
+            return sparse_interaction_matrices_from_matches(queries, matches, self.idfs, self.max_doc_len)
+        return interaction_matrices_from_matches(queries, matches, self.idfs, self.max_doc_len)
 
-                cur_qid = q_ids[i]
-                if cur_qid == doc_ids[j]:
-                    m[j, i] = self.idfs[cur_qid]
 
-        return m
+class DuetHdf5Dataset(DuetDataset):
+    def __init__(self, file_path, max_query_len, max_doc_len, idfs, build_imat=True, chunk_cache_bytes=None,
+                 preload=False, preload_max_bytes=2 ** 32, sparse_imat=False):
+        """Base class of the hdf5 DUET datasets. Reads both the variable length (version 1) and the fixed width
+        (version 2) layout written by DuetHhdf5Saver.
+
+        Args:
+            file_path: the hdf5 file to read.
+            max_query_len: pad queries to this length.
+            max_doc_len: pad documents to this length.
+            idfs: an array of idfs indexed by integer id (see load_idfs). A mapping from integer ids to idfs is
+            converted into one.
+            build_imat: whether samples contain the interaction matrix. Set to False if the model computes it (see
+            duetv2_model.InteractionMatrix), samples are then (query, doc) only.
+            chunk_cache_bytes: size of the hdf5 chunk cache per dataset. Uses the h5py default if None.
+            preload: read the whole file into memory once, as zero padded arrays of the narrowest integer type. The
+            arrays are shared by forked dataloader workers.
+            preload_max_bytes: if the estimated size of the preloaded arrays exceeds this, read lazily instead.
+            sparse_imat: build the interaction matrices in sparse form (see sparse_interaction_matrices).
+        """
+        super().__init__(max_query_len, max_doc_len, idfs, build_imat, sparse_imat)
+        file_kwargs = {} if chunk_cache_bytes is None else {'rdcc_nbytes': chunk_cache_bytes}
+        self.fp = h5py.File(file_path, 'r', **file_kwargs)
+        self.layout_version = self.fp.attrs.get('layout_version', 1)
+        self.preload = preload
+        self.preload_max_bytes = preload_max_bytes
+
+    # read the covering slice instead of a point selection if it is at most this many times larger
+    max_read_span = 4
+
+    # number of rows to read at once when preloading
+    preload_batch_size = 100000
+
+    def _token_dtype(self, dataset):
+        if dataset.ndim == 2:
+            return dataset.dtype
+        if self.idfs is not None:
+            # idfs are indexed by token id, so this fits the whole vocabulary
+            return np.min_scalar_type(len(self.idfs) - 1)
+        return np.dtype('uint32')
+
+    def _load_padded(self, dataset, width):
+        """Read a whole dataset of token ids into a zero padded array of the narrowest integer type."""
+        n = len(dataset)
+        array = np.zeros(shape=(n, width), dtype=self._token_dtype(dataset))
+        for start in range(0, n, self.preload_batch_size):
+            indices = np.arange(start, min(start + self.preload_batch_size, n))
+            array[indices] = self._read_padded_rows(dataset, indices, width)
+        return array
+
+    def _match_bytes(self, dataset, sample_size=1000):
+        """Estimate the memory of a match coordinate dataset loaded as FlatRows from evenly spaced rows. The storage
+        size of a variable length dataset only counts the references to its rows, not the rows themselves."""
+        n = len(dataset)
+        if n == 0:
+            return 0
+        sample = np.unique(np.linspace(0, n - 1, min(n, sample_size)).astype(np.int64))
+        itemsize = np.dtype(dataset.dtype.metadata['vlen']).itemsize
+        row_bytes = np.mean([len(row) for row in dataset[sample]]) * itemsize
+        return int(n * row_bytes) + (n + 1) * np.dtype(np.int64).itemsize
+
+    def _preload_arrays(self, token_fields, match_fields, array_fields):
+        """Replace the hdf5 datasets with in-memory arrays if the preload option is set and they fit into the budget.
+
+        Args:
+            token_fields: dict of attribute names of token id datasets and their padded lengths.
+            match_fields: attribute names of match coordinate datasets (may be None).
+            array_fields: attribute names of fixed size datasets.
+        """
+        if not self.preload:
+            return
+        n = len(getattr(self, next(iter(token_fields))))
+        # tables of normalized files are shared by several fields, they are only loaded once
+        tables = {}
+        estimate = 0
+        for name, width in token_fields.items():
+            dataset = getattr(self, name)
+            if isinstance(dataset, ReferencedRows):
+                tables[dataset.table.name] = dataset.table, width
+                estimate += n * dataset.refs.dtype.itemsize
+            else:
+                estimate += n * width * self._token_dtype(dataset).itemsize
+        estimate += sum(len(table) * width * self._token_dtype(table).itemsize for table, width in tables.values())
+        estimate += sum(self._match_bytes(getattr(self, name)) for name in match_fields
+                        if getattr(self, name) is not None)
+        estimate += sum(getattr(self, name).dtype.itemsize * n for name in array_fields)
+        if estimate > self.preload_max_bytes:
+            print('not preloading {}: estimated {:.1f} MB exceed the budget of {:.1f} MB'.format(
+                self.fp.filename, estimate / 2 ** 20, self.preload_max_bytes / 2 ** 20))
+            return
+
+        nbytes = 0
+        for table_name, (table, width) in tables.items():
+            tables[table_name] = self._load_padded(table, width)
+            nbytes += tables[table_name].nbytes
+        for name, width in token_fields.items():
+            dataset = getattr(self, name)
+            if isinstance(dataset, ReferencedRows):
+                refs = dataset.refs[:]
+                setattr(self, name, ReferencedRows(tables[dataset.table.name], refs))
+                nbytes += refs.nbytes
+            else:
+                setattr(self, name, self._load_padded(dataset, width))
+                nbytes += getattr(self, name).nbytes
+        for name in match_fields:
+            dataset = getattr(self, name)
+            if dataset is not None:
+                rows = FlatRows(dataset[:], dataset.dtype.metadata['vlen'])
+                setattr(self, name, rows)
+                nbytes += rows.nbytes
+        for name in array_fields:
+            setattr(self, name, getattr(self, name)[:])
+            nbytes += getattr(self, name).nbytes
+        print('preloaded {} ({:.1f} MB)'.format(self.fp.filename, nbytes / 2 ** 20))
+
+    def _read_rows(self, dataset, indices):
+        """Read multiple rows with a single hdf5 selection.
+
+        Args:
+            dataset: the hdf5 dataset (or preloaded array) to read from.
+            indices: sorted, unique row indices.
+
+        Returns:
+            np.ndarray: the rows (an object array for variable length datasets).
+        """
+        start, stop = indices[0], indices[-1] + 1
+        if stop - start <= self.max_read_span * len(indices):
+            return dataset[start:stop][indices - start]
+        return dataset[indices]
+
+    def _read_padded_rows(self, dataset, indices, n):
+        """Read multiple rows of token ids, zero padded or truncated to length n.
+
+        Args:
+            dataset: the hdf5 dataset (or preloaded array) to read from.
+            indices: sorted, unique row indices.
+            n: the output length.
+
+        Returns:
+            np.ndarray: a (len(indices) x n) int64 array of token ids.
+        """
+        rows = self._read_rows(dataset, indices)
+        if dataset.ndim == 1:
+            out = np.zeros(shape=(len(rows), n), dtype=np.int64)
+            for i, row in enumerate(rows):
+                out[i, :min(len(row), n)] = row[:n]
+            return out
+        rows = rows[:, :n].astype(np.int64)
+        return np.pad(rows, ((0, 0), (0, n - rows.shape[1])), constant_values=0)
+
+    def _read_padded(self, dataset, index, n):
+        """Read a row of token ids, zero padded or truncated to length n.
+
+        Args:
+            dataset: the hdf5 dataset (or preloaded array) to read from.
+            index: the row index.
+            n: the output length.
+
+        Returns:
+            np.ndarray: the int64 token ids.
+        """
+        if dataset.ndim == 1:
+            return self._pad_to(dataset[index][:n], n)
+        # fixed width rows are already zero padded
+        return self._pad_to(dataset[index, :n].astype(np.int64), n)
+
+    def _row_lengths(self, dataset):
+        """Return the number of tokens in each row of a dataset (or preloaded array).
+
+        Args:
+            dataset: the dataset.
+
+        Returns:
+            np.ndarray: the lengths.
+        """
+        if isinstance(dataset, ReferencedRows):
+            return self._row_lengths(dataset.table)[dataset.refs[:]]
+        if isinstance(dataset, np.ndarray):
+            # preloaded rows are zero padded and id 0 only occurs as padding
+            return np.count_nonzero(dataset, axis=1)
+        if dataset.ndim == 2:
+            return self.fp[dataset.name + '_lengths'][:]
+        return np.array([len(row) for i in range(0, len(dataset), self.preload_batch_size)
+                         for row in dataset[i:i + self.preload_batch_size]], dtype=np.int64)
 
 
 class DuetHdf5Trainset(DuetHdf5Dataset):
-    def __init__(self, file_path, max_query_len, max_doc_len, idfs):
-        super().__init__(file_path, max_query_len, max_doc_len, idfs)
+    def __init__(self, file_path, max_query_len, max_doc_len, idfs, build_imat=True, chunk_cache_bytes=None,
+                 preload=False, preload_max_bytes=2 ** 32, sparse_imat=False):
+        super().__init__(file_path, max_query_len, max_doc_len, idfs, build_imat, chunk_cache_bytes, preload,
+                         preload_max_bytes, sparse_imat)
 
         fp = self.fp
 
-        self.queries = fp['queries']
-        self.pos_docs = fp['pos_docs']
-        self.neg_docs = fp['neg_docs']
+        if 'pos_doc_refs' in fp:
+            # normalized file, the triples reference unique queries and documents
+            self.queries = ReferencedRows(fp['query_table'], fp['query_refs'])
+            self.pos_docs = ReferencedRows(fp['doc_table'], fp['pos_doc_refs'])
+            self.neg_docs = ReferencedRows(fp['doc_table'], fp['neg_doc_refs'])
+        else:
+            self.queries = fp['queries']
+            self.pos_docs = fp['pos_docs']
+            self.neg_docs = fp['neg_docs']
+
+        # precomputed match coordinates, only present if the file was saved with save_matches
+        self.pos_matches = fp.get('pos_matches')
+        self.neg_matches = fp.get('neg_matches')
+
+        self._preload_arrays({'queries': max_query_len, 'pos_docs': max_doc_len, 'neg_docs': max_doc_len},
+                             ['pos_matches', 'neg_matches'], [])
 
     def __getitem__(self, index):
-        queries = self._pad_to(self.queries[index], self.max_query_len)
+        queries = self._read_padded(self.queries, index, self.max_query_len)
 
-        pos_docs = self._pad_to(self.pos_docs[index], self.max_doc_len)
-        neg_docs = self._pad_to(self.neg_docs[index], self.max_doc_len)
+        pos_docs = self._read_padded(self.pos_docs, index, self.max_doc_len)
+        neg_docs = self._read_padded(self.neg_docs, index, self.max_doc_len)
 
-        pos_imat = self._build_interaction_matrix(self.queries[index], self.pos_docs[index])
-        pos_sample = queries, pos_docs, pos_imat
+        if not self.build_imat:
+            return (queries, pos_docs), (queries, neg_docs), 0
+
+        if self.pos_matches is not None:
+            pos_imat = self._interaction_matrix_from_matches(queries, self.pos_matches[index])
+            neg_imat = self._interaction_matrix_from_matches(queries, self.neg_matches[index])
+        else:
+            pos_imat = self._build_interaction_matrix(queries, pos_docs)
+            neg_imat = self._build_interaction_matrix(queries, neg_docs)
 
-        neg_imat = self._build_interaction_matrix(self.queries[index], self.neg_docs[index])
+        pos_sample = queries, pos_docs, pos_imat
         neg_sample = queries, neg_docs, neg_imat
 
         return pos_sample, neg_sample, 0
@@ -53,26 +972,576 @@ class DuetHdf5Trainset(DuetHdf5Dataset):
     def __len__(self):
         return len(self.queries)
 
+    def sample_lengths(self):
+        """Return the length of the longer document of each sample, for length bucketing."""
+        lengths = np.maximum(self._row_lengths(self.pos_docs), self._row_lengths(self.neg_docs))
+        return np.minimum(lengths, self.max_doc_len)
+
 
 class DuetHdf5Testset(DuetHdf5Dataset):
-    def __init__(self, file_path, max_query_len, max_doc_len, idfs):
-        super().__init__(file_path, max_query_len, max_doc_len, idfs)
+    def __init__(self, file_path, max_query_len, max_doc_len, idfs, build_imat=True, chunk_cache_bytes=None,
+                 preload=False, preload_max_bytes=2 ** 32, sparse_imat=False):
+        super().__init__(file_path, max_query_len, max_doc_len, idfs, build_imat, chunk_cache_bytes, preload,
+                         preload_max_bytes, sparse_imat)
         fp = self.fp
         self.q_ids = fp['q_ids']
 
-        self.queries = fp['queries']
-        self.docs = fp['docs']
+        if 'doc_refs' in fp:
+            # normalized file, the rows reference unique queries and documents
+            self.queries = ReferencedRows(fp['query_table'], fp['query_refs'])
+            self.docs = ReferencedRows(fp['doc_table'], fp['doc_refs'])
+        else:
+            self.queries = fp['queries']
+            self.docs = fp['docs']
 
         self.labels = fp['labels']
 
+        # precomputed match coordinates, only present if the file was saved with save_matches
+        self.matches = fp.get('matches')
+
+        self._preload_arrays({'queries': max_query_len, 'docs': max_doc_len}, ['matches'], ['q_ids', 'labels'])
+
     def __getitem__(self, index):
         qids = self.q_ids[index]
-        inputs = (self._pad_to(self.queries[index], self.max_query_len),
-                  self._pad_to(self.docs[index], self.max_doc_len),
-                  self._build_interaction_matrix(self.queries[index], self.docs[index]))
+        queries = self._read_padded(self.queries, index, self.max_query_len)
+        docs = self._read_padded(self.docs, index, self.max_doc_len)
+        inputs = (queries, docs)
+        if self.build_imat and self.matches is not None:
+            inputs += (self._interaction_matrix_from_matches(queries, self.matches[index]),)
+        elif self.build_imat:
+            inputs += (self._build_interaction_matrix(queries, docs),)
         labels = self.labels[index]
 
         return qids, inputs, labels
 
     def __len__(self):
         return len(self.queries)
+
+    def sample_lengths(self):
+        """Return the length of the document of each sample, for length bucketing."""
+        return np.minimum(self._row_lengths(self.docs), self.max_doc_len)
+
+
+class DuetHdf5BatchTrainset(DuetHdf5Trainset):
+    """A DuetHdf5Trainset that reads whole batches at once. Use it with a batch sampler (e.g. BlockShuffleBatchSampler)
+    and collate_batch, the dataloader then passes all indices of a batch to __getitems__, which reads every hdf5 dataset
+    once and returns stacked tensors.
+    """
+
+    def _read_batch_rows(self, indices):
+        """Read the token ids of sorted, unique rows and, if the interaction matrices are built from them, their match
+        coordinates.
+        """
+        rows = [self._read_padded_rows(self.queries, indices, self.max_query_len),
+                self._read_padded_rows(self.pos_docs, indices, self.max_doc_len),
+                self._read_padded_rows(self.neg_docs, indices, self.max_doc_len)]
+        if self.build_imat and self.pos_matches is not None:
+            rows += [self._read_rows(self.pos_matches, indices), self._read_rows(self.neg_matches, indices)]
+        return rows
+
+    def _batch_inputs(self, queries, pos_docs, neg_docs, pos_matches=None, neg_matches=None):
+        """Return the positive and negative inputs of a batch, building the interaction matrices if build_imat is set.
+        """
+        pos_batch = [queries, pos_docs]
+        neg_batch = [queries, neg_docs]
+        if self.build_imat and pos_matches is not None:
+            pos_batch.append(self._interaction_matrices_from_matches(queries, pos_matches))
+            neg_batch.append(self._interaction_matrices_from_matches(queries, neg_matches))
+        elif self.build_imat:
+            pos_batch.append(self._build_interaction_matrices(queries, pos_docs))
+            neg_batch.append(self._build_interaction_matrices(queries, neg_docs))
+        return pos_batch, neg_batch
+
+    def __getitems__(self, indices):
+        unique, inverse = np.unique(indices, return_inverse=True)
+        pos_batch, neg_batch = self._batch_inputs(*self._read_batch_rows(unique))
+        pos_batch = [torch.from_numpy(x[inverse]) for x in pos_batch]
+        neg_batch = [torch.from_numpy(x[inverse]) for x in neg_batch]
+        return pos_batch, neg_batch, torch.zeros(len(indices), dtype=torch.int64)
+
+
+class DuetHdf5BatchTestset(DuetHdf5Testset):
+    """A DuetHdf5Testset that reads whole batches at once, see DuetHdf5BatchTrainset.
+    """
+
+    def __getitems__(self, indices):
+        unique, inverse = np.unique(indices, return_inverse=True)
+        q_ids = self._read_rows(self.q_ids, unique)
+        queries = self._read_padded_rows(self.queries, unique, self.max_query_len)
+        docs = self._read_padded_rows(self.docs, unique, self.max_doc_len)
+        inputs = [queries, docs]
+        if self.build_imat and self.matches is not None:
+            inputs.append(self._interaction_matrices_from_matches(queries, self._read_rows(self.matches, unique)))
+        elif self.build_imat:
+            inputs.append(self._build_interaction_matrices(queries, docs))
+        labels = self._read_rows(self.labels, unique)
+
+        inputs = [torch.from_numpy(x[inverse]) for x in inputs]
+        return torch.from_numpy(q_ids[inverse]), inputs, torch.from_numpy(labels[inverse])
+
+
+class DuetHdf5GroupedTestset(DuetHdf5Testset):
+    """A DuetHdf5Testset that reads whole batches grouped by query (see QueryGroupBatchSampler and
+    duetv2_model.CandidateScorer). Each query of a batch is only read and passed to the model once, the inputs are
+    (queries, docs, query_index[, imat]), where query_index is the row in queries of each candidate.
+    """
+
+    def __getitems__(self, indices):
+        unique, inverse = np.unique(indices, return_inverse=True)
+        q_ids = self._read_rows(self.q_ids, unique)
+        # the first row of each query
+        _, first, query_index = np.unique(q_ids, return_index=True, return_inverse=True)
+        query_index = query_index.reshape(-1).astype(np.int64)
+        queries = self._read_padded_rows(self.queries, unique[first], self.max_query_len)
+        docs = self._read_padded_rows(self.docs, unique, self.max_doc_len)
+        inputs = [queries, docs[inverse], query_index[inverse]]
+        if self.build_imat:
+            if self.matches is not None:
+                imat = self._interaction_matrices_from_matches(queries[query_index],
+                                                               self._read_rows(self.matches, unique))
+            else:
+                imat = self._build_interaction_matrices(queries[query_index], docs)
+            inputs.append(imat[inverse])
+        labels = self._read_rows(self.labels, unique)
+
+        inputs = [torch.from_numpy(x) for x in inputs]
+        return torch.from_numpy(q_ids[inverse]), inputs, torch.from_numpy(labels[inverse])
+
+
+def _rank_info():
+    """Return the rank and the world size, (0, 1) if not distributed."""
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+def _shard_info():
+    """Return the index and number of the shards the current process reads, one shard per dataloader worker and rank.
+    """
+    rank, world_size = _rank_info()
+    worker_info = data.get_worker_info()
+    worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+    return rank * num_workers + worker_id, world_size * num_workers
+
+
+def _shuffle_buffer(samples, buffer_size, rng):
+    """Approximately shuffle a stream of samples by keeping up to buffer_size of them and yielding a random one for
+    each new sample.
+    """
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        j = rng.integers(buffer_size)
+        yield buffer[j]
+        buffer[j] = sample
+    for j in rng.permutation(len(buffer)):
+        yield buffer[j]
+
+
+class DuetHdf5StreamTrainset(DuetHdf5BatchTrainset, data.IterableDataset):
+    """A DuetHdf5Trainset that streams the file in contiguous chunks instead of reading random rows. The chunks are
+    visited in a random order and split between the dataloader workers (and ranks, if distributed), their rows are mixed
+    through a shuffle buffer. Only the token ids (and match coordinates) pass through the buffer, the interaction
+    matrices are built for each batch that leaves it. Yields whole batches like __getitems__, use it with a DataLoader
+    with batch_size=None, collate_batch and the num_workers given here.
+
+    The order only depends on the seed and the epoch (see set_epoch) and the number of workers.
+    """
+
+    def __init__(self, file_path, max_query_len, max_doc_len, idfs, batch_size=32, chunk_size=4096, buffer_size=65536,
+                 seed=0, num_workers=0, build_imat=True, chunk_cache_bytes=None, preload=False,
+                 preload_max_bytes=2 ** 32, sparse_imat=False):
+        """Constructs the train set.
+
+        Args:
+            file_path: the hdf5 file to read.
+            max_query_len: pad queries to this length.
+            max_doc_len: pad documents to this length.
+            idfs: an array of idfs indexed by integer id (see load_idfs).
+            batch_size: the number of rows per batch, the last batch of each worker may be smaller.
+            chunk_size: the number of consecutive rows read at once.
+            buffer_size: the number of rows in the shuffle buffer.
+            seed: the random seed of the chunk order and the shuffle buffer.
+            num_workers: the number of workers of the dataloader, which split the chunks between them. Needed for the
+            length, which is the number of batches of this rank.
+            build_imat: whether samples contain the interaction matrix.
+            chunk_cache_bytes: size of the hdf5 chunk cache per dataset. Uses the h5py default if None.
+            preload: read the whole file into memory once.
+            preload_max_bytes: if the estimated size of the preloaded arrays exceeds this, read lazily instead.
+            sparse_imat: build the interaction matrices in sparse form (see sparse_interaction_matrices).
+        """
+        super().__init__(file_path, max_query_len, max_doc_len, idfs, build_imat, chunk_cache_bytes, preload,
+                         preload_max_bytes, sparse_imat)
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.num_workers = num_workers
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Set the epoch. Together with the seed, it determines the order of the samples."""
+        self.epoch = epoch
+
+    def _shard_starts(self, shard, num_shards):
+        # every shard computes the same chunk order and takes its share
+        starts = np.arange(0, len(self.queries), self.chunk_size)
+        return np.random.default_rng([self.seed, self.epoch]).permutation(starts)[shard::num_shards]
+
+    def __len__(self):
+        # the batches the workers of this rank yield in the current epoch, the last one of each worker may be smaller
+        rank, world_size = _rank_info()
+        num_workers = max(self.num_workers, 1)
+        num_batches = 0
+        for shard in range(rank * num_workers, (rank + 1) * num_workers):
+            num_rows = np.minimum(len(self.queries) - self._shard_starts(shard, world_size * num_workers),
+                                  self.chunk_size).sum()
+            num_batches += (int(num_rows) + self.batch_size - 1) // self.batch_size
+        return num_batches
+
+    def _iter_chunk_rows(self, starts):
+        for start in starts:
+            chunk = self._read_batch_rows(np.arange(start, min(start + self.chunk_size, len(self.queries))))
+            # copies, so that the buffer doesn't keep whole chunks alive
+            for j in range(len(chunk[0])):
+                yield tuple(np.array(x[j]) for x in chunk)
+
+    def _collate_rows(self, rows):
+        fields = list(zip(*rows))
+        pos_batch, neg_batch = self._batch_inputs(*[np.stack(x) for x in fields[:3]], *fields[3:])
+        pos_batch = [torch.from_numpy(x) for x in pos_batch]
+        neg_batch = [torch.from_numpy(x) for x in neg_batch]
+        return pos_batch, neg_batch, torch.zeros(len(rows), dtype=torch.int64)
+
+    def __iter__(self):
+        shard, num_shards = _shard_info()
+        starts = self._shard_starts(shard, num_shards)
+        rng = np.random.default_rng([self.seed, self.epoch, shard])
+        rows = []
+        for row in _shuffle_buffer(self._iter_chunk_rows(starts), self.buffer_size, rng):
+            rows.append(row)
+            if len(rows) == self.batch_size:
+                yield self._collate_rows(rows)
+                rows = []
+        if rows:
+            yield self._collate_rows(rows)
+
+
+def _splitmix64(x):
+    """The splitmix64 finalizer, a fast hash of uint64 arrays (overflow wraps around)."""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class DuetDynamicTrainset(DuetHdf5Dataset):
+    """A train set that samples negative documents on the fly, so every epoch sees new negatives. The file only stores
+    the positive pairs and a pool of documents (see DuetHhdf5Saver, dynamic_negatives). Samples are the same as those
+    of DuetHdf5Trainset.
+    """
+
+    # give up if no negative that isn't a positive of the query is found after this many attempts
+    max_sampling_attempts = 100
+
+    def __init__(self, file_path, max_query_len, max_doc_len, idfs, num_neg_examples=1, seed=0, build_imat=True,
+                 chunk_cache_bytes=None, preload=False, preload_max_bytes=2 ** 32, sparse_imat=False):
+        """Constructs the train set.
+
+        Args:
+            file_path: the hdf5 file to read.
+            max_query_len: pad queries to this length.
+            max_doc_len: pad documents to this length.
+            idfs: an array of idfs indexed by integer id (see load_idfs).
+            num_neg_examples: the number of negatives sampled for each positive pair per epoch.
+            seed: the random seed of the negative sampling.
+            build_imat: whether samples contain the interaction matrix.
+            chunk_cache_bytes: size of the hdf5 chunk cache per dataset. Uses the h5py default if None.
+            preload: read the whole file into memory once.
+            preload_max_bytes: if the estimated size of the preloaded arrays exceeds this, read lazily instead.
+            sparse_imat: build the interaction matrices in sparse form (see sparse_interaction_matrices).
+        """
+        super().__init__(file_path, max_query_len, max_doc_len, idfs, build_imat, chunk_cache_bytes, preload,
+                         preload_max_bytes, sparse_imat)
+        self.num_neg_examples = num_neg_examples
+        self.seed = seed
+        self.num_workers = num_workers
+        self.epoch = 0
+
+        fp = self.fp
+        self.queries = ReferencedRows(fp['query_table'], fp['query_refs'])
+        self.pos_docs = ReferencedRows(fp['doc_table'], fp['pos_doc_refs'])
+
+        # the sampler needs to know all positive pairs, so negatives that are positives of the query are rejected
+        self.n_docs = len(fp['doc_table'])
+        self.query_refs = fp['query_refs'][:].astype(np.uint64)
+        self.positive_keys = np.unique(self.query_refs * np.uint64(self.n_docs) + fp['pos_doc_refs'][:])
+
+        self._preload_arrays({'queries': max_query_len, 'pos_docs': max_doc_len}, [], [])
+
+    def set_epoch(self, epoch):
+        """Set the epoch. Together with the seed, it determines the sampled negatives."""
+        self.epoch = epoch
+
+    def _sample_negatives(self, indices):
+        """Sample a negative document for each index. The sample is a hash of seed, epoch and index, so it doesn't
+        depend on the worker or the order of the reads.
+
+        Args:
+            indices: the sample indices.
+
+        Returns:
+            np.ndarray: the rows of the sampled documents in the document table.
+        """
+        indices = np.asarray(indices, dtype=np.uint64)
+        query_refs = self.query_refs[indices // np.uint64(self.num_neg_examples)]
+        base = _splitmix64(_splitmix64(np.full(len(indices), self.seed, dtype=np.uint64)) ^ np.uint64(self.epoch))
+        base = _splitmix64(base ^ indices)
+
+        neg_refs = np.zeros(len(indices), dtype=np.uint64)
+        todo = np.arange(len(indices))
+        for attempt in range(self.max_sampling_attempts):
+            neg_refs[todo] = _splitmix64(base[todo] + np.uint64(attempt)) % np.uint64(self.n_docs)
+            keys = query_refs[todo] * np.uint64(self.n_docs) + neg_refs[todo]
+            todo = todo[np.isin(keys, self.positive_keys)]
+            if len(todo) == 0:
+                return neg_refs.astype(np.int64)
+        raise RuntimeError('Could not sample a negative document for {} samples.'.format(len(todo)))
+
+    def __getitem__(self, index):
+        pos_index = index // self.num_neg_examples
+        queries = self._read_padded(self.queries, pos_index, self.max_query_len)
+
+        pos_docs = self._read_padded(self.pos_docs, pos_index, self.max_doc_len)
+        neg_ref = self._sample_negatives([index])[0]
+        neg_docs = self._read_padded(self.pos_docs.table, neg_ref, self.max_doc_len)
+
+        if not self.build_imat:
+            return (queries, pos_docs), (queries, neg_docs), 0
+
+        pos_sample = queries, pos_docs, self._build_interaction_matrix(queries, pos_docs)
+        neg_sample = queries, neg_docs, self._build_interaction_matrix(queries, neg_docs)
+
+        return pos_sample, neg_sample, 0
+
+    def __len__(self):
+        return len(self.query_refs) * self.num_neg_examples
+
+    def sample_lengths(self):
+        """Return the length of the positive document of each sample (negatives are only known when they are read),
+        for length bucketing."""
+        lengths = np.minimum(self._row_lengths(self.pos_docs), self.max_doc_len)
+        return np.repeat(lengths, self.num_neg_examples)
+
+
+class DuetDynamicBatchTrainset(DuetDynamicTrainset):
+    """A DuetDynamicTrainset that reads whole batches at once, see DuetHdf5BatchTrainset.
+    """
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        unique, inverse = np.unique(indices // self.num_neg_examples, return_inverse=True)
+        queries = self._read_padded_rows(self.queries, unique, self.max_query_len)[inverse]
+        pos_docs = self._read_padded_rows(self.pos_docs, unique, self.max_doc_len)[inverse]
+
+        unique, inverse = np.unique(self._sample_negatives(indices), return_inverse=True)
+        neg_docs = self._read_padded_rows(self.pos_docs.table, unique, self.max_doc_len)[inverse]
+
+        pos_batch = [queries, pos_docs]
+        neg_batch = [queries, neg_docs]
+        if self.build_imat:
+            pos_batch.append(self._build_interaction_matrices(queries, pos_docs))
+            neg_batch.append(self._build_interaction_matrices(queries, neg_docs))
+
+        pos_batch = [torch.from_numpy(x) for x in pos_batch]
+        neg_batch = [torch.from_numpy(x) for x in neg_batch]
+        return pos_batch, neg_batch, torch.zeros(len(indices), dtype=torch.int64)
+
+
+class DuetMmapDataset(DuetDataset):
+    def __init__(self, dir_path, max_query_len, max_doc_len, idfs, build_imat=True, sparse_imat=False):
+        """Base class of the DUET datasets stored as flat arrays (see hdf5_to_mmap.py). Every variable length field
+        <name> is stored as <name>.tokens.npy, all rows concatenated, and <name>.offsets.npy, the n + 1 row offsets. All
+        arrays are memory-mapped, so dataloader workers share their pages through the OS page cache and rows are read
+        without copies.
+
+        Args:
+            dir_path: the directory containing the arrays.
+            max_query_len: pad queries to this length.
+            max_doc_len: pad documents to this length.
+            idfs: an array of idfs indexed by integer id (see load_idfs). A mapping from integer ids to idfs is
+            converted into one.
+            build_imat: whether samples contain the interaction matrix.
+            sparse_imat: build the interaction matrices in sparse form (see sparse_interaction_matrices).
+        """
+        super().__init__(max_query_len, max_doc_len, idfs, build_imat, sparse_imat)
+        self.dir_path = dir_path
+        self._open()
+
+    def _open(self):
+        self.arrays = {}
+        for file_name in os.listdir(self.dir_path):
+            if file_name.endswith('.npy'):
+                file_path = os.path.join(self.dir_path, file_name)
+                self.arrays[file_name[:-len('.npy')]] = np.load(file_path, mmap_mode='r')
+
+    def __getstate__(self):
+        # memory-mapped arrays would be pickled as copies, so workers map the files again instead
+        state = self.__dict__.copy()
+        del state['arrays']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def _has_field(self, name):
+        return name + '.offsets' in self.arrays
+
+    def _row(self, name, index):
+        """Return a row of a variable length field as a view of the memory-mapped array."""
+        if name in NORMALIZED_FIELDS and not self._has_field(name):
+            table, refs = NORMALIZED_FIELDS[name]
+            name, index = table, self.arrays[refs][index]
+        offsets = self.arrays[name + '.offsets']
+        return self.arrays[name + '.tokens'][offsets[index]:offsets[index + 1]]
+
+    def _padded(self, name, index, n):
+        """Return a row of token ids, zero padded or truncated to length n. This writes the row into the output once,
+        there are no intermediate copies."""
+        row = self._row(name, index)[:n]
+        out = np.zeros(n, dtype=np.int64)
+        out[:len(row)] = row
+        return torch.from_numpy(out)
+
+    def _imat(self, query, doc, match_field, index):
+        if self._has_field(match_field):
+            m = self._interaction_matrix_from_matches(query.numpy(), self._row(match_field, index))
+        else:
+            m = self._build_interaction_matrix(query.numpy(), doc.numpy())
+        return torch.from_numpy(m)
+
+
+class DuetMmapTrainset(DuetMmapDataset):
+    """A train set in the flat memory-mapped format, with the same samples as DuetHdf5Trainset.
+    """
+
+    def __getitem__(self, index):
+        queries = self._padded('queries', index, self.max_query_len)
+
+        pos_docs = self._padded('pos_docs', index, self.max_doc_len)
+        neg_docs = self._padded('neg_docs', index, self.max_doc_len)
+
+        if not self.build_imat:
+            return (queries, pos_docs), (queries, neg_docs), 0
+
+        pos_sample = queries, pos_docs, self._imat(queries, pos_docs, 'pos_matches', index)
+        neg_sample = queries, neg_docs, self._imat(queries, neg_docs, 'neg_matches', index)
+
+        return pos_sample, neg_sample, 0
+
+    def __len__(self):
+        if self._has_field('queries'):
+            return len(self.arrays['queries.offsets']) - 1
+        return len(self.arrays[NORMALIZED_FIELDS['queries'][1]])
+
+
+class DuetMmapTestset(DuetMmapDataset):
+    """A candidate set in the flat memory-mapped format, with the same samples as DuetHdf5Testset.
+    """
+
+    def __getitem__(self, index):
+        qids = self.arrays['q_ids'][index]
+        queries = self._padded('queries', index, self.max_query_len)
+        docs = self._padded('docs', index, self.max_doc_len)
+        inputs = (queries, docs)
+        if self.build_imat:
+            inputs += (self._imat(queries, docs, 'matches', index),)
+        labels = self.arrays['labels'][index]
+
+        return qids, inputs, labels
+
+    def __len__(self):
+        return len(self.arrays['labels'])
+
+
+class DocFeatureStore(object):
+    """Precomputed document features of the distributed model (see DuetV2.encode_docs), stored as memory-mapped arrays
+    features.npy (one row per document) and doc_ids.npy in a directory, see precompute_doc_features.py.
+    """
+
+    def __init__(self, dir_path):
+        """Opens the store.
+
+        Args:
+            dir_path: the directory containing the arrays.
+        """
+        self.dir_path = dir_path
+        self._open()
+
+    def _open(self):
+        self.features = np.load(os.path.join(self.dir_path, 'features.npy'), mmap_mode='r')
+        self.doc_ids = np.load(os.path.join(self.dir_path, 'doc_ids.npy'))
+        # rows are looked up by binary search over the sorted ids
+        self._order = np.argsort(self.doc_ids, kind='stable')
+        self._sorted_ids = self.doc_ids[self._order]
+
+    def __getstate__(self):
+        # memory-mapped arrays would be pickled as copies, so workers map the files again instead
+        state = self.__dict__.copy()
+        for name in ['features', 'doc_ids', '_order', '_sorted_ids']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    @staticmethod
+    def create(dir_path, doc_ids, feature_shape, dtype=np.float32):
+        """Create an empty store.
+
+        Args:
+            dir_path: the directory to store the arrays in.
+            doc_ids: the document ids (integers or strings), one per row.
+            feature_shape: the shape of the features of one document.
+            dtype: the type the features are stored as, e.g. np.float16 to halve the size.
+
+        Returns:
+            np.memmap: the writable features array, row i belongs to doc_ids[i].
+        """
+        os.makedirs(dir_path, exist_ok=True)
+        doc_ids = np.asarray(doc_ids)
+        # object arrays of strings would be pickled
+        doc_ids = doc_ids.astype(np.int64 if doc_ids.dtype.kind in 'iu' else str)
+        np.save(os.path.join(dir_path, 'doc_ids.npy'), doc_ids)
+        return np.lib.format.open_memmap(os.path.join(dir_path, 'features.npy'), mode='w+', dtype=dtype,
+                                         shape=(len(doc_ids),) + tuple(feature_shape))
+
+    def rows(self, doc_ids):
+        """Return the rows of the documents.
+
+        Args:
+            doc_ids: an array of document ids.
+
+        Returns:
+            np.ndarray: the rows.
+        """
+        doc_ids = np.asarray(doc_ids)
+        if self.doc_ids.dtype.kind == 'i':
+            doc_ids = doc_ids.astype(np.int64)
+        positions = np.minimum(np.searchsorted(self._sorted_ids, doc_ids), len(self._sorted_ids) - 1)
+        missing = self._sorted_ids[positions] != doc_ids
+        if np.any(missing):
+            raise KeyError('Unknown document ids: {}'.format(doc_ids[missing][:10].tolist()))
+        return self._order[positions]
+
+    def __getitem__(self, doc_ids):
+        """Return the features of the documents as a float32 tensor."""
+        unique, inverse = np.unique(self.rows(doc_ids), return_inverse=True)
+        return torch.from_numpy(self.features[unique].astype(np.float32)[inverse])
+
+    def __len__(self):
+        return len(self.doc_ids)
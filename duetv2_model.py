@@ -1,29 +1,69 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+import zlib
+
+import numpy as np
 import torch
 from torch import nn
+from torch.nn import functional as F
 from torchtext import vocab
 
+from qa_utils.io import load_pkl_file
+
 
 class DuetV2(torch.nn.Module):
     """Implementation of the DuetV2 model.
     """
 
     def __init__(self, id_to_word, glove_name, glove_cache, glove_dim, h_dim, max_q_len, max_d_len, dropout_rate,
-                 pooling_size_doc=100):
+                 pooling_size_doc=100, idfs=None, length_adaptive=False, sparse_imat=False, load_glove=True,
+                 pca_dim=None, num_buckets=None, num_frequent=0, embedding_idfs=None, sparse_embeddings=False,
+                 freeze_embeddings=False, precision='fp32', bf16_embeddings=False):
         """
 
         Args:
             id_to_word: a mapping from all integer ids in the vocabulary to tokens.
-            glove_name: version of the pre-trained glove vectors to use. One of: ['42B', '840B', 'twitter.27B', '6B']
+            glove_name: version of the pre-trained glove vectors to use. One of: ['42B', '840B', 'twitter.27B', '6B'].
+            If None, the embeddings are initialized randomly.
             glove_cache: the directory to download the glove vectors to.
             h_dim: Hidden dimension across the network.
             max_q_len: input length of queries.
             max_d_len: input length of documents.
             dropout_rate: dropout rate for all dropout layers.
             pooling_size_doc: size of the max pooling window for the document after convolution.
+            idfs: a mapping from integer ids to idfs. If given, the interaction matrix is computed by the model from the
+            query and document ids and does not need to be passed to forward().
+            length_adaptive: accept batches of any length up to max_q_len and max_d_len (e.g. padded to the longest
+            query and document in the batch). The distributed model pools to a fixed size instead of using fixed
+            pooling windows, so it is not equivalent to the default model.
+            sparse_imat: the interaction matrices are passed in sparse form (see
+            data_source.sparse_interaction_matrices), which the local model multiplies without densifying them.
+            load_glove: if False, the embeddings are not initialized from GloVe, e.g. when a checkpoint is loaded.
+            pca_dim: reduce the embedding dimension to this many principal components of the GloVe vectors.
+            num_buckets: bound the size of the embedding by giving only the num_frequent most frequent words their own
+            embedding and hashing the remaining words into this many shared embeddings (see HashedEmbedding).
+            num_frequent: the number of words with their own embedding with num_buckets.
+            embedding_idfs: an array of idfs indexed by id, the frequent words are the ones with the lowest idfs. Not
+            needed when a checkpoint is loaded.
+            sparse_embeddings: compute sparse gradients for the embeddings, which need an optimizer that supports them
+            (see train.build_optimizer).
+            freeze_embeddings: do not train the embeddings.
+            precision: 'fp32' or 'bf16'. With 'bf16', forward() and score_candidates() run in bf16 autocast, the
+            parameters stay in fp32 and the scores are returned in fp32.
+            bf16_embeddings: store the embeddings in bf16. Requires the 'bf16' precision and frozen embeddings, as
+            there are no fp32 master weights for them.
         """
         super().__init__()
+        if precision not in ('fp32', 'bf16'):
+            raise ValueError('unknown precision {}'.format(precision))
+        if bf16_embeddings and (precision != 'bf16' or not freeze_embeddings):
+            raise ValueError('bf16 embeddings require the bf16 precision and frozen embeddings')
+        self.precision = precision
 
-        self.local_model = DuetV2Local(h_dim, max_q_len, max_d_len, dropout_rate)
+        self.interaction_matrix = None if idfs is None else InteractionMatrix(idfs)
+        self.local_model = DuetV2Local(h_dim, max_q_len, max_d_len, dropout_rate, length_adaptive, sparse_imat)
 
         self.distributed_model = DuetV2Distributed(id_to_word,
                                                    glove_name,
@@ -33,7 +73,17 @@ class DuetV2(torch.nn.Module):
                                                    dropout_rate,
                                                    pooling_size_doc,
                                                    max_q_len - 2,
-                                                   max_d_len)
+                                                   max_d_len,
+                                                   length_adaptive,
+                                                   load_glove,
+                                                   pca_dim,
+                                                   num_buckets,
+                                                   num_frequent,
+                                                   embedding_idfs,
+                                                   sparse_embeddings,
+                                                   freeze_embeddings)
+        if bf16_embeddings:
+            self.distributed_model.glove.embedding.to(torch.bfloat16)
 
         # combining layers
         self.linear_0 = nn.Linear(h_dim, h_dim)
@@ -43,18 +93,48 @@ class DuetV2(torch.nn.Module):
         self.relu = nn.ReLU()
         self.dropout = nn.Dropout(dropout_rate)
 
-    def forward(self, query, doc, imat):
+    def encode_docs(self, doc):
+        """Compute the query independent document representations of the distributed model, see DocFeatureStore.
+
+        Args:
+            doc: a (batch_size x max_d_len) tensor of integer ids.
+
+        Returns:
+            torch.Tensor: the document features, to be passed to forward() as doc_features.
+        """
+        return self.distributed_model.encode_docs(doc)
+
+    def forward(self, query, doc, imat=None, doc_features=None):
         """Run the forward call.
 
         Args:
-            query: a fixed number of integer id's.
-            doc: a fixed number of integer id's.
-            imat: a (max_q_len x max_d_len) interaction matrix.
+            query: a fixed number of integer id's (at most max_q_len if the model is length adaptive).
+            doc: a fixed number of integer id's (at most max_d_len if the model is length adaptive).
+            imat: a (max_d_len x max_q_len) interaction matrix, or (doc length x query length) if the model is length
+            adaptive. Computed from query and doc if omitted, which requires the model to be constructed with idfs. A
+            torch sparse tensor or, with sparse_imat, the matches in sparse form are accepted as well.
+            doc_features: precomputed document features (see encode_docs). If given, the document part of the
+            distributed model is skipped and doc is only used for the interaction matrix.
 
         """
-        local = self.local_model(imat)
-        dist = self.distributed_model(query, doc)
+        with self._autocast(query.device):
+            if imat is None:
+                imat = self._interaction_matrix(query, doc)
+            local = self.local_model(imat)
+            if doc_features is None:
+                dist = self.distributed_model(query, doc)
+            else:
+                dist = self.distributed_model.combine(self.distributed_model.encode_query(query), doc_features)
+            return self._combine(local, dist).float()
+
+    def _autocast(self, device):
+        return torch.autocast(device.type, dtype=torch.bfloat16, enabled=self.precision == 'bf16')
+
+    def _interaction_matrix(self, query, doc):
+        imat = self.interaction_matrix(query, doc)
+        return imat.to_sparse() if self.local_model.sparse_imat else imat
 
+    def _combine(self, local, dist):
         x = dist + local
         x = self.linear_0(x)
         x = self.relu(x)
@@ -64,17 +144,153 @@ class DuetV2(torch.nn.Module):
         x = self.relu(x)
         x = self.dropout(x)
 
-        x = self.linear_out(x)
+        # the scores are computed in fp32 even under autocast, bf16 can't tell close scores apart
+        with torch.autocast(x.device.type, enabled=False):
+            x = self.linear_out(x.float())
         x = self.relu(x)
 
         return x * 0.1
 
+    def score_candidates(self, query, docs, query_index=None, imat=None, doc_features=None):
+        """Score candidate documents of one or more queries. Each query is only encoded once and its representation is
+        shared by its candidates, the scores are the same as those of forward().
+
+        Args:
+            query: a (max_q_len) tensor of integer ids of a single query, or a (num_queries x max_q_len) tensor.
+            docs: a (num_candidates x max_d_len) tensor of integer ids.
+            query_index: a (num_candidates) tensor with the row in query of the query of each candidate. Can be
+            omitted for a single query.
+            imat: the (num_candidates x max_d_len x max_q_len) interaction matrices. Computed from query and docs if
+            omitted, which requires the model to be constructed with idfs.
+            doc_features: precomputed document features (see encode_docs).
+
+        Returns:
+            torch.Tensor: a (num_candidates x 1) tensor of scores.
+        """
+        if query.dim() == 1:
+            query = query.unsqueeze(0)
+        if query_index is None:
+            query_index = torch.zeros(len(docs), dtype=torch.int64, device=docs.device)
+        with self._autocast(query.device):
+            if imat is None:
+                imat = self._interaction_matrix(query[query_index], docs)
+            local = self.local_model(imat)
+
+            if doc_features is None:
+                doc_features = self.distributed_model.encode_docs(docs)
+            q = self.distributed_model.encode_query(query)[query_index]
+            dist = self.distributed_model.combine(q, doc_features)
+            return self._combine(local, dist).float()
+
+
+class CandidateScorer(torch.nn.Module):
+    """Wraps a DuetV2 model so that calling it scores query-grouped batches (see DuetV2.score_candidates and
+    data_source.DuetHdf5GroupedTestset). Like DataParallel, the wrapped model is the module attribute.
+    """
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, *inputs):
+        return self.module.score_candidates(*inputs)
+
+
+def _optional_int(train_args, name):
+    # runs trained before an option existed don't have it in their args.csv, unset options are empty
+    value = train_args.get(name)
+    return int(value) if value not in (None, '', 'None') else None
+
+
+def model_from_train_args(train_args, idfs=None, **kwargs):
+    """Build the DuetV2 model of a training run to load one of its checkpoints into.
+
+    Args:
+        train_args: the arguments of the run, see qa_utils.evaluation.read_args.
+        idfs: a mapping from integer ids to idfs, only used if the run computed the interaction matrix in the model.
+        **kwargs: further arguments of DuetV2 that don't depend on the training run, e.g. the precision.
+
+    Returns:
+        The model without GloVe vectors, the weights are restored from the checkpoint.
+    """
+    return DuetV2(id_to_word=load_pkl_file(train_args['VOCAB_FILE']),
+                  glove_name=train_args['glove_name'],
+                  glove_cache=train_args['glove_cache'],
+                  glove_dim=int(train_args['glove_dim']),
+                  h_dim=int(train_args['hidden_dim']),
+                  max_q_len=int(train_args['max_q_len']),
+                  max_d_len=int(train_args['max_d_len']),
+                  dropout_rate=float(train_args['dropout']),
+                  idfs=idfs if train_args.get('imat_in_model') == 'True' else None,
+                  length_adaptive=train_args.get('length_adaptive') == 'True',
+                  sparse_imat=train_args.get('sparse_imat') == 'True',
+                  load_glove=False,
+                  pca_dim=_optional_int(train_args, 'pca_dim'),
+                  # the rows of the hashed embedding are part of the checkpoints
+                  num_buckets=_optional_int(train_args, 'num_buckets'),
+                  num_frequent=int(train_args.get('num_frequent') or 0),
+                  **kwargs)
+
+
+class InteractionMatrix(torch.nn.Module):
+    """Computes the idf weighted exact match interaction matrices of a batch of padded queries and documents.
+    """
+
+    def __init__(self, idfs):
+        """Constructs the interaction matrix module.
+
+        Args:
+            idfs: either a mapping from integer ids to idfs or an array of idfs indexed by integer id.
+        """
+        super().__init__()
+        if isinstance(idfs, dict):
+            table = torch.zeros(max(idfs) + 1)
+            table[list(idfs.keys())] = torch.tensor(list(idfs.values()))
+        else:
+            table = torch.tensor(idfs, dtype=torch.float32)
+        # derived from the data, so it is not part of the checkpoints
+        self.register_buffer('idfs', table, persistent=False)
+
+    def forward(self, query, doc):
+        """Compute the interaction matrices, padding (id 0) never matches.
+
+        Args:
+            query: a (batch_size x max_q_len) tensor of integer ids.
+            doc: a (batch_size x max_d_len) tensor of integer ids.
+
+        Returns:
+            torch.Tensor: a (batch_size x max_d_len x max_q_len) tensor.
+        """
+        query_idfs = self.idfs[query] * (query != 0)
+        matches = doc.unsqueeze(-1) == query.unsqueeze(1)
+        return matches * query_idfs.unsqueeze(1)
+
+
+class _SharedCounter(object):
+    """A counter that can be incremented from several threads, e.g. by the replicas of DataParallel."""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.value += n
+
+    def __getstate__(self):
+        return self.value
+
+    def __setstate__(self, value):
+        self.value = value
+        self.lock = threading.Lock()
+
 
 class DuetV2Local(torch.nn.Module):
     """The local part of the Duet model which is trained on a query - document interaction matrix.
     """
 
-    def __init__(self, h_dim, max_q_len, max_d_len, dropout_rate):
+    def __init__(self, h_dim, max_q_len, max_d_len, dropout_rate, length_adaptive=False, sparse_imat=False,
+                 zero_overlap_shortcut=True):
         """Constructs the local duet module.
 
         Args:
@@ -82,8 +298,23 @@ class DuetV2Local(torch.nn.Module):
             max_q_len (int): the maximum number of tokens in the query.
             max_d_len (int): the maximum number of tokens in the document.
             dropout_rate (float): dropout rate for all dropout layers.
+            length_adaptive (bool): accept smaller interaction matrices and pad them to the maximum lengths.
+            sparse_imat (bool): interaction matrices are passed as (batch_size x max matches x 3) tensors of
+            (doc_pos, query_pos, idf) rows, padded with zeros (see data_source.sparse_interaction_matrices).
+            zero_overlap_shortcut (bool): when not training and without gradients, rows without any match get the
+            cached output of an empty interaction matrix instead of being passed through the layers.
         """
         super().__init__()
+        self.max_q_len = max_q_len
+        self.max_d_len = max_d_len
+        self.length_adaptive = length_adaptive
+        self.sparse_imat = sparse_imat
+        self.zero_overlap_shortcut = zero_overlap_shortcut
+
+        # shared with the DataParallel replicas, which copy the attributes of the module shallowly
+        self._shortcut_counter = _SharedCounter()
+        self._zero_output = None
+        self._zero_output_key = None
 
         self.conv1d = nn.Conv1d(max_d_len, h_dim, kernel_size=1)
         self.relu = nn.ReLU()
@@ -92,8 +323,48 @@ class DuetV2Local(torch.nn.Module):
         self.linear_0 = nn.Linear(h_dim * max_q_len, h_dim)
         self.linear_1 = nn.Linear(h_dim, h_dim)
 
-    def forward(self, imat):
-        x = self.conv1d(imat)
+    def _sparse_conv1d(self, rows, doc_pos, query_pos, values, batch_size):
+        """Compute conv1d of sparse interaction matrices. The kernel size is 1, so this is the product of a sparse
+        (batch_size * max_q_len x max_d_len) matrix of the matches with the dense weights.
+        """
+        matches = torch.sparse_coo_tensor(torch.stack([rows * self.max_q_len + query_pos, doc_pos]), values,
+                                          (batch_size * self.max_q_len, self.max_d_len))
+        out = torch.sparse.mm(matches, self.conv1d.weight[:, :, 0].t())
+        return out.view(batch_size, self.max_q_len, -1).transpose(1, 2) + self.conv1d.bias.unsqueeze(-1)
+
+    @property
+    def shortcut_rows(self):
+        """The number of rows that took the zero overlap shortcut, also counting those of DataParallel replicas. Reset
+        by setting it to 0.
+        """
+        return self._shortcut_counter.value
+
+    @shortcut_rows.setter
+    def shortcut_rows(self, value):
+        self._shortcut_counter.value = value
+
+    def _has_matches(self, imat):
+        """Return a mask of the rows of a dense or packed sparse batch that have at least one match."""
+        if self.sparse_imat:
+            # padding has an idf of 0
+            return (imat[:, :, 2] != 0).any(1)
+        return imat.flatten(1).any(1)
+
+    def _zero_overlap_output(self):
+        """Return the output for an interaction matrix without matches. The convolution of zeros is its bias, so
+        this only depends on the biases and weights of the linear layers. It is cached until a parameter or the
+        autocast state changes.
+        """
+        # the output is computed in bf16 under autocast
+        device_type = self.conv1d.bias.device.type
+        key = (torch.is_autocast_enabled(device_type),) + tuple((p.data_ptr(), p._version) for p in self.parameters())
+        if key != self._zero_output_key:
+            bias = self.conv1d.bias.view(1, -1, 1).expand(1, -1, self.max_q_len)
+            self._zero_output = self._layers(bias)
+            self._zero_output_key = key
+        return self._zero_output
+
+    def _layers(self, x):
         x = self.relu(x)
         x = self.flatten(x)
 
@@ -107,6 +378,37 @@ class DuetV2Local(torch.nn.Module):
 
         return self.dropout(x)
 
+    def forward(self, imat):
+        # without dropout every row without a match has the same output
+        if self.zero_overlap_shortcut and not self.training and not torch.is_grad_enabled() and not imat.is_sparse:
+            has_matches = self._has_matches(imat)
+            num_zero = len(imat) - int(has_matches.sum())
+            self._shortcut_counter.add(num_zero)
+            if num_zero > 0:
+                out = self._zero_overlap_output().expand(len(imat), -1).clone()
+                if num_zero < len(imat):
+                    out[has_matches] = self._forward(imat[has_matches])
+                return out
+        return self._forward(imat)
+
+    def _forward(self, imat):
+        if imat.is_sparse:
+            imat = imat.coalesce()
+            rows, doc_pos, query_pos = imat.indices()
+            x = self._sparse_conv1d(rows, doc_pos, query_pos, imat.values(), imat.shape[0])
+        elif self.sparse_imat:
+            rows = torch.arange(len(imat), device=imat.device).repeat_interleave(imat.shape[1])
+            doc_pos, query_pos, values = imat.reshape(-1, 3).unbind(1)
+            # padding has an idf of 0
+            keep = values != 0
+            x = self._sparse_conv1d(rows[keep], doc_pos[keep].long(), query_pos[keep].long(), values[keep], len(imat))
+        else:
+            if self.length_adaptive:
+                # the layers are sized by the maximum lengths, padding with zeros doesn't change the result
+                imat = F.pad(imat, (0, self.max_q_len - imat.shape[2], 0, self.max_d_len - imat.shape[1]))
+            x = self.conv1d(imat)
+        return self._layers(x)
+
 
 class DuetV2Distributed(torch.nn.Module):
     """The distributed part of the duet model. It is Trained on distributed representations of query and document i.e.
@@ -115,54 +417,154 @@ class DuetV2Distributed(torch.nn.Module):
 
     def __init__(self, id_to_word, glove_name, glove_cache, glove_dim, h_dim, dropout, pooling_size_doc,
                  pooling_size_query,
-                 max_d_len):
+                 max_d_len,
+                 length_adaptive=False,
+                 load_glove=True,
+                 pca_dim=None,
+                 num_buckets=None,
+                 num_frequent=0,
+                 idfs=None,
+                 sparse_embeddings=False,
+                 freeze_embeddings=False):
         """
 
         Args:
             id_to_word: a mapping from all integer ids in the vocabulary to tokens.
-            glove_name: version of the pre-trained glove vectors to use. One of: ['42B', '840B', 'twitter.27B', '6B']
+            glove_name: version of the pre-trained glove vectors to use. One of: ['42B', '840B', 'twitter.27B', '6B'].
+            If None, the embeddings are initialized randomly.
             glove_cache: the directory to download the glove vectors to.
             h_dim: Hidden dimension across the network.
             dropout: dropout rate for all dropout layers.
             pooling_size_doc: size of the max pooling window for the document after convolution.
             pooling_size_query: size of the max pooling window for the query after convolution.
             max_d_len: input length of documents.
+            length_adaptive: accept inputs of any length. Queries are max pooled over all positions and documents to
+            as many windows as a document of max_d_len has. Padding at the end of the inputs is ignored, so scores
+            don't depend on the length a batch is padded to.
+            load_glove: if False, the embeddings are not initialized from GloVe, e.g. when a checkpoint is loaded.
+            pca_dim: reduce the embedding dimension to this many principal components of the GloVe vectors.
+            num_buckets: if given, use a HashedEmbedding with num_frequent words of their own and this many buckets
+            for the remaining words, the frequent words are the ones with the lowest idfs.
+            num_frequent: the number of words with their own embedding with num_buckets.
+            idfs: an array of idfs indexed by id, used to find the frequent words with num_buckets.
+            sparse_embeddings: compute sparse gradients for the embeddings (see train.build_optimizer).
+            freeze_embeddings: do not train the embeddings.
         """
         super().__init__()
         self.flatten = nn.Flatten()
         self.dropout = nn.Dropout(dropout)
         self.relu = nn.ReLU()
 
-        self.glove = GloveEmbedding(id_to_word, glove_name, glove_dim, cache=glove_cache, padding_idx=0)
-        self.conv1d_query = nn.Conv1d(glove_dim, h_dim, kernel_size=3)
+        if num_buckets is None:
+            self.glove = GloveEmbedding(id_to_word, glove_name, glove_dim, freeze=freeze_embeddings, cache=glove_cache,
+                                        padding_idx=0, load_glove=load_glove, pca_dim=pca_dim,
+                                        sparse=sparse_embeddings)
+        else:
+            self.glove = HashedEmbedding(id_to_word, glove_name, glove_dim, num_buckets, num_frequent,
+                                         freeze=freeze_embeddings, cache=glove_cache, padding_idx=0,
+                                         load_glove=load_glove, pca_dim=pca_dim, idfs=idfs, sparse=sparse_embeddings)
+        self.conv1d_query = nn.Conv1d(self.glove.dim, h_dim, kernel_size=3)
         self.linear_query = nn.Linear(h_dim, h_dim)
-        self.max_pool_query = nn.MaxPool1d(pooling_size_query)
 
-        self.conv1d_doc_0 = nn.Conv1d(glove_dim, h_dim, kernel_size=3)
+        self.conv1d_doc_0 = nn.Conv1d(self.glove.dim, h_dim, kernel_size=3)
         self.conv1d_doc_1 = nn.Conv1d(h_dim, h_dim, kernel_size=1)
-        self.max_pool_doc = nn.MaxPool1d(pooling_size_doc, stride=1)
 
         n_pooling_windows = max_d_len - pooling_size_doc - 1
+        self.n_pooling_windows = n_pooling_windows
+        self.length_adaptive = length_adaptive
+        if length_adaptive:
+            # documents are pooled by _max_pool_doc_adaptive
+            self.max_pool_query = nn.AdaptiveMaxPool1d(1)
+        else:
+            self.max_pool_query = nn.MaxPool1d(pooling_size_query)
+            self.max_pool_doc = nn.MaxPool1d(pooling_size_doc, stride=1)
         self.comb_linear_0 = nn.Linear(h_dim * n_pooling_windows, h_dim)
         self.comb_linear_1 = nn.Linear(h_dim, h_dim)
 
-    def forward(self, query, doc):
-        query_embeds = self.glove(query).permute(0, 2, 1)  # swap channel with time dimension for conv1d
-        doc_embeds = self.glove(doc).permute(0, 2, 1)
+    def _pad_short(self, tokens):
+        if self.length_adaptive:
+            # the convolutions need at least 3 positions
+            tokens = F.pad(tokens, (0, max(0, 3 - tokens.shape[1])))
+        return tokens
+
+    @staticmethod
+    def _conv_lengths(tokens):
+        # the number of convolution outputs (kernel size 3) that don't cover padding (id 0) at the end of the rows,
+        # rows shorter than 3 tokens are padded to 3 (see _pad_short)
+        return (tokens != 0).sum(1).clamp(min=3) - 2
+
+    @staticmethod
+    def _mask_padding(x, lengths):
+        # x is the output of a relu, zeros don't change the maximum of the positions that are kept
+        mask = torch.arange(x.shape[2], device=x.device) < lengths.unsqueeze(1)
+        return x * mask.unsqueeze(1).to(x.dtype)
+
+    def _max_pool_doc_adaptive(self, d, lengths):
+        """Max pool each document to n_pooling_windows windows of its own length, i.e. like AdaptiveMaxPool1d does
+        for a document without padding.
+
+        Args:
+            d: a (batch_size x h_dim x positions) tensor.
+            lengths: a (batch_size,) tensor of the number of positions of each document that are not padding.
+
+        Returns:
+            torch.Tensor: a (batch_size x h_dim x n_pooling_windows) tensor.
+        """
+        num_windows = self.n_pooling_windows
+        windows = torch.arange(num_windows, device=d.device)
+        lengths = lengths.unsqueeze(1)
+        starts = windows * lengths // num_windows
+        ends = ((windows + 1) * lengths + num_windows - 1) // num_windows
+        width = int((ends - starts).max())
+        # windows narrower than the widest one repeat their last position
+        positions = torch.min(starts.unsqueeze(2) + torch.arange(width, device=d.device), (ends - 1).unsqueeze(2))
+        index = positions.view(len(d), 1, -1).expand(-1, d.shape[1], -1)
+        return d.gather(2, index).view(len(d), d.shape[1], num_windows, width).amax(3)
+
+    def encode_query(self, query):
+        """Compute the query representation.
+
+        Args:
+            query: a (batch_size x query length) tensor of integer ids.
+
+        Returns:
+            torch.Tensor: a (batch_size x h_dim) tensor.
+        """
+        # swap channel with time dimension for conv1d
+        query_embeds = self.glove(self._pad_short(query)).permute(0, 2, 1)
 
         q = self.conv1d_query(query_embeds)
         q = self.relu(q)
+        if self.length_adaptive:
+            q = self._mask_padding(q, self._conv_lengths(query))
         q = self.max_pool_query(q)
         q = self.flatten(q)
         q = self.linear_query(q)
-        q = self.relu(q)
+        return self.relu(q)
+
+    def encode_docs(self, doc):
+        """Compute the document representation. It doesn't depend on the query, so it can be computed once per document
+        and passed to combine() (see DocFeatureStore).
+
+        Args:
+            doc: a (batch_size x doc length) tensor of integer ids.
+
+        Returns:
+            torch.Tensor: a (batch_size x h_dim x pooling windows) tensor.
+        """
+        doc_embeds = self.glove(self._pad_short(doc)).permute(0, 2, 1)
 
         d = self.conv1d_doc_0(doc_embeds)
         d = self.relu(d)
-        d = self.max_pool_doc(d)
+        if self.length_adaptive:
+            d = self._max_pool_doc_adaptive(d, self._conv_lengths(doc))
+        else:
+            d = self.max_pool_doc(d)
         d = self.conv1d_doc_1(d)
-        d = self.relu(d)
+        return self.relu(d)
 
+    def combine(self, q, d):
+        """Combine query and document representations (see encode_query and encode_docs)."""
         x = q.unsqueeze(-1) * d
         x = self.flatten(x)
         x = self.dropout(x)
@@ -177,37 +579,288 @@ class DuetV2Distributed(torch.nn.Module):
 
         return x
 
+    def forward(self, query, doc):
+        return self.combine(self.encode_query(query), self.encode_docs(doc))
+
+
+_glove_reader = {}
+
+
+def _init_glove_reader(path, words, dim):
+    _glove_reader['path'] = path
+    _glove_reader['words'] = words
+    # the first token of each word, words of the 840B vectors may contain spaces
+    _glove_reader['first_tokens'] = {w.split(' ', 1)[0].encode('utf-8') for w in words}
+    _glove_reader['dim'] = dim
+
+
+def _read_glove_block(block):
+    """Parse the lines of a GloVe text file starting in the byte range [start, end) and return the words of the
+    vocabulary among them and their vectors.
+    """
+    start, end = block
+    words, first_tokens, dim = _glove_reader['words'], _glove_reader['first_tokens'], _glove_reader['dim']
+    found, values = [], []
+    with open(_glove_reader['path'], 'rb') as fp:
+        fp.seek(start)
+        if start > 0:
+            # the line crossing start belongs to the previous block
+            fp.seek(start - 1)
+            fp.readline()
+        while fp.tell() < end:
+            line = fp.readline()
+            if not line:
+                break
+            if line.split(b' ', 1)[0] not in first_tokens:
+                continue
+            entries = line.rstrip().rsplit(b' ', dim)
+            word = entries[0].decode('utf-8', errors='replace')
+            if word in words and len(entries) == dim + 1:
+                found.append(word)
+                values.append(b' '.join(entries[1:]))
+    vectors = np.array(b' '.join(values).split(), dtype=np.float32).reshape(len(found), dim)
+    return found, vectors
+
+
+def iter_glove_text(path, words, dim, num_workers=None, block_size=2 ** 26):
+    """Stream a GloVe text file and yield the words of a vocabulary and their vectors in the order of the file. The
+    file is split into blocks of lines that are parsed in parallel, only the vectors of the vocabulary are kept.
+
+    Args:
+        path: the GloVe text file, e.g. glove.840B.300d.txt.
+        words: the words to keep.
+        dim: the dimension of the vectors.
+        num_workers: the number of parsing processes, by default the number of CPUs.
+        block_size: the number of bytes per block.
+    """
+    size = os.path.getsize(path)
+    blocks = [(start, min(start + block_size, size)) for start in range(0, size, block_size)]
+    with multiprocessing.Pool(num_workers, initializer=_init_glove_reader, initargs=(path, set(words), dim)) as pool:
+        yield from pool.imap(_read_glove_block, blocks)
+
+
+def _vocab_hash(id_to_word):
+    """Return a hash of the words of a vocabulary in the order of their ids."""
+    h = hashlib.sha1()
+    for idx in sorted(id_to_word):
+        h.update(id_to_word[idx].encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
 
 class GloveEmbedding(torch.nn.Module):
-    def __init__(self, id_to_word, name, dim, freeze=False, cache=None, padding_idx=None):
+    def __init__(self, id_to_word, name, dim, freeze=False, cache=None, padding_idx=None, load_glove=True,
+                 pca_dim=None, sparse=False):
+        """An embedding of a vocabulary initialized with pre-trained GloVe vectors. The vocabulary restricted weight
+        matrix is cached in the GloVe cache directory, keyed by the vocabulary hash, the GloVe name and dimension, so
+        that GloVe is only loaded for the first model of a vocabulary.
+
+        Args:
+            id_to_word: a mapping from all integer ids in the vocabulary to tokens.
+            name: the name of the GloVe vectors. If None, the embeddings are initialized randomly.
+            dim: the embedding dimension.
+            freeze: do not train the embeddings.
+            cache: the directory of the GloVe vectors and the cached weights.
+            padding_idx: the id whose embedding is zero.
+            load_glove: if False, neither GloVe nor the cached weights are loaded and the weights are left
+            uninitialized, e.g. when they are restored from a checkpoint.
+            pca_dim: project the GloVe vectors to this many principal components (at most dim), which is the embedding
+            dimension. The components are those of the words found in GloVe.
+            sparse: compute sparse gradients, which only contain the rows of the ids in the batch.
+        """
         super().__init__()
+        if pca_dim is not None and pca_dim > dim:
+            raise ValueError('pca_dim {} exceeds the GloVe dimension {}'.format(pca_dim, dim))
         self.id_to_word = id_to_word
         self.name = name
-        self.dim = dim
+        self.glove_dim = dim
+        self.dim = pca_dim or dim
         self.padding_idx = padding_idx
-        self.glove = vocab.GloVe(name=name, dim=dim, cache=cache)
-        weights = self._get_weights()
-        self.embedding = torch.nn.Embedding.from_pretrained(weights, freeze=freeze)
-
-    def _get_weights(self):
-        weights = []
-        i = 0
-        for idx in sorted(self.id_to_word):
-            word = self.id_to_word[idx]
-            if i == self.padding_idx:
-                weights.append(torch.zeros([self.dim]))
-                i += 1
-                continue
-            if word in self.glove.stoi:
-                glove_idx = self.glove.stoi[word]
-                weights.append(self.glove.vectors[glove_idx])
-                i += 1
-            else:
-                # initialize randomly
-                weights.append(torch.zeros([self.dim]).uniform_(-0.25, 0.25))
-        print(f'Imported {i} words from GloVe')
-        # this converts a list of tensors to a new tensor
-        return torch.stack(weights)
+        if not load_glove:
+            weights = torch.empty([len(id_to_word), self.dim])
+        elif name is None:
+            weights = torch.zeros([len(id_to_word), self.dim]).uniform_(-0.25, 0.25)
+            if padding_idx is not None:
+                weights[padding_idx] = 0
+        else:
+            weights, imported = self._cached_weights(cache or '.vector_cache')
+            if pca_dim is not None:
+                weights = self._project(weights, imported)
+        self.embedding = torch.nn.Embedding.from_pretrained(weights, freeze=freeze, sparse=sparse)
+
+    def _cached_weights(self, cache):
+        """Load the vocabulary restricted weights and the mask of the rows imported from GloVe from the cache, or build
+        them from GloVe and cache them.
+        """
+        file_name = 'glove.{}.{}d.vocab_{}.pt'.format(self.name, self.glove_dim, _vocab_hash(self.id_to_word))
+        path = os.path.join(cache, file_name)
+        if os.path.isfile(path):
+            cached = torch.load(path)
+            # older caches only contain the weights, they are rebuilt
+            if isinstance(cached, dict):
+                print(f'Loading cached GloVe weights from {path}')
+                return cached['weights'], cached['imported']
+
+        weights, imported = self._get_weights(cache)
+        os.makedirs(cache, exist_ok=True)
+        # write to a temporary file first, so that concurrent runs never read a partial file
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        torch.save({'weights': weights, 'imported': imported}, tmp_path)
+        os.replace(tmp_path, path)
+        return weights, imported
+
+    def _project(self, weights, imported):
+        """Project the weights to the first principal components of the imported GloVe vectors, the padding embedding
+        stays zero. The random vectors of words not in GloVe are projected as well, but don't shape the components.
+        """
+        rows = imported.clone()
+        if self.padding_idx is not None:
+            rows[self.padding_idx] = False
+        if rows.sum() < self.dim:
+            # too few GloVe vectors for as many components
+            rows = torch.ones(len(weights), dtype=torch.bool)
+            if self.padding_idx is not None:
+                rows[self.padding_idx] = False
+        mean = weights[rows].mean(0)
+        _, s, v = torch.linalg.svd(weights[rows] - mean, full_matrices=False)
+        weights = (weights - mean) @ v[:self.dim].t()
+        if self.padding_idx is not None:
+            weights[self.padding_idx] = 0
+        explained = (s[:self.dim] ** 2).sum() / (s ** 2).sum()
+        print(f'Projected GloVe to {self.dim} dimensions ({explained:.1%} of the variance)')
+        return weights
+
+    def _get_weights(self, cache):
+        """Build the weights of the vocabulary from the GloVe vectors in the cache directory. The vectors are read
+        from torchtext's serialized vectors (memory mapped) or streamed from the text file if only that exists,
+        otherwise torchtext downloads them. Words not in GloVe are initialized randomly.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: the weights and a boolean mask of the rows imported from GloVe.
+        """
+        word_rows = {}
+        for row, idx in enumerate(sorted(self.id_to_word)):
+            word_rows.setdefault(self.id_to_word[idx], []).append(row)
+        weights = torch.zeros([len(self.id_to_word), self.glove_dim]).uniform_(-0.25, 0.25)
+        imported = set()
+
+        def fill(words, vectors):
+            rows, glove_rows = [], []
+            for i, word in enumerate(words):
+                if word in word_rows:
+                    rows.extend(word_rows[word])
+                    glove_rows.extend([i] * len(word_rows[word]))
+            weights[rows] = torch.as_tensor(vectors[glove_rows])
+            imported.update(rows)
+
+        txt_path = os.path.join(cache, 'glove.{}.{}d.txt'.format(self.name, self.glove_dim))
+        if os.path.isfile(txt_path + '.pt'):
+            itos, _, vectors, _ = torch.load(txt_path + '.pt', mmap=True)
+            fill(itos, vectors)
+        elif os.path.isfile(txt_path):
+            for words, vectors in iter_glove_text(txt_path, word_rows, self.glove_dim):
+                fill(words, vectors)
+        else:
+            glove = vocab.GloVe(name=self.name, dim=self.glove_dim, cache=cache)
+            fill(glove.itos, glove.vectors)
+
+        if self.padding_idx is not None:
+            weights[self.padding_idx] = 0
+            imported.add(self.padding_idx)
+        print(f'Imported {len(imported)} words from GloVe')
+        mask = torch.zeros(len(weights), dtype=torch.bool)
+        mask[list(imported)] = True
+        return weights, mask
 
     def forward(self, x):
         return self.embedding(x)
+
+
+class HashedEmbedding(torch.nn.Module):
+    def __init__(self, id_to_word, name, dim, num_buckets, num_frequent=0, freeze=False, cache=None, padding_idx=None,
+                 load_glove=True, pca_dim=None, idfs=None, sparse=False):
+        """An embedding with a fixed number of rows, independent of the vocabulary size. The most frequent words have
+        their own rows and the remaining words are hashed into num_buckets shared rows. Rows of frequent words are
+        initialized with their GloVe vectors and buckets with the mean GloVe vector of their words.
+
+        Args:
+            id_to_word: a mapping from all integer ids in the vocabulary to tokens.
+            name: the name of the GloVe vectors. If None, the embeddings are initialized randomly.
+            dim: the dimension of the GloVe vectors.
+            num_buckets: the number of rows shared by the words that are not frequent.
+            num_frequent: the number of words with their own row.
+            freeze: do not train the embeddings.
+            cache: the directory of the GloVe vectors and the cached weights.
+            padding_idx: the id whose embedding is zero, it always has its own row.
+            load_glove: if False, the weights are left uninitialized, e.g. when they are restored from a checkpoint.
+            pca_dim: project the GloVe vectors to this many principal components (at most dim), which is the embedding
+            dimension.
+            idfs: an array of idfs indexed by id. The frequent words are the ones with the lowest idf, without idfs they
+            are the lowest ids.
+            sparse: compute sparse gradients, which only contain the rows of the ids in the batch.
+        """
+        super().__init__()
+        if pca_dim is not None and pca_dim > dim:
+            raise ValueError('pca_dim {} exceeds the GloVe dimension {}'.format(pca_dim, dim))
+        self.dim = pca_dim or dim
+        self.num_buckets = num_buckets
+        self.padding_idx = padding_idx
+
+        # the row of each id, part of the checkpoints as the frequent words depend on the idfs
+        rows, num_own = self._assign_rows(id_to_word, num_frequent, idfs)
+        self.register_buffer('rows', torch.from_numpy(rows))
+        num_rows = num_own + num_buckets
+        if not load_glove:
+            weights = torch.empty([num_rows, self.dim])
+        elif name is None:
+            weights = torch.zeros([num_rows, self.dim]).uniform_(-0.25, 0.25)
+        else:
+            vectors = GloveEmbedding(id_to_word, name, dim, freeze=True, cache=cache, padding_idx=padding_idx,
+                                     pca_dim=pca_dim).embedding.weight
+            counts = torch.bincount(self.rows, minlength=num_rows).unsqueeze(-1)
+            weights = torch.zeros([num_rows, self.dim]).index_add_(0, self.rows, vectors) / counts.clamp(min=1)
+            # buckets without words are never used
+            weights[counts[:, 0] == 0] = 0
+        if padding_idx is not None:
+            weights[rows[padding_idx]] = 0
+        self.embedding = torch.nn.Embedding.from_pretrained(weights, freeze=freeze, sparse=sparse)
+
+        full_bytes = len(id_to_word) * self.dim * 4
+        print('Hashed embedding: {} rows ({} words with their own row, {} buckets), {:.1f} MB of weights, {:.1f} MB '
+              'with gradients and Adam state (full vocabulary: {:.1f} MB of weights)'.format(
+                  num_rows, num_own, num_buckets, self.memory_bytes() / 2 ** 20, 4 * self.memory_bytes() / 2 ** 20,
+                  full_bytes / 2 ** 20))
+
+    def _assign_rows(self, id_to_word, num_frequent, idfs):
+        """Return the row of each id and the number of ids with their own row."""
+        n = len(id_to_word)
+        if idfs is None:
+            candidates = np.arange(n)
+        else:
+            # ids without an idf don't occur in the data
+            idfs = np.asarray(idfs, dtype=np.float64)[:n]
+            order = np.full(n, np.inf)
+            order[:len(idfs)] = np.where(idfs > 0, idfs, np.inf)
+            candidates = np.argsort(order, kind='stable')
+        # the padding row comes on top of the frequent words, so the number of rows doesn't depend on the idfs
+        candidates = candidates[candidates != self.padding_idx]
+        own = np.zeros(n, dtype=bool)
+        own[candidates[:num_frequent]] = True
+        if self.padding_idx is not None:
+            own[self.padding_idx] = True
+
+        rows = np.empty(n, dtype=np.int64)
+        num_own = int(own.sum())
+        rows[own] = np.arange(num_own)
+        words = [id_to_word[idx] for idx in sorted(id_to_word)]
+        # a hash of the word rather than the id, so that the buckets don't depend on the vocabulary order
+        rows[~own] = [num_own + zlib.crc32(words[i].encode('utf-8')) % self.num_buckets for i in np.flatnonzero(~own)]
+        return rows, num_own
+
+    def memory_bytes(self):
+        """Return the size of the weights in bytes."""
+        weight = self.embedding.weight
+        return weight.numel() * weight.element_size()
+
+    def forward(self, x):
+        return self.embedding(self.rows[x])
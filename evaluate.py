@@ -1,22 +1,45 @@
 import argparse
+import os
 
 import torch
 from torch.utils.data import DataLoader
 
-from data_source import DuetHdf5Testset
-from duetv2_model import DuetV2
+from data_source import BatchPrefetcher, BlockShuffleBatchSampler, DuetHdf5BatchTestset, DuetHdf5GroupedTestset, \
+    DuetHdf5Testset, DuetMmapTestset, LengthBucketBatchSampler, QueryGroupBatchSampler, collate_batch, \
+    collate_sparse, collate_trimmed, load_idfs
+from duetv2_model import CandidateScorer, model_from_train_args
 from qa_utils.evaluation import read_args, evaluate_all
-from qa_utils.io import get_cuda_device, load_pkl_file
+from qa_utils.io import get_cuda_device
 
 if __name__ == '__main__':
     ap = argparse.ArgumentParser()
-    ap.add_argument('DEV_DATA', help='Dev data hdf5 filepath.')
-    ap.add_argument('TEST_DATA', help='Test data hdf5 filepath.')
+    ap.add_argument('DEV_DATA', help='Dev data hdf5 filepath, or a directory created by hdf5_to_mmap.py.')
+    ap.add_argument('TEST_DATA', help='Test data hdf5 filepath, or a directory created by hdf5_to_mmap.py.')
     ap.add_argument('WORKING_DIR', help='Working directory containing args.csv and a ckpt folder.')
     ap.add_argument('--mrr_k', type=int, default=10, help='Compute MRR@k')
     ap.add_argument('--batch_size', type=int, default=1024, help='Batch size')
     ap.add_argument('--interval', type=int, default=1, help='Only evaluate every i-th checkpoint.')
     ap.add_argument('--num_workers', type=int, default=1, help='number of workers used by the dataloader.')
+    ap.add_argument('--batch_reads', default=False, action='store_true',
+                    help='Read whole batches of consecutive samples from the hdf5 file at once.')
+    ap.add_argument('--group_by_query', default=False, action='store_true',
+                    help='Batch the candidates of each query together and encode every query only once.')
+    ap.add_argument('--bucket_by_length', default=False, action='store_true',
+                    help='With --batch_reads and a length adaptive model, batch samples of similar document length.')
+    ap.add_argument('--chunk_cache_bytes', type=int, help='Size of the hdf5 chunk cache per dataset.')
+    ap.add_argument('--preload', default=False, action='store_true',
+                    help='Read the whole hdf5 file into memory once.')
+    ap.add_argument('--preload_max_bytes', type=int, default=2 ** 32,
+                    help='Read lazily if the preloaded data is estimated to exceed this many bytes.')
+    ap.add_argument('--prefetch_batches', type=int, default=0,
+                    help='Number of batches whose inputs are moved to the device in a background thread ahead of time '
+                         '(0 to disable).')
+    ap.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32',
+                    help='Run the model in bf16 autocast, the weights and the scores stay in fp32.')
+    ap.add_argument('--bf16_imat', default=False, action='store_true',
+                    help='Move the interaction matrices to the device in bf16 (requires --precision bf16).')
+    ap.add_argument('--bf16_embeddings', default=False, action='store_true',
+                    help='Store the embeddings in bf16 (requires --precision bf16).')
     args = ap.parse_args()
 
     train_args = read_args(args.WORKING_DIR)
@@ -24,27 +47,84 @@ if __name__ == '__main__':
     max_q_len = int(train_args['max_q_len'])
     max_d_len = int(train_args['max_d_len'])
 
-    idfs = load_pkl_file(train_args['IDF_FILE'])
-    dev_set = DuetHdf5Testset(args.DEV_DATA, max_q_len, max_d_len, idfs)
-    test_set = DuetHdf5Testset(args.TEST_DATA, max_q_len, max_d_len, idfs)
+    # runs trained before this option existed don't have it in their args.csv, unset options are empty
+    imat_in_model = train_args.get('imat_in_model') == 'True'
+    length_adaptive = train_args.get('length_adaptive') == 'True'
+    sparse_imat = train_args.get('sparse_imat') == 'True'
+    if args.bucket_by_length and not (args.batch_reads and length_adaptive):
+        ap.error('--bucket_by_length requires --batch_reads and a model trained with --length_adaptive.')
+    if args.group_by_query and (args.batch_reads or args.bucket_by_length):
+        ap.error('--group_by_query can not be combined with --batch_reads or --bucket_by_length.')
+    if (args.bf16_imat or args.bf16_embeddings) and args.precision != 'bf16':
+        ap.error('--bf16_imat and --bf16_embeddings require --precision bf16.')
+    if args.bf16_imat and (args.prefetch_batches == 0 or sparse_imat or imat_in_model):
+        # the sparse form stores the positions of the matches as floats
+        ap.error('--bf16_imat requires --prefetch_batches > 0 and dense interaction matrices computed by the '
+                 'dataloader.')
 
-    dev_dl = DataLoader(dev_set, batch_size=args.batch_size, shuffle=True, pin_memory=True,
-                        num_workers=args.num_workers)
-    test_dl = DataLoader(test_set, batch_size=args.batch_size, shuffle=True, pin_memory=True,
-                         num_workers=args.num_workers)
+    idfs = load_idfs(train_args['IDF_FILE'])
+    if os.path.isdir(args.DEV_DATA):
+        if args.batch_reads or args.group_by_query:
+            ap.error('--batch_reads and --group_by_query are only supported for hdf5 files.')
+        dev_set = DuetMmapTestset(args.DEV_DATA, max_q_len, max_d_len, idfs, build_imat=not imat_in_model,
+                                  sparse_imat=sparse_imat)
+        test_set = DuetMmapTestset(args.TEST_DATA, max_q_len, max_d_len, idfs, build_imat=not imat_in_model,
+                                   sparse_imat=sparse_imat)
+    else:
+        if args.group_by_query:
+            dataset_cls = DuetHdf5GroupedTestset
+        else:
+            dataset_cls = DuetHdf5BatchTestset if args.batch_reads else DuetHdf5Testset
+        dev_set = dataset_cls(args.DEV_DATA, max_q_len, max_d_len, idfs, build_imat=not imat_in_model,
+                              chunk_cache_bytes=args.chunk_cache_bytes, preload=args.preload,
+                              preload_max_bytes=args.preload_max_bytes, sparse_imat=sparse_imat)
+        test_set = dataset_cls(args.TEST_DATA, max_q_len, max_d_len, idfs, build_imat=not imat_in_model,
+                               chunk_cache_bytes=args.chunk_cache_bytes, preload=args.preload,
+                               preload_max_bytes=args.preload_max_bytes, sparse_imat=sparse_imat)
+
+    if args.group_by_query:
+        dev_dl = DataLoader(dev_set, batch_sampler=QueryGroupBatchSampler(dev_set.q_ids[:], args.batch_size),
+                            collate_fn=collate_batch, pin_memory=True, num_workers=args.num_workers)
+        test_dl = DataLoader(test_set, batch_sampler=QueryGroupBatchSampler(test_set.q_ids[:], args.batch_size),
+                             collate_fn=collate_batch, pin_memory=True, num_workers=args.num_workers)
+    elif args.batch_reads:
+        # the order of the candidates doesn't matter for the metrics, so the batches can be consecutive or sorted by
+        # length
+        def batch_sampler(dataset):
+            if args.bucket_by_length:
+                return LengthBucketBatchSampler(dataset.sample_lengths(), args.batch_size, shuffle=False)
+            return BlockShuffleBatchSampler(len(dataset), args.batch_size, shuffle=False)
+
+        collate_fn = collate_trimmed if length_adaptive else collate_batch
+        dev_dl = DataLoader(dev_set, batch_sampler=batch_sampler(dev_set), collate_fn=collate_fn, pin_memory=True,
+                            num_workers=args.num_workers)
+        test_dl = DataLoader(test_set, batch_sampler=batch_sampler(test_set), collate_fn=collate_fn, pin_memory=True,
+                             num_workers=args.num_workers)
+    else:
+        # samples with sparse interaction matrices differ in size
+        collate_fn = collate_sparse if sparse_imat and not imat_in_model else None
+        dev_dl = DataLoader(dev_set, batch_size=args.batch_size, shuffle=True, collate_fn=collate_fn, pin_memory=True,
+                            num_workers=args.num_workers)
+        test_dl = DataLoader(test_set, batch_size=args.batch_size, shuffle=True, collate_fn=collate_fn,
+                             pin_memory=True, num_workers=args.num_workers)
 
     device = get_cuda_device()
+    if args.prefetch_batches > 0:
+        imat_dtype = torch.bfloat16 if args.bf16_imat else None
+        # only the inputs, q_ids and labels stay on the cpu
+        dev_dl = BatchPrefetcher(dev_dl, device, args.prefetch_batches, imat_dtype, fields=[1])
+        test_dl = BatchPrefetcher(test_dl, device, args.prefetch_batches, imat_dtype, fields=[1])
 
-    id_to_word = load_pkl_file(train_args['VOCAB_FILE'])
-    model = DuetV2(id_to_word=id_to_word,
-                   glove_name=train_args['glove_name'],
-                   glove_cache=train_args['glove_cache'],
-                   glove_dim=int(train_args['glove_dim']),
-                   h_dim=int(train_args['hidden_dim']),
-                   max_q_len=int(train_args['max_q_len']),
-                   max_d_len=int(train_args['max_d_len']),
-                   dropout_rate=float(train_args['dropout']))
+    # the model is not trained here, so the embeddings can always be frozen
+    model = model_from_train_args(train_args, idfs, freeze_embeddings=True, precision=args.precision,
+                                  bf16_embeddings=args.bf16_embeddings)
     model.to(device)
-    model = torch.nn.DataParallel(model)
+    if args.group_by_query:
+        # the candidates of a batch refer to its queries by index, so the batch can't be split by DataParallel
+        model = CandidateScorer(model)
+    else:
+        model = torch.nn.DataParallel(model)
     evaluate_all(model, args.WORKING_DIR, dev_dl, test_dl, args.mrr_k, device, has_multiple_inputs=True,
                  interval=args.interval)
+    print('{} candidates without query overlap skipped the local model'.format(
+        model.module.local_model.shortcut_rows))
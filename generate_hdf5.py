@@ -17,12 +17,26 @@ if __name__ == '__main__':
     ap.add_argument('--vocab_size', type=int, default=80000,
                     help='Only use the n most frequent words for the vocabulary.')
     ap.add_argument('--num_neg_examples', type=int, default=1,
-                    help='For each query sample this many negative documents.')
+                    help='For each query sample this many negative documents (ignored with --dynamic_negatives).')
     ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
     ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document legth.')
     ap.add_argument('--examples_per_query', type=int, choices=[100, 500, 1000, 1500],
                     default=500, help='How many examples per query in the dev- and testset for insurance qa.')
 
+    ap.add_argument('--save_matches', default=False, action='store_true',
+                    help='Store the exact match coordinates of each row to speed up building the interaction matrices.')
+
+    ap.add_argument('--layout_version', type=int, choices=[1, 2], default=1,
+                    help='1: variable length int64 rows, 2: fixed width rows of the narrowest integer type.')
+    ap.add_argument('--chunk_rows', type=int, help='Rows per hdf5 chunk (layout version 2 only).')
+    ap.add_argument('--compression', choices=['gzip', 'lzf'], help='Hdf5 compression filter (layout version 2 only).')
+
+    ap.add_argument('--normalize', default=False, action='store_true',
+                    help='Store unique queries and documents once and reference them from the rows.')
+
+    ap.add_argument('--dynamic_negatives', default=False, action='store_true',
+                    help='Only store positive pairs in the train set and sample negatives at training time.')
+
     ap.add_argument('--no_train', default=False, action='store_true', help='Don\'t export the train set.')
     ap.add_argument('--no_dev', default=False, action='store_true', help='Don\'t export the dev set.')
     ap.add_argument('--no_test', default=False, action='store_true', help='Don\'t export the test set.')
@@ -63,6 +77,13 @@ if __name__ == '__main__':
                            args.max_d_len,
                            train_outfile=train_path,
                            dev_outfile=dev_path,
-                           test_outfile=test_path)
+                           test_outfile=test_path,
+                           idf_array_outfile=os.path.join(args.OUTPUT_DIR, 'idfs.npy'),
+                           save_matches=args.save_matches,
+                           layout_version=args.layout_version,
+                           chunk_rows=args.chunk_rows,
+                           compression=args.compression,
+                           normalize=args.normalize,
+                           dynamic_negatives=args.dynamic_negatives)
 
     saver.build_all()
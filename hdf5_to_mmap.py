@@ -0,0 +1,84 @@
+import os
+from argparse import ArgumentParser
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+# variable length fields, stored as a flat token array plus row offsets
+TOKEN_FIELDS = ['queries', 'pos_docs', 'neg_docs', 'docs', 'query_table', 'doc_table']
+MATCH_FIELDS = ['pos_matches', 'neg_matches', 'matches']
+# fixed size fields, stored as they are
+ARRAY_FIELDS = ['q_ids', 'labels', 'query_refs', 'doc_refs', 'pos_doc_refs', 'neg_doc_refs']
+
+
+def _iter_rows(fp, name, batch_size):
+    """Iterate over the unpadded rows of a variable length field in either hdf5 layout version."""
+    dataset = fp[name]
+    for start in range(0, len(dataset), batch_size):
+        rows = dataset[start:start + batch_size]
+        if dataset.ndim == 2:
+            # fixed width layout (version 2)
+            lengths = fp[name + '_lengths'][start:start + batch_size]
+            yield from (row[:length] for row, length in zip(rows, lengths))
+        else:
+            yield from rows
+
+
+def convert_field(fp, name, out_dir, batch_size):
+    """Write a variable length field as <name>.tokens.npy and <name>.offsets.npy. Token ids are stored with the
+    narrowest unsigned integer type that fits them.
+
+    Args:
+        fp: the hdf5 file.
+        name: the name of the field.
+        out_dir: the output directory.
+        batch_size: the number of rows to read at once.
+    """
+    n = len(fp[name])
+    lengths = np.zeros(n, dtype=np.int64)
+    max_value = 0
+    for i, row in enumerate(tqdm(_iter_rows(fp, name, batch_size), total=n, desc='{} (pass 1)'.format(name))):
+        lengths[i] = len(row)
+        if len(row) > 0:
+            max_value = max(max_value, int(row.max()))
+
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(os.path.join(out_dir, name + '.offsets.npy'), offsets)
+
+    dtype = np.int16 if name in MATCH_FIELDS else np.min_scalar_type(max_value)
+    tokens = np.lib.format.open_memmap(os.path.join(out_dir, name + '.tokens.npy'), mode='w+', dtype=dtype,
+                                       shape=(int(offsets[-1]),))
+    for i, row in enumerate(tqdm(_iter_rows(fp, name, batch_size), total=n, desc='{} (pass 2)'.format(name))):
+        tokens[offsets[i]:offsets[i + 1]] = row
+    tokens.flush()
+
+
+def convert(hdf5_file, out_dir, batch_size):
+    """Convert a train or candidate set written by generate_hdf5.py into the flat memory-mapped format read by
+    DuetMmapTrainset and DuetMmapTestset.
+
+    Args:
+        hdf5_file: the hdf5 file.
+        out_dir: the output directory.
+        batch_size: the number of rows to read at once.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with h5py.File(hdf5_file, 'r') as fp:
+        for name in TOKEN_FIELDS + MATCH_FIELDS:
+            if name in fp:
+                convert_field(fp, name, out_dir, batch_size)
+        for name in ARRAY_FIELDS:
+            if name in fp:
+                np.save(os.path.join(out_dir, name + '.npy'), fp[name][:])
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser(description='Convert an hdf5 file written by generate_hdf5.py into flat memory-mapped arrays.')
+    ap.add_argument('HDF5_FILE', help='The train, dev or test hdf5 file.')
+    ap.add_argument('OUTPUT_DIR', help='Directory to store the arrays in.')
+    ap.add_argument('--batch_size', type=int, default=100000, help='Number of rows to read at once.')
+    args = ap.parse_args()
+
+    convert(args.HDF5_FILE, args.OUTPUT_DIR, args.batch_size)
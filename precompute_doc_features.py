@@ -0,0 +1,91 @@
+import os
+from argparse import ArgumentParser
+
+import h5py
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from data_source import DocFeatureStore
+from duetv2_model import model_from_train_args
+from qa_utils.evaluation import read_args
+from qa_utils.io import get_cuda_device
+
+
+def _read_docs(dataset, start, stop, max_len):
+    """Read rows of token ids in either hdf5 layout version, zero padded or truncated to max_len."""
+    if dataset.ndim == 2:
+        rows = dataset[start:stop, :max_len].astype(np.int64)
+        return np.pad(rows, ((0, 0), (0, max_len - rows.shape[1])))
+    docs = np.zeros((stop - start, max_len), dtype=np.int64)
+    for i, row in enumerate(dataset[start:stop]):
+        docs[i, :min(len(row), max_len)] = row[:max_len]
+    return docs
+
+
+def read_doc_ids(fp):
+    """Read the document ids of the doc_table of a normalized file and their rows (see DuetHhdf5Saver)."""
+    doc_ids = fp['doc_ids']
+    doc_ids = doc_ids.asstr()[:].astype(str) if h5py.check_string_dtype(doc_ids.dtype) else doc_ids[:]
+    return doc_ids, fp['doc_id_refs'][:].astype(np.int64)
+
+
+def precompute(model, dataset, out_dir, max_d_len, batch_size, device, dtype=np.float32, doc_ids=None, rows=None):
+    """Compute the document features of a dataset of documents and store them in a DocFeatureStore.
+
+    Args:
+        model: the DuetV2 model.
+        dataset: the hdf5 dataset of documents.
+        out_dir: the directory of the store.
+        max_d_len: pad documents to this length.
+        batch_size: the number of documents encoded at once.
+        device: the device to run the model on.
+        dtype: the type the features are stored as.
+        doc_ids: the ids of the documents, see read_doc_ids. If None, the row indices are the ids.
+        rows: the row of the dataset of each document id.
+    """
+    model.eval()
+    if doc_ids is None:
+        doc_ids = rows = np.arange(len(dataset))
+    # in the order of the rows, so that every batch is read with a single contiguous read
+    order = np.argsort(rows, kind='stable')
+    doc_ids, rows = doc_ids[order], rows[order]
+    with torch.no_grad():
+        shape = model.encode_docs(torch.zeros((1, max_d_len), dtype=torch.int64, device=device)).shape[1:]
+        features = DocFeatureStore.create(out_dir, doc_ids, shape, dtype)
+        for start in tqdm(range(0, len(doc_ids), batch_size)):
+            batch_rows = rows[start:start + batch_size]
+            docs = _read_docs(dataset, batch_rows[0], batch_rows[-1] + 1, max_d_len)[batch_rows - batch_rows[0]]
+            docs = torch.from_numpy(docs).to(device)
+            features[start:start + len(batch_rows)] = model.encode_docs(docs).cpu().numpy().astype(dtype)
+    features.flush()
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser(description='Precompute the query independent document features of a trained model.')
+    ap.add_argument('WORKING_DIR', help='Working directory containing args.csv.')
+    ap.add_argument('CKPT', help='The checkpoint to use.')
+    ap.add_argument('HDF5_FILE', help='A normalized hdf5 file (or any file containing documents).')
+    ap.add_argument('OUTPUT_DIR', help='Directory to store the features in.')
+    ap.add_argument('--field', default='doc_table',
+                    help='The dataset of documents. The documents of doc_table are stored by the ids in doc_ids, those '
+                         'of other datasets (or files without doc_ids) by their row indices.')
+    ap.add_argument('--batch_size', type=int, default=1024, help='Batch size')
+    ap.add_argument('--float16', default=False, action='store_true', help='Store the features as float16.')
+    args = ap.parse_args()
+
+    train_args = read_args(args.WORKING_DIR)
+    max_d_len = int(train_args['max_d_len'])
+    device = get_cuda_device()
+
+    model = model_from_train_args(train_args)
+    model.load_state_dict(torch.load(args.CKPT, map_location='cpu')['state_dict'])
+    model.to(device)
+
+    with h5py.File(args.HDF5_FILE, 'r') as fp:
+        doc_ids, rows = read_doc_ids(fp) if args.field == 'doc_table' and 'doc_ids' in fp else (None, None)
+        if doc_ids is None:
+            print('no document ids in {}, the rows of {} are the ids'.format(args.HDF5_FILE, args.field))
+        precompute(model, fp[args.field], args.OUTPUT_DIR, max_d_len, args.batch_size, device,
+                   np.float16 if args.float16 else np.float32, doc_ids, rows)
+    print('wrote {}'.format(os.path.join(args.OUTPUT_DIR, 'features.npy')))
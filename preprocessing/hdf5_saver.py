@@ -1,3 +1,5 @@
+import hashlib
+
 import h5py
 import numpy as np
 
@@ -12,8 +14,13 @@ class DuetHhdf5Saver(Hdf5Saver):
     DUET V2.
     """
 
+    # rows per chunk of the resizable tables of normalized files, new table rows are also written in blocks of this size
+    table_chunk_rows = 1024
+
     def __init__(self, dataset: Dataset, tokenizer, max_vocab_size, vocab_outfile, idf_outfile, max_query_len,
-                 max_doc_len, train_outfile=None, dev_outfile=None, test_outfile=None):
+                 max_doc_len, train_outfile=None, dev_outfile=None, test_outfile=None, idf_array_outfile=None,
+                 save_matches=False, layout_version=1, chunk_rows=None, compression=None, compression_opts=None,
+                 normalize=False, dynamic_negatives=False):
         """Construct a hdf5 saver for qa_util Datasets.
 
         Args:
@@ -23,9 +30,43 @@ class DuetHhdf5Saver(Hdf5Saver):
             vocab_outfile: a pickle file where a word to index dictionary will be exported to.
             max_vocab_size: the maximum number of words in the vocabulary, only keeping the most frequent ones. Uses all
             if None.
+            idf_outfile: a pickle file where a token id to idf dictionary will be exported to.
+            idf_array_outfile: a .npy file where the idfs will be exported to as a dense float32 array indexed by token
+            id. Skipped if None.
+            save_matches: additionally store the (doc_pos, query_pos) coordinates of all exact matches between query
+            and document of each row, so the interaction matrices don't have to be recomputed every epoch.
+            layout_version: 1 stores token ids as variable length int64 rows. 2 stores them as zero padded fixed width
+            rows of the narrowest unsigned integer type that fits the vocabulary, plus a separate array of lengths.
+            chunk_rows: number of rows per hdf5 chunk. Chosen by h5py if None.
+            compression: hdf5 compression filter, e.g. 'gzip' or 'lzf' (layout version 2 only).
+            compression_opts: options of the compression filter, e.g. the gzip level.
+            normalize: store each unique query and document once, in query_table and doc_table, and only references to
+            them in the rows (query_refs and doc_refs for dev/test sets, query_refs, pos_doc_refs and neg_doc_refs for
+            the train set). The ids of the documents in doc_table are stored in doc_ids and their rows in doc_id_refs,
+            documents with the same tokens share a row.
+            dynamic_negatives: only store the positive (query, document) pairs of the train set and all documents as a
+            pool to sample negatives from at training time (see data_source.DuetDynamicTrainset). Implies normalize
+            for the train set.
         """
+        if layout_version not in (1, 2):
+            raise ValueError('Unknown layout version {}.'.format(layout_version))
 
         super().__init__(dataset, tokenizer, max_vocab_size, vocab_outfile, train_outfile, dev_outfile, test_outfile)
+        self.save_matches = save_matches
+        self.max_query_len = max_query_len
+        self.max_doc_len = max_doc_len
+        self.layout_version = layout_version
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.normalize = normalize
+        self.dynamic_negatives = dynamic_negatives
+        # map each table to the token digests of its rows and to the rows that are not written yet (see _table_ref),
+        # _tables_path is the file whose tables are not finished yet (see _finish_tables)
+        self._table_refs = {}
+        self._pending_rows = {}
+        self._tables_path = None
+        self.token_dtype = np.min_scalar_type(max(self.word_to_index.values()))
 
         # compute idfs for weighting of the interaction matrix
         vocab_tokens = set(self.word_to_index.keys())
@@ -33,27 +74,193 @@ class DuetHhdf5Saver(Hdf5Saver):
         # map token ids to idfs
         self.idfs = dict(map(lambda x: (self.word_to_index[x[0]], x[1]), self.idfs.items()))
         dump_pkl_file(self.idfs, idf_outfile)
+        if idf_array_outfile is not None:
+            idf_array = np.zeros(max(self.word_to_index.values()) + 1, dtype=np.float32)
+            idf_array[list(self.idfs.keys())] = list(self.idfs.values())
+            np.save(idf_array_outfile, idf_array)
 
         print('tokenizing...')
         self.dataset.transform_docs(lambda x: self._words_to_index(self.tokenizer.tokenize(x))[:max_doc_len])
         self.dataset.transform_queries(lambda x: self._words_to_index(self.tokenizer.tokenize(x)[:max_query_len]))
 
+    def _define_token_dataset(self, dataset_fp, name, n_out_examples, max_len, resizable=False):
+        """Create a dataset of token id rows according to the layout version.
+
+        Args:
+            dataset_fp: the hdf5 file.
+            name: the name of the dataset. In layout version 2, the lengths are stored in name + '_lengths'.
+            n_out_examples: the number of rows.
+            max_len: the maximum number of tokens in a row.
+            resizable: create an empty dataset that rows are appended to, see _table_ref.
+        """
+        if resizable:
+            shape, maxshape = (0,), (None,)
+            chunk_rows = self.chunk_rows or self.table_chunk_rows
+        else:
+            shape, maxshape = (n_out_examples,), None
+            chunk_rows = None if self.chunk_rows is None else min(self.chunk_rows, n_out_examples)
+
+        if self.layout_version == 1:
+            vlen_int64 = h5py.special_dtype(vlen=np.dtype('int64'))
+            dataset_fp.create_dataset(name, shape=shape, maxshape=maxshape, dtype=vlen_int64,
+                                      chunks=None if chunk_rows is None else (chunk_rows,))
+            return
+
+        chunks = True if chunk_rows is None else (chunk_rows, max_len)
+        dataset_fp.create_dataset(name, shape=shape + (max_len,),
+                                  maxshape=None if maxshape is None else maxshape + (max_len,), dtype=self.token_dtype,
+                                  chunks=chunks, fillvalue=0, compression=self.compression,
+                                  compression_opts=self.compression_opts)
+        chunks = True if chunk_rows is None else (chunk_rows,)
+        dataset_fp.create_dataset(name + '_lengths', shape=shape, maxshape=maxshape, dtype=np.min_scalar_type(max_len),
+                                  chunks=chunks, compression=self.compression, compression_opts=self.compression_opts)
+
+    def _define_tables(self, dataset_fp):
+        """Create the empty query and document tables of a normalized file."""
+        self._define_token_dataset(dataset_fp, 'query_table', 0, self.max_query_len, resizable=True)
+        self._define_token_dataset(dataset_fp, 'doc_table', 0, self.max_doc_len, resizable=True)
+        self._table_refs = {'query_table': {}, 'doc_table': {}}
+        self._pending_rows = {'query_table': [], 'doc_table': []}
+        self._tables_path = dataset_fp.filename
+
+    @staticmethod
+    def _digest(tokens):
+        return hashlib.blake2b(np.asarray(tokens, dtype=np.int64).tobytes(), digest_size=16).digest()
+
+    def _table_ref(self, fp, table, tokens):
+        """Return the row of a table of unique token id rows that stores the given query or document, appending it if
+        it is not in the table yet. Rows are identified by a digest of their tokens. New rows are written in blocks,
+        see _flush_table.
+
+        Args:
+            fp: the hdf5 file.
+            table: the name of the table.
+            tokens (list(int)): the token ids.
+
+        Returns:
+            int: the row of the table.
+        """
+        key = self._digest(tokens)
+        refs = self._table_refs[table]
+        if key not in refs:
+            pending = self._pending_rows[table]
+            refs[key] = len(fp[table]) + len(pending)
+            pending.append(tokens)
+            if len(pending) >= (self.chunk_rows or self.table_chunk_rows):
+                self._flush_table(fp, table)
+        return refs[key]
+
+    def _flush_table(self, fp, table):
+        """Append the pending rows of a table with a single resize and write."""
+        rows = self._pending_rows[table]
+        if not rows:
+            return
+        start = len(fp[table])
+        stop = start + len(rows)
+        fp[table].resize(stop, axis=0)
+        if self.layout_version == 1:
+            block = np.empty(len(rows), dtype=object)
+            for i, row in enumerate(rows):
+                block[i] = np.asarray(row, dtype=np.int64)
+            fp[table][start:stop] = block
+        else:
+            block = np.zeros((len(rows), fp[table].shape[1]), dtype=self.token_dtype)
+            for i, row in enumerate(rows):
+                block[i, :len(row)] = row
+            fp[table][start:stop] = block
+            fp[table + '_lengths'].resize(stop, axis=0)
+            fp[table + '_lengths'][start:stop] = [len(row) for row in rows]
+        self._pending_rows[table] = []
+
+    def _finish_tables(self):
+        """Write the pending table rows of the last normalized file once it is closed, i.e. before the next set is
+        defined and at the end of build_all.
+        """
+        if self._tables_path is None:
+            return
+        with h5py.File(self._tables_path, 'r+') as fp:
+            for table in self._pending_rows:
+                self._flush_table(fp, table)
+            self._save_doc_ids(fp)
+        self._tables_path = None
+
+    def _save_doc_ids(self, fp):
+        """Store the ids of the documents in doc_table and their rows, e.g. to look up precomputed document features
+        by document id (see precompute_doc_features.py).
+        """
+        refs = self._table_refs['doc_table']
+        doc_ids, rows = [], []
+        for doc_id, tokens in self.dataset.docs.items():
+            row = refs.get(self._digest(tokens))
+            if row is not None:
+                doc_ids.append(doc_id)
+                rows.append(row)
+        if all(isinstance(doc_id, (int, np.integer)) for doc_id in doc_ids):
+            fp.create_dataset('doc_ids', data=np.array(doc_ids, dtype=np.int64))
+        else:
+            fp.create_dataset('doc_ids', data=[str(doc_id) for doc_id in doc_ids], dtype=h5py.string_dtype())
+        fp.create_dataset('doc_id_refs', data=np.array(rows, dtype=np.uint32))
+
+    def build_all(self):
+        super().build_all()
+        self._finish_tables()
+
+    def _save_tokens(self, fp, name, idx, tokens):
+        """Write a row of token ids according to the layout version."""
+        if self.layout_version == 1:
+            fp[name][idx] = tokens
+        else:
+            fp[name][idx, :len(tokens)] = tokens
+            fp[name + '_lengths'][idx] = len(tokens)
+
     def _define_trainset(self, dataset_fp, n_out_examples):
-        vlen_int64 = h5py.special_dtype(vlen=np.dtype('int64'))
-        dataset_fp.create_dataset('queries', shape=(n_out_examples,), dtype=vlen_int64)
-        dataset_fp.create_dataset('pos_docs', shape=(n_out_examples,), dtype=vlen_int64)
-        dataset_fp.create_dataset('neg_docs', shape=(n_out_examples,), dtype=vlen_int64)
+        self._finish_tables()
+        dataset_fp.attrs['layout_version'] = self.layout_version
+        if self.dynamic_negatives:
+            self._train_row = 0
+            self._define_tables(dataset_fp)
+            # every document is a candidate negative
+            for doc in self.dataset.docs.values():
+                self._table_ref(dataset_fp, 'doc_table', doc)
+            self._flush_table(dataset_fp, 'doc_table')
+            dataset_fp.create_dataset('query_refs', shape=(n_out_examples,), dtype=np.dtype('uint32'))
+            dataset_fp.create_dataset('pos_doc_refs', shape=(n_out_examples,), dtype=np.dtype('uint32'))
+        elif self.normalize:
+            self._define_tables(dataset_fp)
+            for name in ['query_refs', 'pos_doc_refs', 'neg_doc_refs']:
+                dataset_fp.create_dataset(name, shape=(n_out_examples,), dtype=np.dtype('uint32'))
+        else:
+            self._define_token_dataset(dataset_fp, 'queries', n_out_examples, self.max_query_len)
+            self._define_token_dataset(dataset_fp, 'pos_docs', n_out_examples, self.max_doc_len)
+            self._define_token_dataset(dataset_fp, 'neg_docs', n_out_examples, self.max_doc_len)
+
+        if self.save_matches:
+            vlen_int16 = h5py.special_dtype(vlen=np.dtype('int16'))
+            dataset_fp.create_dataset('pos_matches', shape=(n_out_examples,), dtype=vlen_int16)
+            dataset_fp.create_dataset('neg_matches', shape=(n_out_examples,), dtype=vlen_int16)
 
     def _define_candidate_set(self, dataset_fp, n_out_examples):
-        vlen_int64 = h5py.special_dtype(vlen=np.dtype('int64'))
-        dataset_fp.create_dataset('queries', shape=(n_out_examples,), dtype=vlen_int64)
-        dataset_fp.create_dataset('docs', shape=(n_out_examples,), dtype=vlen_int64)
+        self._finish_tables()
+        dataset_fp.attrs['layout_version'] = self.layout_version
+        if self.normalize:
+            self._define_tables(dataset_fp)
+            dataset_fp.create_dataset('query_refs', shape=(n_out_examples,), dtype=np.dtype('uint32'))
+            dataset_fp.create_dataset('doc_refs', shape=(n_out_examples,), dtype=np.dtype('uint32'))
+        else:
+            self._define_token_dataset(dataset_fp, 'queries', n_out_examples, self.max_query_len)
+            self._define_token_dataset(dataset_fp, 'docs', n_out_examples, self.max_doc_len)
+
+        if self.save_matches:
+            vlen_int16 = h5py.special_dtype(vlen=np.dtype('int16'))
+            dataset_fp.create_dataset('matches', shape=(n_out_examples,), dtype=vlen_int16)
 
         dataset_fp.create_dataset('q_ids', shape=(n_out_examples,), dtype=np.dtype('int64'))
         dataset_fp.create_dataset('labels', shape=(n_out_examples,), dtype=np.dtype('int64'))
 
     def _n_out_samples(self, dataset):
-        if isinstance(dataset, Trainset):
+        if isinstance(dataset, Trainset) and self.dynamic_negatives:
+            return len(dataset.pos_pairs)
+        elif isinstance(dataset, Trainset):
             # duet trains on triplets i.e. pairs of (q, pos, neg)
             return len(dataset.pos_pairs) * dataset.num_neg_examples
         elif isinstance(dataset, Testset):
@@ -62,16 +269,55 @@ class DuetHhdf5Saver(Hdf5Saver):
             raise TypeError('Dataset needs to be of type Trainset or Testset.')
 
     def _save_train_row(self, fp, query, pos_doc, neg_docs, idx):
-        for neg_ids in neg_docs:
-            fp['queries'][idx] = query
-            fp['pos_docs'][idx] = pos_doc
-            fp['neg_docs'][idx] = neg_ids
+        if self.dynamic_negatives:
+            # one row per positive pair, the negatives are sampled at training time
+            fp['query_refs'][self._train_row] = self._table_ref(fp, 'query_table', query)
+            fp['pos_doc_refs'][self._train_row] = self._table_ref(fp, 'doc_table', pos_doc)
+            self._train_row += 1
+            return
+
+        if self.normalize:
+            query_ref = self._table_ref(fp, 'query_table', query)
+            pos_doc_ref = self._table_ref(fp, 'doc_table', pos_doc)
+        # one row per negative example, starting at idx
+        for i, neg_ids in enumerate(neg_docs):
+            if self.normalize:
+                fp['query_refs'][idx + i] = query_ref
+                fp['pos_doc_refs'][idx + i] = pos_doc_ref
+                fp['neg_doc_refs'][idx + i] = self._table_ref(fp, 'doc_table', neg_ids)
+            else:
+                self._save_tokens(fp, 'queries', idx + i, query)
+                self._save_tokens(fp, 'pos_docs', idx + i, pos_doc)
+                self._save_tokens(fp, 'neg_docs', idx + i, neg_ids)
+            if self.save_matches:
+                fp['pos_matches'][idx + i] = self._match_coordinates(query, pos_doc)
+                fp['neg_matches'][idx + i] = self._match_coordinates(query, neg_ids)
 
     def _save_candidate_row(self, fp, q_id, query, doc, label, idx):
         fp['q_ids'][idx] = q_id
-        fp['queries'][idx] = query
-        fp['docs'][idx] = doc
+        if self.normalize:
+            fp['query_refs'][idx] = self._table_ref(fp, 'query_table', query)
+            fp['doc_refs'][idx] = self._table_ref(fp, 'doc_table', doc)
+        else:
+            self._save_tokens(fp, 'queries', idx, query)
+            self._save_tokens(fp, 'docs', idx, doc)
         fp['labels'][idx] = label
+        if self.save_matches:
+            fp['matches'][idx] = self._match_coordinates(query, doc)
+
+    @staticmethod
+    def _match_coordinates(query, doc):
+        """Find all exact matches between the tokens of a query and a document.
+
+        Args:
+            query (list(int)): the query token ids.
+            doc (list(int)): the document token ids.
+
+        Returns:
+            np.ndarray: the flattened (doc_pos, query_pos) pairs of all matches as int16.
+        """
+        doc_pos, query_pos = np.nonzero(np.equal.outer(doc, query))
+        return np.stack([doc_pos, query_pos], axis=1).ravel().astype(np.int16)
 
     def _words_to_index(self, words, unknown_token='<UNK>'):
         """Turns a list of words into integer indices using self.word_to_index.
@@ -0,0 +1,26 @@
+import torch
+
+from data_source import BatchPrefetcher
+
+
+def _batches():
+    for i in range(3):
+        q_ids = torch.full((4,), i)
+        inputs = [torch.ones(4, 5, dtype=torch.int64), torch.rand(4, 6, 5)]
+        yield q_ids, inputs, torch.rand(4)
+
+
+def test_only_the_given_fields_are_converted():
+    batches = list(_batches())
+    prefetched = list(BatchPrefetcher(batches, 'cpu', dtype=torch.bfloat16, fields=[1]))
+    assert len(prefetched) == len(batches)
+    for (q_ids, inputs, labels), (prefetched_q_ids, prefetched_inputs, prefetched_labels) in zip(batches, prefetched):
+        # e.g. evaluate_all gets the q_ids and labels as the dataloader returns them
+        assert prefetched_q_ids is q_ids and prefetched_labels is labels
+        assert prefetched_inputs[0].dtype == torch.int64 and prefetched_inputs[1].dtype == torch.bfloat16
+        torch.testing.assert_close(prefetched_inputs[1].float(), inputs[1], atol=1e-2, rtol=1e-2)
+
+
+def test_all_fields_are_converted_by_default():
+    q_ids, inputs, labels = next(iter(BatchPrefetcher(list(_batches()), 'cpu', dtype=torch.bfloat16)))
+    assert inputs[1].dtype == torch.bfloat16 and labels.dtype == torch.bfloat16
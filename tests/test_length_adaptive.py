@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from duetv2_model import DuetV2
+
+VOCAB_SIZE = 200
+MAX_Q_LEN = 10
+MAX_D_LEN = 120
+
+
+def _model():
+    torch.manual_seed(0)
+    id_to_word = {i: str(i) for i in range(VOCAB_SIZE)}
+    return DuetV2(id_to_word, None, None, 16, 16, MAX_Q_LEN, MAX_D_LEN, 0.5, pooling_size_doc=20,
+                  length_adaptive=True).distributed_model.eval()
+
+
+def _batch():
+    """Queries and documents of different lengths, padded to the longest one of the batch."""
+    rng = np.random.default_rng(1)
+    query_lens = rng.integers(1, MAX_Q_LEN, size=16)
+    doc_lens = np.concatenate([[1, 2, 3, 80], rng.integers(1, 80, size=12)])
+    query = torch.zeros(16, query_lens.max(), dtype=torch.int64)
+    doc = torch.zeros(16, doc_lens.max(), dtype=torch.int64)
+    for i in range(16):
+        query[i, :query_lens[i]] = torch.from_numpy(rng.integers(1, VOCAB_SIZE, size=query_lens[i]))
+        doc[i, :doc_lens[i]] = torch.from_numpy(rng.integers(1, VOCAB_SIZE, size=doc_lens[i]))
+    return query, doc
+
+
+def _trim(tokens):
+    return tokens[None, :max(1, int((tokens != 0).sum()))]
+
+
+def test_padding_does_not_change_outputs():
+    model = _model()
+    query, doc = _batch()
+    padded_query, padded_doc = F.pad(query, (0, MAX_Q_LEN - query.shape[1])), F.pad(doc, (0, MAX_D_LEN - doc.shape[1]))
+    with torch.no_grad():
+        torch.testing.assert_close(model.encode_query(query), model.encode_query(padded_query))
+        torch.testing.assert_close(model.encode_docs(doc), model.encode_docs(padded_doc))
+        outputs = model(query, doc)
+        torch.testing.assert_close(outputs, model(padded_query, padded_doc))
+        torch.testing.assert_close(outputs, torch.cat([model(_trim(q), _trim(d)) for q, d in zip(query, doc)]))
+    assert (outputs > 0).any()
+
+
+def test_unpadded_documents_are_pooled_like_adaptive_max_pool():
+    model = _model()
+    adaptive_max_pool = torch.nn.AdaptiveMaxPool1d(model.n_pooling_windows)
+    d = torch.relu(torch.randn(4, 16, 90))
+    torch.testing.assert_close(model._max_pool_doc_adaptive(d, torch.full((4,), 90)), adaptive_max_pool(d))
+    # pooling the first positions of a document gives the same windows as pooling the document cut to that length
+    lengths = [90, 50, 10, 1]
+    pooled = model._max_pool_doc_adaptive(d, torch.tensor(lengths))
+    for i, n in enumerate(lengths):
+        torch.testing.assert_close(pooled[i], adaptive_max_pool(d[i, :, :n]))
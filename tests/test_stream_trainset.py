@@ -0,0 +1,30 @@
+import h5py
+import numpy as np
+import pytest
+from torch.utils.data import DataLoader
+
+from data_source import DuetHdf5StreamTrainset, collate_batch
+
+NUM_ROWS = 1000
+
+
+@pytest.fixture(scope='module')
+def train_file(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('stream') / 'train.hdf5')
+    rng = np.random.default_rng(0)
+    with h5py.File(path, 'w') as fp:
+        for name, length in (('queries', 5), ('pos_docs', 20), ('neg_docs', 20)):
+            fp.create_dataset(name, data=rng.integers(1, 100, size=(NUM_ROWS, length)))
+    return path
+
+
+@pytest.mark.parametrize('num_workers', [0, 3])
+def test_length_is_the_number_of_batches(train_file, num_workers):
+    idfs = np.ones(100, dtype=np.float32)
+    dataset = DuetHdf5StreamTrainset(train_file, 5, 20, idfs, batch_size=50, chunk_size=64, buffer_size=100,
+                                     num_workers=num_workers, build_imat=False)
+    dl = DataLoader(dataset, batch_size=None, collate_fn=collate_batch, num_workers=num_workers)
+    for epoch in range(2):
+        dataset.set_epoch(epoch)
+        batch_sizes = [len(b_y) for _, _, b_y in dl]
+        assert len(batch_sizes) == len(dl) and sum(batch_sizes) == NUM_ROWS
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import torch
+
+from duetv2_model import DuetV2
+
+VOCAB_SIZE = 200
+MAX_Q_LEN = 10
+MAX_D_LEN = 120
+
+
+def _model(precision='fp32'):
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    id_to_word = {i: str(i) for i in range(VOCAB_SIZE)}
+    idfs = rng.uniform(1, 10, size=VOCAB_SIZE).astype(np.float32)
+    model = DuetV2(id_to_word, None, None, 16, 16, MAX_Q_LEN, MAX_D_LEN, 0.5, pooling_size_doc=20, idfs=idfs,
+                   precision=precision)
+    # random weights cut most scores off at the last relu
+    with torch.no_grad():
+        model.linear_out.bias.add_(1)
+    return model.eval()
+
+
+def _batch():
+    """Queries from the first half of the vocabulary, every other document only from the second half."""
+    rng = np.random.default_rng(1)
+    query = torch.from_numpy(rng.integers(1, VOCAB_SIZE // 2, size=(32, MAX_Q_LEN)))
+    doc = torch.from_numpy(rng.integers(1, VOCAB_SIZE // 2, size=(32, MAX_D_LEN)))
+    doc[::2] += VOCAB_SIZE // 2 - 1
+    return query, doc
+
+
+def _scores(model, shortcut):
+    model.local_model.zero_overlap_shortcut = shortcut
+    with torch.no_grad():
+        return model(*_batch())
+
+
+@pytest.mark.parametrize('precision, tolerance', [('fp32', {}), ('bf16', {'atol': 1e-3, 'rtol': 1e-2})])
+def test_shortcut_scores_equal_full_scores(precision, tolerance):
+    model = _model(precision)
+    torch.testing.assert_close(_scores(model, True), _scores(model, False), **tolerance)
+    assert model.local_model.shortcut_rows == 16
+
+
+@pytest.mark.parametrize('precision, tolerance', [('fp32', {}), ('bf16', {'atol': 1e-3, 'rtol': 1e-2})])
+def test_shortcut_follows_parameter_updates(precision, tolerance):
+    model = _model(precision)
+    before = _scores(model, True)
+
+    # an optimizer step changes the cached output of empty interaction matrices, it raises the scores so that they
+    # are not all cut off by the last relu
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+    model.train()
+    (-model(*_batch()).sum()).backward()
+    optimizer.step()
+    model.eval()
+
+    after = _scores(model, True)
+    assert (after > 0).all() and not torch.allclose(before, after)
+    torch.testing.assert_close(after, _scores(model, False), **tolerance)
+
+
+def test_shortcut_follows_autocast():
+    model = _model('bf16')
+    # caches the output of empty interaction matrices computed in bf16
+    _scores(model, True)
+    model.precision = 'fp32'
+    torch.testing.assert_close(_scores(model, True), _scores(model, False))
+
+
+def test_shortcut_is_not_taken_in_training_or_with_gradients():
+    model = _model()
+    model(*_batch())
+    model.train()
+    with torch.no_grad():
+        model(*_batch())
+    assert model.local_model.shortcut_rows == 0
@@ -7,12 +7,57 @@ from torch import optim
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from data_source import DuetHdf5Trainset
+from data_source import BatchPrefetcher, BlockShuffleBatchSampler, DuetDynamicBatchTrainset, DuetDynamicTrainset, \
+    DuetHdf5BatchTrainset, DuetHdf5StreamTrainset, DuetHdf5Trainset, DuetMmapTrainset, LengthBucketBatchSampler, \
+    SharedBatchDataset, SharedBatchLoader, SharedBatchPool, collate_batch, collate_sparse, collate_trimmed, load_idfs
 from duetv2_model import DuetV2
 from qa_utils.io import batches_to_device, get_cuda_device, load_pkl_file
 from qa_utils.misc import Logger
 
 
+class SplitOptimizer(object):
+    """Steps several optimizers of disjoint parameters as one, e.g. SparseAdam for embeddings with sparse gradients
+    and Adam for all other parameters.
+    """
+
+    def __init__(self, *optimizers):
+        self.optimizers = optimizers
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+def build_optimizer(model, learning_rate):
+    """Create Adam for the trainable parameters of a model. Embeddings with sparse gradients are updated by SparseAdam
+    instead, which only updates the rows (and their moments) of the ids in a batch.
+
+    Args:
+        model: the model.
+        learning_rate: the learning rate of both optimizers.
+
+    Returns:
+        the optimizer, a SplitOptimizer if the model has sparse embeddings.
+    """
+    sparse = [m.weight for m in model.modules()
+              if isinstance(m, torch.nn.Embedding) and m.sparse and m.weight.requires_grad]
+    dense = [p for p in model.parameters() if p.requires_grad and all(p is not s for s in sparse)]
+    if not sparse:
+        return optim.Adam(dense, lr=learning_rate)
+    return SplitOptimizer(optim.SparseAdam(sparse, lr=learning_rate), optim.Adam(dense, lr=learning_rate))
+
+
 def train_model_pairwise_ce(model, train_dl, optimizer, device, args):
     """Train a model using pairwise CrossentropyLoss. Save the model after each epoch and log the loss in
         a file.
@@ -40,6 +85,9 @@ def train_model_pairwise_ce(model, train_dl, optimizer, device, args):
     criterion = torch.nn.CrossEntropyLoss()
     model.train()
     for epoch in range(args.epochs):
+        # datasets that sample negatives or shuffle on the fly depend on the epoch, workers get a copy when it starts
+        if hasattr(train_dl.dataset, 'set_epoch'):
+            train_dl.dataset.set_epoch(epoch)
         loss_sum = 0
         optimizer.zero_grad()
         for i, (b_pos, b_neg, b_y) in enumerate(tqdm(train_dl, desc='epoch {}'.format(epoch + 1))):
@@ -56,6 +104,8 @@ def train_model_pairwise_ce(model, train_dl, optimizer, device, args):
 
         epoch_loss = loss_sum / len(train_dl)
         print('epoch {} -- loss: {}'.format(epoch + 1, epoch_loss))
+        if isinstance(train_dl, BatchPrefetcher):
+            print('epoch {} -- waited {:.1f}s for data'.format(epoch + 1, train_dl.wait_time))
         logger.log([epoch + 1, epoch_loss])
 
         state = {'epoch': epoch + 1, 'state_dict': model.module.state_dict(), 'optimizer': optimizer.state_dict()}
@@ -66,19 +116,38 @@ def train_model_pairwise_ce(model, train_dl, optimizer, device, args):
 
 def main():
     ap = ArgumentParser(description='Train the DUET model.')
-    ap.add_argument('TRAIN_DATA', help='Path to an hdf5 file containing the training data.')
+    ap.add_argument('TRAIN_DATA', help='Path to an hdf5 file containing the training data, or a directory of flat '
+                                       'arrays created by hdf5_to_mmap.py.')
     ap.add_argument('VOCAB_FILE', help='Pickle file containing the mapping from ids to words.')
-    ap.add_argument('IDF_FILE', help='Pickle file containing the mapping from ids to words.')
+    ap.add_argument('IDF_FILE', help='File containing the idfs, either idfs.npy or the pickled idfs.pkl.')
 
     ap.add_argument('--glove_name', default='840B', help='GloVe embedding name')
     ap.add_argument('--glove_cache', default='glove_cache', help='Glove cache directory.')
     ap.add_argument('--glove_dim', type=int, default=300, help='The dimensionality of the GloVe embeddings')
+    ap.add_argument('--pca_dim', type=int,
+                    help='Reduce the embedding dimension to this many principal components of the GloVe vectors.')
+    ap.add_argument('--freeze_embeddings', default=False, action='store_true',
+                    help='Do not train the embeddings.')
+    ap.add_argument('--sparse_embeddings', default=False, action='store_true',
+                    help='Compute sparse gradients for the embeddings and update them with SparseAdam.')
+    ap.add_argument('--num_buckets', type=int,
+                    help='Bound the embedding memory by hashing all but the --num_frequent most frequent words into '
+                         'this many shared embeddings.')
+    ap.add_argument('--num_frequent', type=int, default=0,
+                    help='Number of the most frequent words (lowest idf) with their own embedding with --num_buckets.')
 
     ap.add_argument('--max_q_len', type=int, default=20, help='Maximum query length.')
     ap.add_argument('--max_d_len', type=int, default=200, help='Maximum document legth.')
 
     ap.add_argument('--hidden_dim', type=int, default=300,
                     help='The hidden dimension used throughout the whole network.')
+    ap.add_argument('--imat_in_model', default=False, action='store_true',
+                    help='Compute the interaction matrices in the model instead of the dataloader workers.')
+    ap.add_argument('--length_adaptive', default=False, action='store_true',
+                    help='Use a model that accepts batches padded to the longest query and document (and remove the '
+                         'remaining padding with --batch_reads).')
+    ap.add_argument('--sparse_imat', default=False, action='store_true',
+                    help='Pass the interaction matrices as lists of matches and compute the local model sparsely.')
     ap.add_argument('--dropout', type=float, default=0.5, help='Dropout value')
     ap.add_argument('--learning_rate', type=float, default=1e-3, help='Learning rate')
 
@@ -88,18 +157,128 @@ def main():
                     help='Update weights after this many batches')
     ap.add_argument('--working_dir', default='train', help='Working directory for checkpoints and logs')
     ap.add_argument('--num_workers', type=int, default=1, help='number of workers used by the dataloader.')
+    ap.add_argument('--batch_reads', default=False, action='store_true',
+                    help='Read whole batches from the hdf5 file at once, shuffling blocks of consecutive samples.')
+    ap.add_argument('--shuffle_block_size', type=int,
+                    help='Number of consecutive samples per shuffled block with --batch_reads (default: 4 batches).')
+    ap.add_argument('--bucket_by_length', default=False, action='store_true',
+                    help='With --batch_reads and --length_adaptive, batch samples of similar document length.')
+    ap.add_argument('--bucket_size', type=int,
+                    help='Number of samples sorted by length together with --bucket_by_length (default: 100 batches).')
+    ap.add_argument('--chunk_cache_bytes', type=int, help='Size of the hdf5 chunk cache per dataset.')
+    ap.add_argument('--preload', default=False, action='store_true',
+                    help='Read the whole hdf5 file into memory once.')
+    ap.add_argument('--preload_max_bytes', type=int, default=2 ** 32,
+                    help='Read lazily if the preloaded data is estimated to exceed this many bytes.')
+    ap.add_argument('--stream', default=False, action='store_true',
+                    help='Stream the hdf5 file in contiguous chunks and shuffle the rows in a buffer.')
+    ap.add_argument('--stream_chunk_size', type=int, default=4096,
+                    help='Number of consecutive rows read at once with --stream.')
+    ap.add_argument('--shuffle_buffer_size', type=int, default=65536,
+                    help='Number of rows in the shuffle buffer with --stream.')
+    ap.add_argument('--dynamic_negatives', default=False, action='store_true',
+                    help='Sample negatives on the fly from a file created with generate_hdf5.py --dynamic_negatives.')
+    ap.add_argument('--num_neg_examples', type=int, default=1,
+                    help='Number of negatives sampled per positive pair and epoch with --dynamic_negatives.')
+    ap.add_argument('--prefetch_batches', type=int, default=2,
+                    help='Number of batches moved to the device in a background thread ahead of time (0 to disable).')
+    ap.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32',
+                    help='Run the model in bf16 autocast, the weights and the scores stay in fp32.')
+    ap.add_argument('--bf16_imat', default=False, action='store_true',
+                    help='Move the interaction matrices to the device in bf16 (requires --precision bf16).')
+    ap.add_argument('--bf16_embeddings', default=False, action='store_true',
+                    help='Store the embeddings in bf16 (requires --precision bf16 and --freeze_embeddings).')
+    ap.add_argument('--shared_memory', default=False, action='store_true',
+                    help='With --batch_reads, workers write batches into a pool of shared memory slots and only pass '
+                         'the slot index to the training loop.')
     ap.add_argument('--random_seed', type=int, default=1579129142, help='Random seed')
 
     args = ap.parse_args()
 
     torch.manual_seed(args.random_seed)
 
-    idfs = load_pkl_file(args.IDF_FILE)
-    trainset = DuetHdf5Trainset(args.TRAIN_DATA, args.max_q_len, args.max_d_len, idfs)
-    train_dataloader = DataLoader(trainset, batch_size=args.batch_size, shuffle=True, pin_memory=True,
-                                  num_workers=args.num_workers)
+    if args.stream and (args.batch_reads or args.dynamic_negatives):
+        ap.error('--stream can not be combined with --batch_reads or --dynamic_negatives.')
+
+    if args.shared_memory and not args.batch_reads:
+        ap.error('--shared_memory requires --batch_reads.')
+    if args.bucket_by_length and not (args.batch_reads and args.length_adaptive):
+        ap.error('--bucket_by_length requires --batch_reads and --length_adaptive.')
+    if args.length_adaptive and args.shared_memory:
+        ap.error('--length_adaptive can not be combined with --shared_memory, the slots have a fixed shape.')
+    if args.sparse_imat and (args.length_adaptive or args.shared_memory):
+        ap.error('--sparse_imat can not be combined with --length_adaptive or --shared_memory.')
+
+    if args.pca_dim is not None and args.pca_dim > args.glove_dim:
+        ap.error('--pca_dim can not exceed --glove_dim.')
+    if args.freeze_embeddings and args.sparse_embeddings:
+        ap.error('--sparse_embeddings has no effect with --freeze_embeddings.')
+    if args.bf16_embeddings and not args.freeze_embeddings:
+        ap.error('--bf16_embeddings requires --freeze_embeddings.')
+    if (args.bf16_imat or args.bf16_embeddings) and args.precision != 'bf16':
+        ap.error('--bf16_imat and --bf16_embeddings require --precision bf16.')
+    if args.bf16_imat and (args.prefetch_batches == 0 or args.sparse_imat or args.imat_in_model):
+        # the sparse form stores the positions of the matches as floats
+        ap.error('--bf16_imat requires --prefetch_batches > 0 and dense interaction matrices computed by the '
+                 'dataloader.')
+
+    idfs = load_idfs(args.IDF_FILE)
+    if os.path.isdir(args.TRAIN_DATA):
+        if args.batch_reads or args.dynamic_negatives or args.stream:
+            ap.error('--batch_reads, --dynamic_negatives and --stream are only supported for hdf5 files.')
+        trainset = DuetMmapTrainset(args.TRAIN_DATA, args.max_q_len, args.max_d_len, idfs,
+                                    build_imat=not args.imat_in_model, sparse_imat=args.sparse_imat)
+    elif args.dynamic_negatives:
+        dataset_cls = DuetDynamicBatchTrainset if args.batch_reads else DuetDynamicTrainset
+        trainset = dataset_cls(args.TRAIN_DATA, args.max_q_len, args.max_d_len, idfs,
+                               num_neg_examples=args.num_neg_examples, seed=args.random_seed,
+                               build_imat=not args.imat_in_model, chunk_cache_bytes=args.chunk_cache_bytes,
+                               preload=args.preload, preload_max_bytes=args.preload_max_bytes,
+                               sparse_imat=args.sparse_imat)
+    elif args.stream:
+        trainset = DuetHdf5StreamTrainset(args.TRAIN_DATA, args.max_q_len, args.max_d_len, idfs,
+                                          batch_size=args.batch_size, chunk_size=args.stream_chunk_size,
+                                          buffer_size=args.shuffle_buffer_size, seed=args.random_seed,
+                                          num_workers=args.num_workers, build_imat=not args.imat_in_model,
+                                          chunk_cache_bytes=args.chunk_cache_bytes, preload=args.preload,
+                                          preload_max_bytes=args.preload_max_bytes, sparse_imat=args.sparse_imat)
+    else:
+        dataset_cls = DuetHdf5BatchTrainset if args.batch_reads else DuetHdf5Trainset
+        trainset = dataset_cls(args.TRAIN_DATA, args.max_q_len, args.max_d_len, idfs,
+                               build_imat=not args.imat_in_model, chunk_cache_bytes=args.chunk_cache_bytes,
+                               preload=args.preload, preload_max_bytes=args.preload_max_bytes,
+                               sparse_imat=args.sparse_imat)
+    if args.shared_memory:
+        # the shapes of the slots are taken from the first batch, every batch in flight and held by the prefetcher
+        # needs its own slot
+        pool = SharedBatchPool(trainset.__getitems__(list(range(min(args.batch_size, len(trainset))))),
+                               2 * max(args.num_workers, 1) + args.prefetch_batches + 3)
+        trainset = SharedBatchDataset(trainset, pool)
+    if args.batch_reads:
+        if args.bucket_by_length:
+            batch_sampler = LengthBucketBatchSampler(trainset.sample_lengths(), args.batch_size, args.bucket_size)
+        else:
+            batch_sampler = BlockShuffleBatchSampler(len(trainset), args.batch_size, args.shuffle_block_size)
+        collate_fn = collate_trimmed if args.length_adaptive else collate_batch
+        train_dataloader = DataLoader(trainset, batch_sampler=batch_sampler, collate_fn=collate_fn, pin_memory=True,
+                                      num_workers=args.num_workers)
+    elif args.stream:
+        # the stream shuffles itself and yields whole batches
+        collate_fn = collate_trimmed if args.length_adaptive else collate_batch
+        train_dataloader = DataLoader(trainset, batch_size=None, collate_fn=collate_fn, pin_memory=True,
+                                      num_workers=args.num_workers)
+    else:
+        # samples with sparse interaction matrices differ in size
+        collate_fn = collate_sparse if args.sparse_imat and not args.imat_in_model else None
+        train_dataloader = DataLoader(trainset, batch_size=args.batch_size, shuffle=True, collate_fn=collate_fn,
+                                      pin_memory=True, num_workers=args.num_workers)
 
     device = get_cuda_device()
+    if args.shared_memory:
+        train_dataloader = SharedBatchLoader(train_dataloader, pool, num_held=args.prefetch_batches + 2)
+    if args.prefetch_batches > 0:
+        train_dataloader = BatchPrefetcher(train_dataloader, device, args.prefetch_batches,
+                                           torch.bfloat16 if args.bf16_imat else None)
     id_to_word = load_pkl_file(args.VOCAB_FILE)
     model = DuetV2(id_to_word=id_to_word,
                    glove_name=args.glove_name,
@@ -108,11 +287,22 @@ def main():
                    h_dim=args.hidden_dim,
                    max_q_len=args.max_q_len,
                    max_d_len=args.max_d_len,
-                   dropout_rate=args.dropout)
+                   dropout_rate=args.dropout,
+                   idfs=idfs if args.imat_in_model else None,
+                   length_adaptive=args.length_adaptive,
+                   sparse_imat=args.sparse_imat,
+                   pca_dim=args.pca_dim,
+                   num_buckets=args.num_buckets,
+                   num_frequent=args.num_frequent,
+                   embedding_idfs=idfs,
+                   sparse_embeddings=args.sparse_embeddings,
+                   freeze_embeddings=args.freeze_embeddings,
+                   precision=args.precision,
+                   bf16_embeddings=args.bf16_embeddings)
     model = model.to(device)
     model = torch.nn.DataParallel(model)
 
-    optimizer = optim.Adam(model.parameters(), lr=args.learning_rate)
+    optimizer = build_optimizer(model, args.learning_rate)
     train_model_pairwise_ce(model, train_dataloader, optimizer, device, args)
 
 